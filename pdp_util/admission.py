@@ -0,0 +1,337 @@
+"""
+This module provides admission control for heavy PCDS downloads: limits on the number of downloads running at once, overall and per client, and on their total estimated size, with requests beyond those limits queued (first-come, first-served or shortest job first) for a while and then turned away with a 503
+"""
+
+import time
+import logging
+from contextlib import contextmanager
+from threading import Condition
+
+from webob.request import Request
+from paste.httpexceptions import HTTPServiceUnavailable
+
+from pycds import CrmpNetworkGeoserver as cng
+from pdp_util.util import get_stn_list, get_clip_dates, close_iterator
+from pdp_util.filters import validate_vars
+from pdp_util.counts import length_of_return_dataset, length_of_return_climo
+from pdp_util.agg import agg_generator
+from pdp_util import session_scope
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ACTIVE = 8
+DEFAULT_MAX_PER_CLIENT = 2
+DEFAULT_QUEUE_TIMEOUT = 30
+DEFAULT_RETRY_AFTER = 60
+DEFAULT_AGING = 60
+
+FIFO = "fifo"
+SJF = "sjf"
+
+
+class AdmissionRejected(Exception):
+    """Raised when a download cannot be admitted
+
+    :param reason: human readable explanation
+    :param retry_after: number of seconds after which the client may try again
+    """
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class Ticket(object):
+    """A download waiting for, or holding, an admission slot"""
+
+    def __init__(self, client, cost):
+        self.client = client
+        self.cost = cost
+        self.queued = time.monotonic()
+
+
+class AdmissionController(object):
+    """Thread-safe bookkeeping of the downloads which are running and those which are waiting to run
+
+    A download is admitted when fewer than ``max_active`` downloads are running, fewer than ``max_per_client`` of them belong to the same client and, if ``max_load`` is set, the estimated costs of the running downloads plus its own do not exceed ``max_load``. A download whose cost alone exceeds ``max_load`` is admitted once nothing else is running. Waiting downloads are considered in the order given by ``scheduling``:
+
+    .. hlist::
+       * ``fifo``: first-come, first-served
+       * ``sjf``: shortest job first, by estimated cost. A download's rank is its cost halved for every ``aging`` seconds it has waited, so large downloads move up the queue. A download which has waited ``starvation_time`` seconds goes ahead of every download that has not, whatever its cost, so that large downloads are admitted before they time out even while small ones keep arriving.
+
+    The first download in that order which fits is admitted, except that no download may overtake one which is held back by the global limits (as opposed to the limit of its own client), which is what guarantees that large downloads eventually run. A download which has not been admitted within ``queue_timeout`` seconds, or which arrives when ``max_queued`` downloads are already waiting, is rejected.
+
+    :param max_active: maximum number of downloads running at once
+    :type max_active: int
+    :param max_per_client: maximum number of downloads running at once for a single client
+    :type max_per_client: int
+    :param max_load: maximum total estimated cost (number of records) of the running downloads, or None for no limit
+    :type max_load: int
+    :param max_queued: maximum number of waiting downloads, or None for no limit
+    :type max_queued: int
+    :param queue_timeout: number of seconds a download may wait for admission
+    :type queue_timeout: float
+    :param retry_after: number of seconds which rejected clients are asked to wait before trying again
+    :type retry_after: int
+    :param scheduling: ``fifo`` or ``sjf``
+    :type scheduling: str
+    :param aging: number of seconds of waiting which halve the rank of a download under ``sjf`` scheduling
+    :type aging: float
+    :param starvation_time: number of seconds after which a waiting download is no longer ranked by cost under ``sjf`` scheduling, or None for half of ``queue_timeout``
+    :type starvation_time: float
+    """
+
+    def __init__(
+        self,
+        max_active=DEFAULT_MAX_ACTIVE,
+        max_per_client=DEFAULT_MAX_PER_CLIENT,
+        max_load=None,
+        max_queued=None,
+        queue_timeout=DEFAULT_QUEUE_TIMEOUT,
+        retry_after=DEFAULT_RETRY_AFTER,
+        scheduling=FIFO,
+        aging=DEFAULT_AGING,
+        starvation_time=None,
+    ):
+        if scheduling not in (FIFO, SJF):
+            raise ValueError(f"Unknown scheduling policy: {scheduling}")
+        self.max_active = max_active
+        self.max_per_client = max_per_client
+        self.max_load = max_load
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.scheduling = scheduling
+        self.aging = aging
+        self.starvation_time = (
+            queue_timeout / 2 if starvation_time is None else starvation_time
+        )
+        self.active = []
+        self.waiting = []
+        self._cond = Condition()
+
+    @property
+    def load(self):
+        return sum(ticket.cost for ticket in self.active)
+
+    def acquire(self, client, cost):
+        """Wait for an admission slot for a download of estimated ``cost`` by ``client``
+
+        :rtype: :class:`Ticket`, to be handed back to :meth:`release`
+        :raises: :class:`AdmissionRejected`
+        """
+        ticket = Ticket(client, cost)
+        deadline = ticket.queued + self.queue_timeout
+        with self._cond:
+            self.waiting.append(ticket)
+            try:
+                if (
+                    self.max_queued is not None
+                    and self._next() is not ticket
+                    and len(self.waiting) > self.max_queued
+                ):
+                    raise AdmissionRejected(
+                        "Too many downloads waiting", self.retry_after
+                    )
+                while self._next() is not ticket:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise AdmissionRejected(
+                            "Timed out waiting for a download slot", self.retry_after
+                        )
+                    self._cond.wait(remaining)
+                self.active.append(ticket)
+            finally:
+                self.waiting.remove(ticket)
+                # Whoever is next may have been waiting behind this ticket
+                self._cond.notify_all()
+        return ticket
+
+    def release(self, ticket):
+        """Give up the slot held by ``ticket``"""
+        with self._cond:
+            self.active.remove(ticket)
+            self._cond.notify_all()
+
+    def fits(self, ticket):
+        """Whether ``ticket`` could be admitted now"""
+        return self.client_fits(ticket) and self.capacity_fits(ticket)
+
+    def client_fits(self, ticket):
+        running = sum(1 for active in self.active if active.client == ticket.client)
+        return running < self.max_per_client
+
+    def capacity_fits(self, ticket):
+        if len(self.active) >= self.max_active:
+            return False
+        if self.max_load is not None and self.active:
+            return self.load + ticket.cost <= self.max_load
+        return True
+
+    def rank(self, ticket, now):
+        """The position of ``ticket`` among the waiting downloads: lower goes first"""
+        if self.scheduling == SJF:
+            waited = now - ticket.queued
+            if waited >= self.starvation_time:
+                # Oldest first, ahead of all of the ranked downloads
+                return (0, 0, ticket.queued)
+            return (1, ticket.cost * 0.5 ** (waited / self.aging), ticket.queued)
+        return (ticket.queued,)
+
+    def _next(self):
+        """The waiting ticket to be admitted next, if any"""
+        now = time.monotonic()
+        for ticket in sorted(self.waiting, key=lambda ticket: self.rank(ticket, now)):
+            if not self.client_fits(ticket):
+                continue
+            if self.capacity_fits(ticket):
+                return ticket
+            return None
+        return None
+
+
+def client_id(environ, header=None):
+    """Identify the client of a request by the first address in the header ``header`` (e.g. ``X-Forwarded-For``, when behind a proxy) or else by its remote address"""
+    if header:
+        key = "HTTP_" + header.upper().replace("-", "_")
+        if environ.get(key):
+            return environ[key].split(",")[0].strip()
+    return environ.get("REMOTE_ADDR", "")
+
+
+def estimate_cost(sesh, environ):
+    """Estimate the number of records a download request would return, with :func:`pdp_util.counts.length_of_return_dataset` or, for climatologies, :func:`pdp_util.counts.length_of_return_climo`"""
+    filters = validate_vars(environ)
+    stns = [stn[0] for stn in get_stn_list(sesh, filters, cng.station_id)]
+    if "download-climatology" in Request(environ).params:
+        rv = length_of_return_climo(sesh, stns)
+    else:
+        sdate, edate = get_clip_dates(environ)
+        rv = length_of_return_dataset(sesh, stns, sdate, edate)
+    return int(rv[0] if rv[0] else 0)
+
+
+class AdmissionApp(object):
+    """WSGI middleware which admits download requests to the application ``app`` (a :class:`pdp_util.agg.PcdsZipApp`) through an :class:`AdmissionController`
+
+    The cost of each request is estimated before it is queued. The slot is held until the response has been sent (or abandoned), and a request which is not admitted gets a 503 response with a Retry-After header.
+
+    Requests which ``app`` says it would not build (see :meth:`pdp_util.agg.PcdsZipApp.builds`), because they are served from its cache or join a build already in progress, are passed straight through: they are neither estimated nor queued, as they cost the database nothing. Should the build they were to join end in the meantime, they build their own without admission. Responses sent with the server's ``wsgi.file_wrapper`` (cached archives) are passed through unwrapped, so that the server can still send them with ``sendfile``, and their slot is released at once.
+
+    :param app: the download application
+    :param session_scope_factory: callable returning a context manager which provides a database session for the cost estimate
+    :param controller: the admission controller
+    :type controller: :class:`AdmissionController`
+    :param client_header: optional request header identifying the client (see :func:`client_id`)
+    :type client_header: str
+    """
+
+    def __init__(self, app, session_scope_factory, controller, client_header=None):
+        self.app = app
+        self.session_scope_factory = session_scope_factory
+        self.controller = controller
+        self.client_header = client_header
+
+    def __call__(self, environ, start_response):
+        sesh = environ.get("sesh", None)
+
+        @contextmanager
+        def dummy_context():
+            yield sesh
+
+        builds = getattr(self.app, "builds", None)
+        if builds is not None and not builds(environ):
+            return self.app(environ, start_response)
+
+        with self.session_scope_factory() if not sesh else dummy_context() as sesh:
+            cost = estimate_cost(sesh, environ)
+
+        client = client_id(environ, self.client_header)
+        try:
+            ticket = self.controller.acquire(client, cost)
+        except AdmissionRejected as e:
+            logger.info(f"Rejected download of {cost} records for {client}: {e}")
+            return HTTPServiceUnavailable(
+                str(e), headers=[("Retry-After", str(e.retry_after))]
+            )(environ, start_response)
+
+        try:
+            response = self.app(environ, start_response)
+        except Exception:
+            self.controller.release(ticket)
+            raise
+        return self.released(response, ticket, environ)
+
+    def released(self, response, ticket, environ=None):
+        """Wrap ``response`` so that ``ticket`` is released once it is finished or abandoned
+
+        A response from the server's ``wsgi.file_wrapper`` is returned as it is, since wrapping it would hide it from the server, and ``ticket`` is released straight away.
+
+        :rtype: :class:`ReleasingResponse`
+        """
+        file_wrapper = (environ or {}).get("wsgi.file_wrapper")
+        if isinstance(file_wrapper, type) and isinstance(response, file_wrapper):
+            self.controller.release(ticket)
+            return response
+        return ReleasingResponse(response, lambda: self.controller.release(ticket))
+
+
+class ReleasingResponse(object):
+    """A WSGI response which passes through ``response`` and calls ``release()`` when it is closed
+
+    Unlike a generator's ``finally``, :meth:`close` runs even if the server closes the response before it has asked for any of it.
+
+    :param response: the wrapped WSGI response
+    :param release: callable, called once
+    """
+
+    def __init__(self, response, release):
+        self.response = response
+        self.release = release
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.response)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            close_iterator(self.response)
+        finally:
+            self.release()
+
+
+def admission_generator(global_conf, **kwargs):
+    """Factory function for an :class:`AdmissionApp` in front of a :class:`pdp_util.agg.PcdsZipApp`
+
+    :param global_conf: dict of the configuration accepted by :func:`pdp_util.agg.agg_generator`, plus the optional keys max_active, max_per_client, max_load, max_queued, queue_timeout, retry_after, client_header, scheduling (``fifo`` or ``sjf``), aging and starvation_time
+    :param kwargs: ignored
+    """
+    dsn = global_conf["dsn"]
+    controller = AdmissionController(
+        max_active=int(global_conf.get("max_active", DEFAULT_MAX_ACTIVE)),
+        max_per_client=int(global_conf.get("max_per_client", DEFAULT_MAX_PER_CLIENT)),
+        max_load=(
+            int(global_conf["max_load"]) if global_conf.get("max_load") else None
+        ),
+        max_queued=(
+            int(global_conf["max_queued"]) if global_conf.get("max_queued") else None
+        ),
+        queue_timeout=float(global_conf.get("queue_timeout", DEFAULT_QUEUE_TIMEOUT)),
+        retry_after=int(global_conf.get("retry_after", DEFAULT_RETRY_AFTER)),
+        scheduling=global_conf.get("scheduling", FIFO),
+        aging=float(global_conf.get("aging", DEFAULT_AGING)),
+        starvation_time=(
+            float(global_conf["starvation_time"])
+            if global_conf.get("starvation_time")
+            else None
+        ),
+    )
+    return AdmissionApp(
+        agg_generator(global_conf),
+        lambda: session_scope(dsn),
+        controller,
+        global_conf.get("client_header"),
+    )
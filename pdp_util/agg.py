@@ -2,25 +2,83 @@
 This module provides aggregation utilities to translate a single HTTP request into multiple OPeNDAP requests, returning a single response
 """
 
+import time
+import logging
 from itertools import chain
-from zipfile import ZipFile, ZIP_DEFLATED
-from tempfile import SpooledTemporaryFile
+from functools import partial
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from webob.request import Request
 from paste.httpexceptions import HTTPBadRequest
-import numpy as np
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.dialects.postgresql import array
 
 from pdp_util.util import get_stn_list
-from pdp_util.filters import validate_vars
+from pdp_util.filters import validate_vars, canonical_filters
 from pycds import Variable, Network, variable_tags
 from pydap_extras.handlers.pcic import RawPcicSqlHandler, ClimoPcicSqlHandler
 from pydap_extras.handlers.sql import Engines
-from pydap.model import DatasetType, SequenceType, BaseType
-from pydap.handlers.lib import BaseHandler
 
-from pdp_util.util import get_extension, get_clip_dates
+from pdp_util.util import (
+    get_extension,
+    get_clip_dates,
+    get_compression,
+    compression_methods,
+    file_response,
+    close_iterator,
+    ClosingIterator,
+    asbool,
+)
+from pdp_util.zipstream import ZipStream, DEFAULT_BLOCK_SIZE
+from pdp_util.prefetch import PrefetchedResponders, DEFAULT_PREFETCH_BYTES
+from pdp_util.coalesce import Coalescer, DEFAULT_COALESCE_MEMORY
+from pdp_util.spool import spooled_responders, spool_file, DEFAULT_SPOOL_MEMORY
+from pdp_util.extract import (
+    get_bulk_responders,
+    get_copy_responders,
+    cancel_query,
+    track_queries,
+    cancel_thread_query,
+    DEFAULT_BATCH_SIZE,
+    TABLE_FORMAT,
+)
+from pdp_util.columnar import get_dsg_responders, DSG_FORMAT
+from pdp_util.windows import (
+    get_station_windows,
+    window_constraints,
+    window_name,
+    parse_window,
+    prune_stations,
+)
+from pdp_util.incremental import (
+    get_since,
+    snapshot_time,
+    changed_stations,
+    get_manifest_responders,
+)
+from pdp_util.budget import MemoryBudget
+from pdp_util.failures import (
+    retrying,
+    get_error_responders,
+    DEFAULT_RETRY_BACKOFF,
+)
+from pdp_util.instrument import Instrumentation, TEXT_EXTENSIONS
+from pdp_util.cache import (
+    ArchiveCache,
+    MemoryCache,
+    cache_key,
+    DEFAULT_CACHE_BYTES,
+    DEFAULT_CACHE_TTL,
+    DEFAULT_CACHE_ENTRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+SPOOL_SIZE = 1024**3
+# The earliest timestamp a ZIP archive can hold, given to every member of a
+# deterministic archive
+DETERMINISTIC_DATE_TIME = (1980, 1, 1, 0, 0, 0)
 
 
 def null_start_response(status, response_headers, exc_info=None):
@@ -28,10 +86,127 @@ def null_start_response(status, response_headers, exc_info=None):
 
 
 class PcdsZipApp(object):
-    """WSGI application which accepts a set of PCDS filters in the request and responds with a generator which streams the OPeNDAP responses one by one"""
+    """WSGI application which accepts a set of PCDS filters in the request and responds with a generator which streams the OPeNDAP responses one by one
 
-    def __init__(self, dsn, sesh=None):
+    Besides the pydap response formats, the ``data-format`` parameter accepts ``dsg``, for which all stations are written to a single CF discrete sampling geometry netCDF file (see :mod:`pdp_util.columnar`). That file is written to the ``spill_dir`` directory before it is streamed. If ``bulk`` or ``copy`` is enabled, it also accepts ``table``, for which each station is extracted directly from the database into a plain CSV table (see :mod:`pdp_util.extract`). The ``csv`` format is always the pydap response.
+
+    A ``table`` download of observations with a ``since`` parameter (the ``next_token`` of a previous download, or a timestamp) is incremental: only the stations with observations inserted or changed since then are exported, with just the rows at which they changed, and a ``manifest.json`` member describes the delta (see :mod:`pdp_util.incremental`).
+    """
+
+    def __init__(
+        self,
+        dsn,
+        sesh=None,
+        streaming=False,
+        block_size=DEFAULT_BLOCK_SIZE,
+        prefetch=0,
+        prefetch_bytes=DEFAULT_PREFETCH_BYTES,
+        compression=ZIP_DEFLATED,
+        compresslevel=None,
+        compress_workers=0,
+        compress_processes=False,
+        cache=None,
+        bulk=False,
+        bulk_batch_size=DEFAULT_BATCH_SIZE,
+        metadata_cache=None,
+        coalesce=False,
+        coalesce_memory=DEFAULT_COALESCE_MEMORY,
+        memory_budget=None,
+        spill_dir=None,
+        instrument=False,
+        instrument_callback=None,
+        window=None,
+        retries=None,
+        retry_backoff=DEFAULT_RETRY_BACKOFF,
+        prune=False,
+        copy=False,
+        spool=False,
+        spool_memory=DEFAULT_SPOOL_MEMORY,
+        deterministic=False,
+    ):
+        """Initialize the application
+
+        :param dsn: sqlalchemy-style dsn string for the database
+        :param sesh: optional database session whose engine should be used for data queries
+        :param streaming: if True, build the archive with :func:`streaming_ziperator` rather than :func:`ziperator`
+        :type streaming: bool
+        :param block_size: size in bytes of the blocks yielded in streaming mode
+        :type block_size: int
+        :param prefetch: number of station responders to run ahead of the one being written (see :class:`pdp_util.prefetch.PrefetchedResponders`). 0 disables prefetching.
+        :type prefetch: int
+        :param prefetch_bytes: cap on the number of bytes held by prefetched responders
+        :type prefetch_bytes: int
+        :param compression: default archive compression method, :py:data:`zipfile.ZIP_DEFLATED` or :py:data:`zipfile.ZIP_STORED`. Requests may override it with the ``compression`` parameter (``deflated`` or ``stored``).
+        :param compresslevel: default zlib compression level (0-9), or None for the zlib default. Requests may override it with the ``compression-level`` parameter.
+        :type compresslevel: int
+        :param compress_workers: number of workers used to compress archive members in parallel. 0 compresses in the request thread. Parallel compression always uses the streaming archive writer.
+        :type compress_workers: int
+        :param compress_processes: if True, compress in a process pool rather than a thread pool
+        :type compress_processes: bool
+        :param cache: optional cache in which finished archives are kept and from which identical requests are served, with an ``ETag`` and in byte ranges on request
+        :type cache: :class:`pdp_util.cache.ArchiveCache`
+        :param bulk: if True, offer the ``table`` data format, extracted in batches of stations with :func:`pdp_util.extract.get_bulk_responders` instead of one pydap request per station. Other formats, ``csv`` included, are unaffected, and bulk extraction is never prefetched.
+        :type bulk: bool
+        :param bulk_batch_size: number of stations per bulk extraction query
+        :type bulk_batch_size: int
+        :param metadata_cache: optional cache for the variable metadata of each network, which spares repeated downloads the metadata query
+        :type metadata_cache: :class:`pdp_util.cache.MemoryCache`
+        :param coalesce: if True, identical downloads which are requested while one is being built share its archive rather than building their own (see :class:`pdp_util.coalesce.Coalescer`). Downloads are identical when they have the same cache key.
+        :type coalesce: bool
+        :param coalesce_memory: number of bytes of each shared archive to keep in memory for its readers; the rest is spilled to ``spill_dir``
+        :type coalesce_memory: int
+        :param memory_budget: optional number of bytes that the buffers of a single download (prefetch queues, parallel compression and the spooled archive) may hold in memory. When it is exhausted the download spills to disk or works less concurrently; see :class:`pdp_util.budget.MemoryBudget`.
+        :type memory_budget: int
+        :param spill_dir: directory in which prefetched members that do not fit in memory are spilled, or None to make prefetching wait for memory instead. An empty string means the system's default temporary directory.
+        :type spill_dir: str
+        :param instrument: if True, time the query, encoding and compression of every member and the sending of the response, and log the figures (see :class:`pdp_util.instrument.Instrumentation`)
+        :type instrument: bool
+        :param instrument_callback: optional callable which receives the figures as (``event``, ``stats``); giving one implies ``instrument``
+        :param retries: if set, a station whose query fails is retried this many times, with backoff, and if it still fails the archive is finished without it and the failure listed in an ``errors.txt`` member (see :mod:`pdp_util.failures`). By default a failure aborts the download. Bulk, ``COPY`` and ``dsg`` downloads, which share one query between stations, are not isolated.
+        :type retries: int
+        :param retry_backoff: number of seconds to wait before the first retry, doubled for each retry after it
+        :type retry_backoff: float
+        :param prune: if True, leave out the stations which have no observations between the requested dates without querying them (see :func:`pdp_util.windows.prune_stations`), and list them in a ``stations_without_data.csv`` member instead. Climatologies and incremental downloads are not pruned.
+        :type prune: bool
+        :param copy: if True, offer the ``table`` data format and have PostgreSQL produce it with ``COPY`` (see :func:`pdp_util.extract.get_copy_responders`), in the same layout as bulk extraction. This takes precedence over ``bulk``, and is never prefetched.
+        :type copy: bool
+        :param spool: if True, drain each station into a spool (in memory up to ``spool_memory`` bytes, then in ``spill_dir``) before it is written to the archive, so that its database connection is given back as soon as the database has produced it rather than when a slow client has received it (see :func:`pdp_util.spool.spooled_responders`). With ``copy``, the session's connection is also released between stations; bulk extraction holds it for a whole batch regardless.
+        :type spool: bool
+        :param spool_memory: number of bytes of each spooled station to keep in memory
+        :type spool_memory: int
+        :param deterministic: if True, build archives byte for byte the same for the same data: the stations are written in a fixed order and every member is given the same timestamp (:data:`DETERMINISTIC_DATE_TIME`) rather than the time of the download. A cached archive which is rebuilt then keeps its ``ETag``, so that a client can resume its download with a ``Range`` request across the rebuild. ``dsg`` files are not reproducible, whatever this setting.
+        :type deterministic: bool
+        :param window: if set, export the raw observations of each station as several members, one per time window: ``"year"`` for calendar years, or a number of rows per member (see :mod:`pdp_util.windows`). Each member is then a bounded query of its own. Climatologies and ``table`` downloads are not split.
+        """
         self.dsn = dsn
+        self.streaming = streaming
+        self.block_size = block_size
+        self.prefetch = prefetch
+        self.prefetch_bytes = prefetch_bytes
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self.compress_workers = compress_workers
+        self.executor = None
+        if compress_workers:
+            Executor = ProcessPoolExecutor if compress_processes else ThreadPoolExecutor
+            self.executor = Executor(max_workers=compress_workers)
+        self.cache = cache
+        self.bulk = bulk
+        self.bulk_batch_size = bulk_batch_size
+        self.metadata_cache = metadata_cache
+        self.coalescer = Coalescer(coalesce_memory, spill_dir) if coalesce else None
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.instrument = instrument or instrument_callback is not None
+        self.instrument_callback = instrument_callback
+        self.window = window
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.prune = prune
+        self.copy = copy
+        self.spool = spool
+        self.spool_memory = spool_memory
+        self.deterministic = deterministic
         if sesh:
             # Stash a copy of our engine in pydap.handlers.sql so that it will use it for data queries
             Engines[self.dsn] = sesh.get_bind()
@@ -41,6 +216,53 @@ class PcdsZipApp(object):
         Session = sessionmaker(bind=Engines[self.dsn])
         return Session()
 
+    @property
+    def extra_formats(self):
+        """The data formats served besides pydap's"""
+        if self.bulk or self.copy:
+            return [DSG_FORMAT, TABLE_FORMAT]
+        return [DSG_FORMAT]
+
+    def builds(self, environ):
+        """Whether the download requested by ``environ`` would build an archive, rather than be served from the cache or join a build in progress with the same key (see :meth:`__call__`). Bad requests are said to build, since they are left to :meth:`__call__` to turn away.
+
+        :rtype: bool
+        """
+        if not (self.cache or self.coalescer):
+            return True
+        ext = get_extension(environ, self.extra_formats)
+        if not ext:
+            return True
+        try:
+            compression, compresslevel = get_compression(environ)
+            since = get_since(environ)
+        except ValueError:
+            return True
+        key = self.key(
+            validate_vars(environ),
+            get_clip_dates(environ),
+            ext,
+            "download-climatology" in Request(environ).params,
+            self.compression if compression is None else compression,
+            self.compresslevel if compresslevel is None else compresslevel,
+            since,
+        )
+        if self.cache and key in self.cache:
+            return False
+        return not (self.coalescer and key in self.coalescer)
+
+    def key(self, filters, clip_dates, ext, climo, compression, compresslevel, since):
+        """The key under which a download is cached and coalesced (see :func:`pdp_util.cache.cache_key`)"""
+        return cache_key(
+            canonical_filters(filters),
+            clip_dates,
+            ext,
+            climo,
+            compression,
+            compresslevel,
+            *((since,) if since else ()),
+        )
+
     def __call__(self, environ, start_response):
         """Fire off pydap requests and return an iterable (from :func:`ziperator`)"""
         req = Request(environ)
@@ -48,109 +270,615 @@ class PcdsZipApp(object):
         climo = True if "download-climatology" in form else False
 
         filters = validate_vars(environ)
-        stns = get_stn_list(self.session, filters)
+        clip_dates = get_clip_dates(environ)
 
-        ext = get_extension(environ)
+        ext = get_extension(environ, self.extra_formats)
         if not ext:
             return HTTPBadRequest("Requested extension not supported")(
                 environ, start_response
             )
+        try:
+            compression, compresslevel = get_compression(environ)
+            since = get_since(environ)
+        except ValueError as e:
+            return HTTPBadRequest(str(e))(environ, start_response)
+        if since and (climo or ext != TABLE_FORMAT):
+            return HTTPBadRequest(
+                "Incremental downloads are only available for observations in "
+                f"the {TABLE_FORMAT} format"
+            )(environ, start_response)
+        if compression is None:
+            compression = self.compression
+        if compresslevel is None:
+            compresslevel = self.compresslevel
 
         status = "200 OK"
         response_headers = [
             ("Content-type", "application/zip"),
             ("Content-Disposition", 'filename="pcds_data.zip"'),
         ]
+
+        key = None
+        if self.cache or self.coalescer:
+            key = self.key(
+                filters, clip_dates, ext, climo, compression, compresslevel, since
+            )
+        if self.cache:
+            f = self.cache.open(key)
+            if f:
+                # A cached archive has a known length, so it can be sent in
+                # ranges to resume a download; one being built cannot.
+                return file_response(
+                    environ,
+                    start_response,
+                    f,
+                    response_headers,
+                    self.cache.etag(f),
+                    self.block_size,
+                )
+
         start_response(status, response_headers)
         environ["pydap.handlers.pcic.dsn"] = self.dsn
+        args = (
+            environ,
+            filters,
+            clip_dates,
+            ext,
+            climo,
+            compression,
+            compresslevel,
+            since,
+        )
+        if self.coalescer:
+            return self.coalescer.subscribe(key, lambda: self.archive(*args, key))
+        return self.archive(*args, key)
+
+    def archive(
+        self,
+        environ,
+        filters,
+        clip_dates,
+        ext,
+        climo,
+        compression,
+        compresslevel,
+        since,
+        key,
+    ):
+        """Look up the selected stations and return an iterator of the blocks of their archive
+
+        The database sessions of the download are closed when the iterator is closed, even if it was never iterated, or as soon as building it fails.
+
+        :param since: if set, only export what changed after this datetime, along with a manifest of the changes (see :mod:`pdp_util.incremental`)
+        :param key: the download key under which the archive is stored in the cache, if there is one
+        """
+        sessions = []
+        try:
+            archive = self._archive(
+                environ,
+                filters,
+                clip_dates,
+                ext,
+                climo,
+                compression,
+                compresslevel,
+                since,
+                key,
+                sessions,
+            )
+        except BaseException:
+            close_sessions(sessions, cancel=True)
+            raise
+        return ClosingIterator(archive, partial(close_sessions, sessions))
+
+    def _archive(
+        self,
+        environ,
+        filters,
+        clip_dates,
+        ext,
+        climo,
+        compression,
+        compresslevel,
+        since,
+        key,
+        sessions,
+    ):
+        """Build the iterator of :meth:`archive`, adding each database session that it opens to the list ``sessions``"""
+        sesh = self.session
+        sessions.append(sesh)
+        stns = get_stn_list(sesh, filters)
+        if self.deterministic:
+            stns = sorted(stns, key=lambda stn: tuple(map(str, stn)))
+        # Every selected network gets its variables, even if none of its
+        # stations make it into the archive
+        selected_stns = stns
+        pruned = []
+        # The changes since a download are not in the views pruning relies on
+        if self.prune and not climo and not since:
+            stns, pruned = prune_stations(sesh, stns, clip_dates)
+            if pruned:
+                logger.info(f"Pruned {len(pruned)} stations without data")
+        manifest = []
+        data_sesh = None
+        if since:
+            # The token, the changed stations and their observations all come
+            # from one snapshot of the database
+            data_sesh = self.session
+            sessions.append(data_sesh)
+            data_sesh.connection(
+                execution_options={"isolation_level": "REPEATABLE READ"}
+            )
+            snapshot = snapshot_time(data_sesh)
+            selected = len(stns)
+            stns, counts = changed_stations(data_sesh, stns, since, clip_dates)
+            logger.info(f"{len(stns)} of {selected} stations changed since {since}")
+            manifest = get_manifest_responders(
+                since, snapshot, counts, selected - len(stns)
+            )
+        budget = MemoryBudget(self.memory_budget) if self.memory_budget else None
+        instrument = (
+            Instrumentation(self.instrument_callback) if self.instrument else None
+        )
 
+        bulk = ext == TABLE_FORMAT
+        copy = bulk and self.copy
+        release = None
+        failures = None
+        if ext == DSG_FORMAT:
+            data_sesh = self.session
+            sessions.append(data_sesh)
+            pcds_responders = close_when_done(
+                data_sesh,
+                get_dsg_responders(data_sesh, stns, clip_dates, climo, self.spill_dir),
+            )
+        elif bulk:
+            if data_sesh is None:
+                data_sesh = self.session
+                sessions.append(data_sesh)
+            get_responders = get_copy_responders if copy else get_bulk_responders
+            pcds_responders = close_when_done(
+                data_sesh,
+                get_responders(
+                    data_sesh,
+                    stns,
+                    clip_dates,
+                    climo,
+                    self.bulk_batch_size,
+                    since=since,
+                ),
+            )
+            if copy and not since:
+                # Every COPY is a query of its own, so the connection can be
+                # handed back between stations
+                release = data_sesh.close
+            if instrument:
+                pcds_responders = instrument.timed_responders(
+                    pcds_responders, count_rows=True
+                )
+        else:
+            windows = None
+            if self.window and not climo:
+                windows = get_station_windows(sesh, stns, clip_dates, self.window)
+            if self.retries is not None:
+                failures = []
+            pcds_responders = get_pcds_responders(
+                self.dsn,
+                stns,
+                ext,
+                clip_dates,
+                environ,
+                instrument,
+                windows,
+                failures,
+                self.retries or 0,
+                self.retry_backoff,
+            )
+        if self.prefetch and not bulk and ext != DSG_FORMAT:
+            # The pydap handlers' queries can only be cancelled through
+            # their engine
+            track_queries(Engines[self.dsn])
+            pcds_responders = PrefetchedResponders(
+                pcds_responders,
+                self.prefetch,
+                self.prefetch_bytes,
+                budget,
+                self.spill_dir,
+                cancel_thread_query,
+            )
+        if self.spool and ext != DSG_FORMAT:
+            pcds_responders = spooled_responders(
+                pcds_responders, self.spool_memory, self.spill_dir, release, budget
+            )
+        # Give the lookup's connection back while the archive is streamed; the
+        # metadata query takes one again only for as long as it runs
+        sesh.close()
         responders = chain(
-            get_all_metadata_index_responders(self.session, stns, climo),
-            get_pcds_responders(self.dsn, stns, ext, get_clip_dates(environ), environ),
+            manifest,
+            close_when_done(
+                sesh,
+                get_all_metadata_index_responders(
+                    sesh, selected_stns, climo, self.metadata_cache
+                ),
+            ),
+            get_pruned_responders(pruned),
+            pcds_responders,
+            get_error_responders(failures),
         )
 
-        return ziperator(responders)
-
-
-def ziperator(responders):
-    """This method creates and returns an iterator which yields bytes for a :py:class:`ZipFile` that contains a set of files from OPeNDAP requests. The method will spool the first one gigabyte in memory using a :py:class:`SpooledTemporaryFile`, after which it will use disk.
+        date_time = DETERMINISTIC_DATE_TIME if self.deterministic else None
+        if self.streaming or self.executor:
+            archive = streaming_ziperator(
+                responders,
+                self.block_size,
+                compression,
+                compresslevel,
+                self.executor,
+                2 * self.compress_workers,
+                budget,
+                instrument,
+                date_time,
+            )
+        else:
+            archive = ziperator(
+                responders, compression, compresslevel, budget, instrument, date_time
+            )
+        archive = cancel_when_abandoned(archive, pcds_responders, sessions)
+        if budget:
+            archive = log_budget(archive, budget)
+
+        if self.cache:
+            # An archive with failed stations is not kept, so that the next
+            # request gets another chance at them
+            archive = self.cache.store(key, archive, lambda: not failures)
+        if instrument:
+            archive = instrument.measure(archive)
+        return archive
+
+
+def close_when_done(sesh, responders):
+    """Pass through (``name``, ``generator``) pairs from ``responders``, closing the database session ``sesh`` once they are exhausted or abandoned. If they are abandoned (or fail), the query which the session may still be running is cancelled first (see :func:`pdp_util.extract.cancel_query`)."""
+    finished = False
+    try:
+        yield from responders
+        finished = True
+    finally:
+        if not finished:
+            cancel_query(sesh)
+        sesh.close()
+
+
+def cancel_when_abandoned(archive, responders, sessions=()):
+    """Pass through the blocks of ``archive``. If the client goes away before the end (i.e. the response is closed early), close the archive, which closes the member being written, and then ``responders``, which stops any prefetching and cancels the database work still in flight, and log the abort.
+
+    The ``sessions`` are closed in the end, whether or not the archive was finished, with their queries cancelled if it was not. Closing a generator which has not started does not run its ``finally`` clause, so the sessions of responders which were never reached, e.g. because the client went away during the first members, are only closed here.
+
+    :param archive: iterator of the archive's blocks, from :func:`ziperator` or :func:`streaming_ziperator`
+    :param responders: the (``name``, ``generator``) pairs from which the archive is built
+    :param sessions: database sessions used by the archive
+    :rtype: iterator of bytes
+    """
+    sent = 0
+    finished = False
+    try:
+        for block in archive:
+            sent += len(block)
+            yield block
+        finished = True
+    finally:
+        if not finished:
+            logger.info(f"Download abandoned after {sent} bytes, cancelling it")
+        close_iterator(archive)
+        close_iterator(responders)
+        close_sessions(sessions, cancel=not finished)
+
+
+def close_sessions(sessions, cancel=False):
+    """Close the database sessions ``sessions``, first cancelling the queries they may be running if ``cancel`` is True (see :func:`pdp_util.extract.cancel_query`)"""
+    for sesh in sessions:
+        if cancel:
+            cancel_query(sesh)
+        sesh.close()
+
+
+def ziperator(
+    responders,
+    compression=ZIP_DEFLATED,
+    compresslevel=None,
+    budget=None,
+    instrument=None,
+    date_time=None,
+):
+    """This method creates and returns an iterator which yields bytes for a :py:class:`ZipFile` that contains a set of files from OPeNDAP requests. The method will spool the first one gigabyte in memory using a :py:class:`SpooledTemporaryFile`, after which it will use disk. Each member is compressed as its content arrives rather than being joined in memory first.
 
     :param responders: A list of (``name``, ``generator``) pairs where ``name`` is the filename to use in the zip archive and ``generator`` should yield all bytes for a single file.
+    :param compression: :py:data:`zipfile.ZIP_DEFLATED` or :py:data:`zipfile.ZIP_STORED`
+    :param compresslevel: zlib compression level (0-9) or None for the default
+    :param budget: optional memory budget of the download. The in-memory part of the spool is limited to half of what is available in it, and reserved for the lifetime of the archive. If nothing is available, the spool is on disk from the start.
+    :type budget: :class:`pdp_util.budget.MemoryBudget`
+    :param instrument: optional instrumentation to which the compression time and sizes of each member are reported
+    :type instrument: :class:`pdp_util.instrument.Instrumentation`
+    :param date_time: optional (year, month, day, hour, minute, second) timestamp for all of the members. By default each member is stamped with the time at which it is written.
     :rtype: iterator
     """
-    with SpooledTemporaryFile(1024**3) as f:
-        yield b"PK"  # Response headers aren't sent until the first chunk of data is sent.  Let's get this repsonse moving!
-        z = ZipFile(f, "w", ZIP_DEFLATED)
-
-        for name, responder in responders:
-            pos = 2 if f.tell() == 0 else f.tell()
-            z.writestr(name, "".join([x for x in responder]))
+    spool_size = SPOOL_SIZE
+    if budget:
+        spool_size = min(spool_size, budget.available // 2)
+        budget.reserve(spool_size)
+    responder = None
+    try:
+        with spool_file(spool_size) as f, ZipFile(
+            f, "w", compression, compresslevel=compresslevel
+        ) as z:
+            yield b"PK"  # Response headers aren't sent until the first chunk of data is sent.  Let's get this repsonse moving!
+
+            for name, responder in responders:
+                pos = 2 if f.tell() == 0 else f.tell()
+                compress_time = 0.0
+                with z.open(
+                    member_info(name, z, date_time), "w", force_zip64=True
+                ) as member:
+                    for chunk in responder:
+                        t0 = time.perf_counter()
+                        member.write(
+                            chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+                        )
+                        compress_time += time.perf_counter() - t0
+                if instrument:
+                    info = z.infolist()[-1]
+                    report_member(
+                        instrument,
+                        name,
+                        compress_time,
+                        info.file_size,
+                        info.compress_size,
+                    )
+                f.seek(pos)
+                yield from read_blocks(f)
+            pos = f.tell()
+            z.close()
             f.seek(pos)
-            yield f.read()
-        pos = f.tell()
-        z.close()
-        f.seek(pos)
-        yield f.read()
-
+            yield from read_blocks(f)
+    finally:
+        close_iterator(responder)
+        close_iterator(responders)
+        if budget:
+            budget.release(spool_size)
+
+
+def member_info(name, z, date_time=None):
+    """The member ``name`` to open in :py:class:`ZipFile` ``z``: the name itself, or a :py:class:`ZipInfo` if it is to have the timestamp ``date_time``"""
+    if date_time is None:
+        return name
+    info = ZipInfo(name, date_time)
+    # As ZipFile.open does for a plain name
+    info.compress_type = z.compression
+    info._compresslevel = z.compresslevel
+    return info
+
+
+def read_blocks(f, block_size=DEFAULT_BLOCK_SIZE):
+    """Yield the rest of the file ``f`` in blocks of at most ``block_size`` bytes"""
+    while True:
+        block = f.read(block_size)
+        if not block:
+            return
+        yield block
+
+
+def report_member(instrument, name, compress_time, raw_bytes, compressed_bytes):
+    stats = instrument.member(name)
+    stats.compress_time += compress_time
+    stats.raw_bytes += raw_bytes
+    stats.compressed_bytes += compressed_bytes
+    instrument.member_done(name)
+
+
+def log_budget(archive, budget):
+    """Pass through the blocks of ``archive``, logging the accounting of ``budget`` once it is finished or abandoned"""
+    try:
+        yield from archive
+    finally:
+        logger.info(f"Download memory budget: {budget.summary()}")
+
+
+def streaming_ziperator(
+    responders,
+    block_size=DEFAULT_BLOCK_SIZE,
+    compression=ZIP_DEFLATED,
+    compresslevel=None,
+    executor=None,
+    max_pending=8,
+    budget=None,
+    instrument=None,
+    date_time=None,
+):
+    """This method creates and returns an iterator which yields bytes for a ZIP archive that contains a set of files from OPeNDAP requests. Unlike :func:`ziperator`, each responder's output is deflated chunk by chunk as it arrives and the archive is yielded in blocks of ``block_size`` bytes (see :class:`pdp_util.zipstream.ZipStream`), so memory use is bounded regardless of the size of the members.
 
-def get_all_metadata_index_responders(sesh, stations, climo=False):
+    :param responders: A list of (``name``, ``generator``) pairs where ``name`` is the filename to use in the zip archive and ``generator`` should yield all bytes for a single file.
+    :param block_size: size in bytes of the blocks to yield
+    :type block_size: int
+    :param compression: :py:data:`zipfile.ZIP_DEFLATED` or :py:data:`zipfile.ZIP_STORED`
+    :param compresslevel: zlib compression level (0-9) or None for the default
+    :param executor: optional :py:class:`concurrent.futures.Executor` with which to compress members in parallel
+    :param max_pending: maximum number of pieces in flight in the executor
+    :type max_pending: int
+    :param budget: optional memory budget of the download, which bounds the pieces in flight in the executor
+    :type budget: :class:`pdp_util.budget.MemoryBudget`
+    :param instrument: optional instrumentation to which the compression time and sizes of each member are reported
+    :type instrument: :class:`pdp_util.instrument.Instrumentation`
+    :param date_time: optional (year, month, day, hour, minute, second) timestamp for all of the members, rather than the time at which the archive is created
+    :rtype: iterator
+    """
+    archive = ZipStream(
+        block_size,
+        compression,
+        compresslevel,
+        date_time=date_time,
+        executor=executor,
+        max_pending=max(max_pending, 1),
+        budget=budget,
+    )
+    responder = None
+    try:
+        for name, responder in responders:
+            yield from archive.write(name, responder)
+            if instrument:
+                member = archive.members[-1]
+                report_member(
+                    instrument,
+                    name,
+                    member.compress_time,
+                    member.file_size,
+                    member.compress_size,
+                )
+        yield from archive.close()
+    finally:
+        close_iterator(responder)
+        close_iterator(responders)
+
+
+# The variable metadata files have always been pydap ASCII responses; keep
+# their exact layout now that they are written directly.
+METADATA_HEADER = (
+    "Dataset {\n"
+    "    Sequence {\n"
+    "        String variable;\n"
+    "        String standard_name;\n"
+    "        String cell_method;\n"
+    "        String unit;\n"
+    "    } variables;\n"
+    "} Variable%20metadata;\n"
+    + 45 * "-"
+    + "\n"
+    + "variables.variable, variables.standard_name, variables.cell_method, variables.unit\n"
+)
+
+
+def get_all_metadata_index_responders(sesh, stations, climo=False, cache=None):
     """This function is a generator which yields (``name``, ``generator``) pairs where ``name`` is the filename (e.g. [``network_name``].csv) and ``generator`` streams a csv file with information on the network's variables
 
+    The variables of all networks are fetched with a single query (see :func:`get_network_variables`).
+
     :param stations: A list of (``network_name``, ``native_id``) pairs representing the stations for which this response should include variable metadata
     :param climo: Should these be climatological variables?
     :type climo: bool
+    :param cache: optional cache of variable rows per (``network_name``, ``climo``)
+    :type cache: :class:`pdp_util.cache.MemoryCache`
     :rtype: iterator
     """
-    networks = {network_name for network_name, native_id in stations}
+    networks = sorted({network_name for network_name, native_id in stations})
+    if not networks:
+        return
+    variables = get_network_variables(sesh, networks, climo, cache)
     for network_name in networks:
         filename = f"{network_name}/variables.csv"
-        yield (filename, metadata_index_responder(sesh, network_name, climo))
+        yield (filename, iter([metadata_csv(variables[network_name])]))
 
 
-def metadata_index_responder(sesh, network, climo=False):
-    """The function creates a pydap csv response which lists variable metadata out of the database. It returns an generator for the contents of the file
+def get_network_variables(sesh, networks, climo=False, cache=None):
+    """Look up the variable metadata of several networks with a single query
 
     :param sesh: database session
     :type sesh: sqlalchemy.orm.session.Session
-    :param network: Name of the network for which variables should be listed
-    :type network: str
-    :rtype: generator
+    :param networks: names of the networks
+    :param climo: Should these be climatological variables?
+    :type climo: bool
+    :param cache: optional cache of variable rows per (``network_name``, ``climo``). Only networks which are not cached are queried.
+    :type cache: :class:`pdp_util.cache.MemoryCache`
+    :rtype: dict mapping each network name to a list of (``variable``, ``standard_name``, ``cell_method``, ``unit``) tuples
     """
-    maxlen = 256
-    rv = (
-        sesh.query(Variable)
-        .join(Network)
-        .filter(Network.name == network)
+    variables = {}
+    if cache is not None:
+        for network in networks:
+            rows = cache.get((network, climo))
+            if rows is not None:
+                variables[network] = rows
+    missing = [network for network in networks if network not in variables]
+    if not missing:
+        return variables
+
+    q = (
+        sesh.query(
+            Network.name,
+            Variable.name,
+            Variable.standard_name,
+            Variable.cell_method,
+            Variable.unit,
+        )
+        .select_from(Variable)
+        .join(Network, Network.id == Variable.network_id)
+        .filter(Network.name.in_(missing))
         .filter(
             variable_tags(Variable).contains(
                 array(["climatology" if climo else "observation"])
             )
         )
+        .order_by(Network.name, Variable.id)
     )
-    a = np.array(
-        [(var.name, var.standard_name, var.cell_method, var.unit) for var in rv],
-        dtype=np.dtype(
-            {
-                "names": ["variable", "standard_name", "cell_method", "unit"],
-                "formats": [(str, maxlen), (str, maxlen), (str, maxlen), (str, maxlen)],
-            }
-        ),
-    )
-    dst = DatasetType("Variable metadata")
-    seq = SequenceType("variables")
-    seq["variable"] = BaseType("variable")
-    seq["standard_name"] = BaseType("standard_name", reference="http://llnl.gov/")
-    seq["cell_method"] = BaseType("cell_method", reference="http://llnl.gov/")
-    seq["unit"] = BaseType("unit")
-    seq.data = a
-    dst["variables"] = seq
-    responder = BaseHandler(dst)
+    for network in missing:
+        variables[network] = []
+    for network, *row in q:
+        variables[network].append(tuple(row))
+    if cache is not None:
+        for network in missing:
+            cache.set((network, climo), variables[network])
+    return variables
 
-    environ = {"PATH_INFO": "/variables.foo.ascii", "REQUEST_METHOD": "GET"}
-    return responder(environ, null_start_response).__iter__()
+
+def metadata_csv(rows):
+    """Render variable metadata rows as the contents of a variables.csv file
+
+    :param rows: list of (``variable``, ``standard_name``, ``cell_method``, ``unit``) tuples
+    :rtype: bytes
+    """
+    lines = [METADATA_HEADER]
+    lines.extend(", ".join(f'"{value}"' for value in row) + "\n" for row in rows)
+    lines.append("\n")
+    return "".join(lines).encode("utf-8")
 
 
-def get_pcds_responders(dsn, stns, extension, clip_dates, environ):
+def metadata_index_responder(sesh, network, climo=False):
+    """The function creates a csv response which lists variable metadata out of the database. It returns an generator for the contents of the file
+
+    :param sesh: database session
+    :type sesh: sqlalchemy.orm.session.Session
+    :param network: Name of the network for which variables should be listed
+    :type network: str
+    :rtype: generator
+    """
+    variables = get_network_variables(sesh, [network], climo)
+    return iter([metadata_csv(variables[network])])
+
+
+PRUNED_FILENAME = "stations_without_data.csv"
+
+
+def get_pruned_responders(pruned):
+    """Generator of a (``name``, ``generator``) pair for a CSV file listing the stations which were left out of the download for having no observations between the requested dates, if there are any
+
+    :param pruned: A list of (``network_name``, ``native_id``) pairs
+    :rtype: iterator
+    """
+    if not pruned:
+        return
+    lines = ["network_name,native_id\n"]
+    lines.extend(f"{net},{native_id}\n" for net, native_id in pruned)
+    yield PRUNED_FILENAME, iter(["".join(lines).encode("utf-8")])
+
+
+def get_pcds_responders(
+    dsn,
+    stns,
+    extension,
+    clip_dates,
+    environ,
+    instrument=None,
+    windows=None,
+    failures=None,
+    retries=0,
+    retry_backoff=DEFAULT_RETRY_BACKOFF,
+):
     """Iterator object which coalesces a list of stations, compresses them, and returns the data for the response
 
     :param dsn:
@@ -160,6 +888,16 @@ def get_pcds_responders(dsn, stns, extension, clip_dates, environ):
     :param clip_dates: pair datetime.datetime objects representing the start and end times for which data should be returned (inclusive)
     :param environ: WSGI environment variables which optionally set the ``download-climatology`` field
     :type environ: dict
+    :param instrument: optional instrumentation which times the query and encoding of each station (and counts its rows, for text formats)
+    :type instrument: :class:`pdp_util.instrument.Instrumentation`
+    :param windows: optional dict mapping (``network_name``, ``native_id``) to a list of (``start``, ``end``) time windows (see :func:`pdp_util.windows.get_station_windows`). A station with windows is exported as one member per window, named as by :func:`pdp_util.windows.window_name`; other stations are exported whole.
+    :type windows: dict
+    :param failures: if given, the failure of a station's query no longer aborts the iteration: the station is retried up to ``retries`` times, waiting ``retry_backoff`` seconds (doubled after each retry) in between, and then given up on and recorded in this list (see :func:`pdp_util.failures.retrying`)
+    :type failures: list
+    :param retries: number of times to retry a failed station
+    :type retries: int
+    :param retry_backoff: number of seconds to wait before the first retry
+    :type retry_backoff: float
     :rtype: iterator
     """
     req = Request(environ)
@@ -171,27 +909,114 @@ def get_pcds_responders(dsn, stns, extension, clip_dates, environ):
         else (RawPcicSqlHandler(dsn), "rsql")
     )
 
-    sdate, edate = clip_dates
-    content_length = 0
-    for net, stn in stns:
+    for net, stn, name, qs in station_requests(stns, extension, clip_dates, windows):
         newenv = environ.copy()
         newenv["PATH_INFO"] = f"/{net}/{stn}.{handler_ext}.{extension}"
+        newenv["QUERY_STRING"] = "&".join(qs)
+
+        if failures is not None:
+            response = retrying(
+                name,
+                partial(handler, newenv, null_start_response),
+                failures,
+                retries,
+                retry_backoff,
+            )
+            yield (
+                name,
+                (
+                    instrument.timed(name, response, extension in TEXT_EXTENSIONS)
+                    if instrument
+                    else response
+                ),
+            )
+        elif instrument:
+            t0 = time.perf_counter()
+            response = handler(newenv, null_start_response)
+            instrument.member(name).query_time += time.perf_counter() - t0
+            yield (
+                name,
+                instrument.timed(name, response, extension in TEXT_EXTENSIONS),
+            )
+        else:
+            yield (name, handler(newenv, null_start_response))
+
+
+def station_requests(stns, extension, clip_dates, windows=None):
+    """Generator of (``network_name``, ``native_id``, ``name``, ``constraints``) tuples giving the archive member name and the ``station_observations.time`` constraints of each member to export"""
+    sdate, edate = clip_dates
+    for net, stn in stns:
+        if windows and windows.get((net, stn)):
+            stn_windows = windows[(net, stn)]
+            for i, window in enumerate(stn_windows):
+                ends = (clip_dates, i == 0, i == len(stn_windows) - 1)
+                qs = window_constraints(window, *ends)
+                if qs is not None:
+                    name = window_name(net, stn, window, extension, *ends)
+                    yield net, stn, name, qs
+            continue
 
         qs = []
         if sdate:
             qs.append(f"station_observations.time>='{sdate}'")
         if edate:
             qs.append(f"station_observations.time<='{edate}'")
-        newenv["QUERY_STRING"] = "&".join(qs)
-
-        name = f"{net}/{stn}.{extension}"
-        yield (name, handler(newenv, null_start_response))
+        yield net, stn, f"{net}/{stn}.{extension}", qs
 
 
 def agg_generator(global_conf, **kwargs):
     """Factory function for the :class:`PcdsZipApp`
 
-    :param global_conf: dict containing the key conn_params which is passed on to :class:`PcdsZipApp`. Everything else is ignored.
+    :param global_conf: dict containing the key dsn which is passed on to :class:`PcdsZipApp`, along with the optional keys streaming, block_size, prefetch, prefetch_bytes, compression (``deflated`` or ``stored``), compresslevel, compress_workers, compress_processes, cache_dir, cache_max_bytes and cache_ttl to enable the archive cache, bulk and bulk_batch_size, metadata_cache_ttl to cache variable metadata, coalesce and coalesce_memory, memory_budget and spill_dir, instrument, window (``year`` or a number of rows), retries and retry_backoff, prune, copy, spool and spool_memory, and deterministic. Everything else is ignored.
     :param kwargs: ignored
     """
-    return PcdsZipApp(dsn=global_conf["dsn"])
+    return PcdsZipApp(
+        dsn=global_conf["dsn"],
+        streaming=asbool(global_conf.get("streaming", False)),
+        block_size=int(global_conf.get("block_size", DEFAULT_BLOCK_SIZE)),
+        prefetch=int(global_conf.get("prefetch", 0)),
+        prefetch_bytes=int(global_conf.get("prefetch_bytes", DEFAULT_PREFETCH_BYTES)),
+        compression=compression_methods[global_conf.get("compression", "deflated")],
+        compresslevel=(
+            int(global_conf["compresslevel"])
+            if "compresslevel" in global_conf
+            else None
+        ),
+        compress_workers=int(global_conf.get("compress_workers", 0)),
+        compress_processes=asbool(global_conf.get("compress_processes", False)),
+        cache=(
+            ArchiveCache(
+                global_conf["cache_dir"],
+                int(global_conf.get("cache_max_bytes", DEFAULT_CACHE_BYTES)),
+                int(global_conf.get("cache_ttl", DEFAULT_CACHE_TTL)),
+            )
+            if global_conf.get("cache_dir")
+            else None
+        ),
+        bulk=asbool(global_conf.get("bulk", False)),
+        bulk_batch_size=int(global_conf.get("bulk_batch_size", DEFAULT_BATCH_SIZE)),
+        metadata_cache=(
+            MemoryCache(DEFAULT_CACHE_ENTRIES, int(global_conf["metadata_cache_ttl"]))
+            if global_conf.get("metadata_cache_ttl")
+            else None
+        ),
+        coalesce=asbool(global_conf.get("coalesce", False)),
+        coalesce_memory=int(
+            global_conf.get("coalesce_memory", DEFAULT_COALESCE_MEMORY)
+        ),
+        memory_budget=(
+            int(global_conf["memory_budget"])
+            if global_conf.get("memory_budget")
+            else None
+        ),
+        spill_dir=global_conf.get("spill_dir"),
+        instrument=asbool(global_conf.get("instrument", False)),
+        window=parse_window(global_conf.get("window")),
+        retries=(int(global_conf["retries"]) if "retries" in global_conf else None),
+        retry_backoff=float(global_conf.get("retry_backoff", DEFAULT_RETRY_BACKOFF)),
+        prune=asbool(global_conf.get("prune", False)),
+        copy=asbool(global_conf.get("copy", False)),
+        spool=asbool(global_conf.get("spool", False)),
+        spool_memory=int(global_conf.get("spool_memory", DEFAULT_SPOOL_MEMORY)),
+        deterministic=asbool(global_conf.get("deterministic", False)),
+    )
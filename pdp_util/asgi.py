@@ -0,0 +1,191 @@
+"""
+This module provides an ASGI variant of the PCDS download application. Each download holds a thread only while its next block is being produced (i.e. while it queries the database or encodes and compresses data) and never while it waits for the client, so a single process can serve many concurrent downloads with a small, fixed pool of threads.
+"""
+
+import sys
+import asyncio
+import logging
+from io import BytesIO
+from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
+
+from pdp_util.agg import agg_generator
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ASGI_WORKERS = 16
+MAX_BODY_SIZE = 1024**2
+
+
+def asgi_environ(scope, body):
+    """Build a WSGI environ for an ASGI HTTP ``scope`` and its request body, so that the request can be handled by the WSGI machinery (filter validation, station resolution and archive generation)
+
+    :param scope: ASGI HTTP connection scope
+    :type scope: dict
+    :param body: complete request body
+    :type body: bytes
+    :rtype: dict
+    """
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": unquote(scope["path"]).encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class AsyncPcdsZipApp(object):
+    """ASGI application which serves PCDS downloads with a :class:`pdp_util.agg.PcdsZipApp`
+
+    The request is validated and its stations resolved by the wrapped application, in the thread pool, so that no database query blocks the event loop. The archive is then pulled one block at a time: each block is produced in the pool and the next one is not started until the previous one has been handed to the server, which gives backpressure from slow clients without holding a thread. A download whose client disconnects is abandoned and its archive generator closed.
+
+    The wrapped application should not use prefetching (``prefetch``), as that starts threads per download.
+
+    :param app: the WSGI download application
+    :type app: :class:`pdp_util.agg.PcdsZipApp`
+    :param workers: number of threads shared by all downloads
+    :type workers: int
+    """
+
+    def __init__(self, app, workers=DEFAULT_ASGI_WORKERS):
+        self.app = app
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="pcds-asgi"
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+
+        body = await self.read_body(receive)
+        if body is None:
+            return
+        if len(body) > MAX_BODY_SIZE:
+            await send_response(send, "413 Request Entity Too Large")
+            return
+        environ = asgi_environ(scope, body)
+        loop = asyncio.get_running_loop()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = headers
+
+        blocks = await loop.run_in_executor(
+            self.executor, self.app, environ, start_response
+        )
+        iterator = iter(blocks)
+        try:
+            # Response headers are only set once the first block is requested
+            # by some WSGI applications, so get it before starting the response
+            block = await loop.run_in_executor(self.executor, next, iterator, None)
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": int(response["status"].split()[0]),
+                    "headers": [
+                        (name.lower().encode("latin-1"), value.encode("latin-1"))
+                        for name, value in response["headers"]
+                    ],
+                }
+            )
+            disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+            try:
+                while block is not None and not disconnected.done():
+                    if block:
+                        await send(
+                            {
+                                "type": "http.response.body",
+                                "body": block,
+                                "more_body": True,
+                            }
+                        )
+                    block = await loop.run_in_executor(
+                        self.executor, next, iterator, None
+                    )
+                if disconnected.done():
+                    logger.info("Client disconnected, abandoning download")
+                    return
+                await send({"type": "http.response.body", "body": b""})
+            finally:
+                disconnected.cancel()
+        finally:
+            if hasattr(blocks, "close"):
+                await loop.run_in_executor(self.executor, blocks.close)
+
+    async def read_body(self, receive):
+        """Read the request body, stopping early once it is larger than :data:`MAX_BODY_SIZE`. Returns None if the client disconnects."""
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            body += message.get("body", b"")
+            if len(body) > MAX_BODY_SIZE or not message.get("more_body", False):
+                return bytes(body)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def send_response(send, status, body=b""):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": int(status.split()[0]),
+            "headers": [(b"content-type", b"text/plain")],
+        }
+    )
+    await send({"type": "http.response.body", "body": body or status.encode()})
+
+
+def asgi_generator(global_conf, **kwargs):
+    """Factory function for the :class:`AsyncPcdsZipApp`
+
+    :param global_conf: dict of the configuration accepted by :func:`pdp_util.agg.agg_generator`, plus the optional key asgi_workers
+    :param kwargs: ignored
+    """
+    return AsyncPcdsZipApp(
+        agg_generator(global_conf),
+        workers=int(global_conf.get("asgi_workers", DEFAULT_ASGI_WORKERS)),
+    )
@@ -0,0 +1,74 @@
+"""
+This module provides per-download memory accounting for the aggregation pipeline in :mod:`pdp_util.agg`
+"""
+
+from threading import Lock
+
+
+class MemoryBudget(object):
+    """Accounting of the memory held by the buffers of a single download
+
+    Components of the pipeline (prefetch queues, parallel compression, archive spooling) reserve bytes before buffering them and release them afterwards. A component which cannot obtain a reservation with :meth:`try_reserve` is expected to degrade, by spilling to disk or by doing less work concurrently, rather than to fail. Reservations which a component cannot do without (e.g. the chunk that the client is waiting for) are made with :meth:`reserve`, which always succeeds; any resulting overrun is recorded.
+
+    :param limit: budget in bytes
+    :type limit: int
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.overrun = 0
+        self.spilled = 0
+        self.throttled = 0
+        self._lock = Lock()
+
+    @property
+    def available(self):
+        return max(self.limit - self.used, 0)
+
+    def try_reserve(self, nbytes):
+        """Reserve ``nbytes`` if that fits in the budget
+
+        :rtype: bool
+        """
+        with self._lock:
+            if self.used + nbytes > self.limit:
+                return False
+            self._add(nbytes)
+            return True
+
+    def reserve(self, nbytes):
+        """Reserve ``nbytes`` unconditionally"""
+        with self._lock:
+            self._add(nbytes)
+            self.overrun = max(self.overrun, self.used - self.limit)
+
+    def release(self, nbytes):
+        with self._lock:
+            self.used -= nbytes
+
+    def record_spill(self, nbytes):
+        """Record that ``nbytes`` were written to disk for want of memory"""
+        with self._lock:
+            self.spilled += nbytes
+
+    def record_throttle(self):
+        """Record that a component reduced its concurrency for want of memory"""
+        with self._lock:
+            self.throttled += 1
+
+    def summary(self):
+        """A dict of the accounting figures, suitable for logging"""
+        return {
+            "limit": self.limit,
+            "used": self.used,
+            "peak": self.peak,
+            "overrun": self.overrun,
+            "spilled": self.spilled,
+            "throttled": self.throttled,
+        }
+
+    def _add(self, nbytes):
+        self.used += nbytes
+        self.peak = max(self.peak, self.used)
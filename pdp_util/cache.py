@@ -0,0 +1,248 @@
+"""
+This module provides caches for the PCDS download path: a content-addressed, size-bounded disk cache for finished download archives, and a small in-memory cache for query results
+"""
+
+import os
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from threading import Lock
+from tempfile import NamedTemporaryFile
+
+from pdp_util.util import close_iterator
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_BYTES = 10 * 1024**3
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+DEFAULT_CACHE_ENTRIES = 1024
+
+
+def cache_key(*parts):
+    """Hash an arbitrary sequence of values with stable ``repr()`` into a hex digest suitable as a cache key
+
+    Example::
+
+     key = cache_key(canonical_filters(filters), clip_dates, "nc", False)
+    """
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+
+class ArchiveCache(object):
+    """A directory of finished archives, each stored under the key of the request that produced it
+
+    Entries are written to a temporary file while the archive streams to the client and only become visible, by an atomic rename, once the archive is complete; an aborted download therefore never leaves a partial entry behind. The SHA-256 digest of each entry is part of its file name, ``<key>.<digest>.zip``, so that the entity tag of an open entry always matches its contents, even if the entry is rebuilt meanwhile (see :meth:`etag`). Entries expire ``ttl`` seconds after they were written. Whenever an entry is added, the least recently used entries are evicted until the cache holds no more than ``max_bytes``. Recency is recorded in each file's access time, which the cache sets explicitly so that it does not depend on how the filesystem is mounted.
+
+    :param directory: directory in which to keep the cache. It is created if need be.
+    :type directory: str
+    :param max_bytes: cap on the total size of the cached archives
+    :type max_bytes: int
+    :param ttl: lifetime of an entry in seconds, or None for no expiry
+    :type ttl: int
+    """
+
+    suffix = ".zip"
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_BYTES, ttl=DEFAULT_CACHE_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        """The path of the newest entry with key ``key``, or None if there is none"""
+        paths = self._paths(key)
+        return paths[-1] if paths else None
+
+    def open(self, key):
+        """Return a binary file object for the cached archive with key ``key``, or None if there is no fresh entry"""
+        path = self.path(key)
+        if path is None:
+            return None
+        try:
+            st = os.stat(path)
+            if self._expired(st):
+                self._remove(path)
+                return None
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        os.utime(path, (time.time(), st.st_mtime))
+        logger.debug(f"Archive cache hit for {key}")
+        return f
+
+    def __contains__(self, key):
+        """Whether there is a fresh entry with key ``key``, without opening it"""
+        path = self.path(key)
+        if path is None:
+            return False
+        try:
+            return not self._expired(os.stat(path))
+        except FileNotFoundError:
+            return False
+
+    def etag(self, f):
+        """The entity tag of a cached archive opened with :meth:`open`: the digest of its contents, which only changes when they do
+
+        :param f: file object returned by :meth:`open`
+        :rtype: str
+        """
+        return os.path.basename(f.name)[: -len(self.suffix)].rpartition(".")[2]
+
+    def store(self, key, chunks, commit=None):
+        """Pass ``chunks`` through unchanged while copying them into the cache under ``key``
+
+        The entry is committed only if ``chunks`` is exhausted without error, and ``commit`` (if given) then returns True.
+
+        :param key: cache key
+        :type key: str
+        :param chunks: iterable of bytes making up the archive
+        :param commit: optional callable deciding whether the finished archive is fit to be cached, e.g. that no member of it failed
+        :rtype: iterator of bytes
+        """
+        directory = os.path.join(self.directory, key[:2])
+        os.makedirs(directory, exist_ok=True)
+        f = NamedTemporaryFile(dir=directory, suffix=".tmp", delete=False)
+        digest = hashlib.sha256()
+        committed = False
+        try:
+            for chunk in chunks:
+                f.write(chunk)
+                digest.update(chunk)
+                yield chunk
+            f.close()
+            if commit is not None and not commit():
+                logger.debug(f"Not storing incomplete archive {key} in the cache")
+                return
+            path = os.path.join(directory, f"{key}.{digest.hexdigest()}{self.suffix}")
+            os.replace(f.name, path)
+            committed = True
+            # Readers of a previous build keep their open file, and its tag
+            for old in self._paths(key):
+                if old != path:
+                    self._remove(old)
+            logger.debug(f"Stored archive {key} in the cache")
+        finally:
+            close_iterator(chunks)
+            if not committed:
+                f.close()
+                self._remove(f.name)
+        self.evict()
+
+    def invalidate(self, key=None):
+        """Remove the entry with key ``key`` or, if no key is given, every entry"""
+        if key is not None:
+            for path in self._paths(key):
+                self._remove(path)
+            return
+        for path, st in self._entries():
+            self._remove(path)
+
+    def evict(self):
+        """Remove expired entries, then the least recently used ones until the cache is within ``max_bytes``"""
+        with self._lock:
+            entries = []
+            for path, st in self._entries():
+                if self._expired(st):
+                    self._remove(path)
+                else:
+                    entries.append((st.st_atime, st.st_size, path))
+            total = sum(size for atime, size, path in entries)
+            for atime, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                logger.debug(f"Evicting {path} from the archive cache")
+                self._remove(path)
+                total -= size
+
+    def size(self):
+        """Total size in bytes of the cached archives"""
+        return sum(st.st_size for path, st in self._entries())
+
+    def _entries(self):
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(self.suffix):
+                    path = os.path.join(root, name)
+                    try:
+                        yield path, os.stat(path)
+                    except FileNotFoundError:
+                        continue
+
+    def _paths(self, key):
+        """The paths of the entries with key ``key``, oldest first"""
+        directory = os.path.join(self.directory, key[:2])
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        entries = []
+        for name in names:
+            if name.startswith(key + ".") and name.endswith(self.suffix):
+                path = os.path.join(directory, name)
+                try:
+                    entries.append((os.stat(path).st_mtime, path))
+                except FileNotFoundError:
+                    continue
+        return [path for mtime, path in sorted(entries)]
+
+    def _expired(self, st):
+        return self.ttl is not None and time.time() - st.st_mtime > self.ttl
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class MemoryCache(object):
+    """A thread-safe, in-memory mapping of keys to query results, bounded in number of entries (evicting the least recently used) and with a time to live
+
+    :param max_entries: maximum number of entries to keep
+    :type max_entries: int
+    :param ttl: lifetime of an entry in seconds, or None for no expiry
+    :type ttl: int
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES, ttl=DEFAULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                return default
+            if expires is not None and time.monotonic() > expires:
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Remove the entry with key ``key`` or, if no key is given, every entry"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._entries)
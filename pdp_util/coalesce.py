@@ -0,0 +1,230 @@
+"""
+This module provides the coalescing of identical concurrent downloads: requests with the same download key attach to a single archive build, whose bytes are fanned out to every one of them, so that the database work does not grow with the number of people downloading the same thing at once
+"""
+
+import logging
+from collections import deque
+from tempfile import TemporaryFile
+from threading import Thread, Lock, Condition
+
+from pdp_util.util import close_iterator
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COALESCE_MEMORY = 16 * 1024**2
+READ_SIZE = 64 * 1024
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class SharedArchive(object):
+    """A single archive build, read by any number of subscribers
+
+    A producer thread pulls the archive from ``archive_factory()``. The most recent ``max_memory`` bytes are kept in memory; older bytes are spilled to a file in ``spill_dir``, from which subscribers which have fallen behind (or joined late) catch up, so that every subscriber reads the whole archive from its start at its own pace. If all of the subscribers go away before the archive is finished, the build is abandoned and the archive closed (see :func:`pdp_util.agg.cancel_when_abandoned`).
+
+    :param archive_factory: callable returning an iterator of the archive's blocks
+    :param max_memory: number of bytes of the archive to keep in memory
+    :type max_memory: int
+    :param spill_dir: directory for the spill file, or None for the system's default temporary directory
+    :type spill_dir: str
+    :param on_done: optional callable, called once the build is finished, failed or abandoned
+    """
+
+    def __init__(
+        self,
+        archive_factory,
+        max_memory=DEFAULT_COALESCE_MEMORY,
+        spill_dir=None,
+        on_done=None,
+    ):
+        self.archive_factory = archive_factory
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self.on_done = on_done
+        self.blocks = deque()
+        self.memory_start = 0
+        self.memory_bytes = 0
+        self.size = 0
+        self.subscribers = 0
+        self.done = False
+        self.cancelled = False
+        self.error = None
+        self.spill = None
+        self._cond = Condition()
+        self._thread = None
+
+    def start(self):
+        """Start the producer thread"""
+        self._thread = Thread(target=self._produce, name="coalesce", daemon=True)
+        self._thread.start()
+
+    def subscribe(self):
+        """A new reader of the archive, or None if the build has been abandoned
+
+        :rtype: :class:`Subscription`
+        """
+        with self._cond:
+            if self.cancelled:
+                return None
+            self.subscribers += 1
+        return Subscription(self)
+
+    def unsubscribe(self):
+        with self._cond:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                logger.info("Every subscriber left, abandoning the shared download")
+                self.cancelled = True
+            self._cleanup()
+
+    def read(self, offset):
+        """The archive bytes from ``offset``, waiting for them if need be. Returns an empty bytes at the end of the archive."""
+        with self._cond:
+            while offset >= self.size and not self.done:
+                self._cond.wait()
+            if offset >= self.size:
+                if self.error is not None:
+                    raise self.error
+                return b""
+            if offset < self.memory_start:
+                self.spill.seek(offset)
+                return self.spill.read(min(READ_SIZE, self.memory_start - offset))
+            position = self.memory_start
+            for block in self.blocks:
+                if offset < position + len(block):
+                    return block[offset - position :]
+                position += len(block)
+
+    def _append(self, block):
+        with self._cond:
+            if self.cancelled:
+                return False
+            self.blocks.append(block)
+            self.memory_bytes += len(block)
+            self.size += len(block)
+            while self.memory_bytes > self.max_memory and len(self.blocks) > 1:
+                oldest = self.blocks.popleft()
+                if self.spill is None:
+                    self.spill = TemporaryFile(dir=self.spill_dir or None)
+                self.spill.seek(self.memory_start)
+                self.spill.write(oldest)
+                self.memory_start += len(oldest)
+                self.memory_bytes -= len(oldest)
+            self._cond.notify_all()
+            return True
+
+    def _produce(self):
+        archive = None
+        try:
+            archive = self.archive_factory()
+            for block in archive:
+                if block and not self._append(block):
+                    break
+        except Exception as e:
+            logger.exception("Shared download failed")
+            self.error = e
+        finally:
+            try:
+                close_iterator(archive)
+            finally:
+                with self._cond:
+                    if self.cancelled and self.error is None:
+                        self.error = DownloadCancelled()
+                    self.done = True
+                    self._cond.notify_all()
+                    self._cleanup()
+                if self.on_done is not None:
+                    self.on_done(self)
+
+    def _cleanup(self):
+        # With the condition held
+        if self.done and self.subscribers == 0:
+            self.blocks.clear()
+            if self.spill is not None:
+                self.spill.close()
+                self.spill = None
+
+
+class Subscription(object):
+    """Iterator over the blocks of a :class:`SharedArchive` for one reader, from the start of the archive. It must be closed (as WSGI servers do with responses) if it is not read to the end."""
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.offset = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        try:
+            block = self.shared.read(self.offset)
+        except Exception:
+            self.close()
+            raise
+        if not block:
+            self.close()
+            raise StopIteration
+        self.offset += len(block)
+        return block
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.shared.unsubscribe()
+
+
+class Coalescer(object):
+    """Registry of the archive builds in progress, by download key
+
+    :param max_memory: number of bytes of each archive to keep in memory (see :class:`SharedArchive`)
+    :type max_memory: int
+    :param spill_dir: directory for the spill files, or None for the system's default temporary directory
+    :type spill_dir: str
+    """
+
+    def __init__(self, max_memory=DEFAULT_COALESCE_MEMORY, spill_dir=None):
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self.builds = {}
+        self._lock = Lock()
+
+    def subscribe(self, key, archive_factory):
+        """Attach to the build of the archive with key ``key``, starting one with ``archive_factory`` if none is in progress
+
+        :param key: download key, e.g. from :func:`pdp_util.cache.cache_key`
+        :param archive_factory: callable returning an iterator of the archive's blocks
+        :rtype: :class:`Subscription`
+        """
+        with self._lock:
+            shared = self.builds.get(key)
+            subscription = shared.subscribe() if shared is not None else None
+            if subscription is not None:
+                logger.debug(f"Joined the download in progress for {key}")
+                return subscription
+
+            shared = SharedArchive(
+                archive_factory,
+                self.max_memory,
+                self.spill_dir,
+                on_done=lambda shared: self._remove(key, shared),
+            )
+            self.builds[key] = shared
+            subscription = shared.subscribe()
+        shared.start()
+        return subscription
+
+    def __contains__(self, key):
+        """Whether the archive with key ``key`` is being built and can still be joined"""
+        with self._lock:
+            shared = self.builds.get(key)
+            return shared is not None and not shared.cancelled
+
+    def _remove(self, key, shared):
+        with self._lock:
+            if self.builds.get(key) is shared:
+                del self.builds[key]
@@ -0,0 +1,306 @@
+"""
+This module provides a consolidated, columnar output format for PCDS downloads: a single CF discrete sampling geometry (timeSeries) netCDF file holding every selected station, written directly from the database in column batches rather than through one pydap response per station
+"""
+
+import os
+from itertools import groupby
+from tempfile import NamedTemporaryFile
+
+import numpy as np
+from netCDF4 import Dataset
+
+from pycds import History, Variable
+from pdp_util.extract import (
+    station_columns,
+    observations_query,
+    merge_datum,
+    DEFAULT_FETCH_SIZE,
+)
+
+DSG_FORMAT = "dsg"
+DSG_FILENAME = "pcds_data.nc"
+DEFAULT_COLUMN_BATCH = 100000
+DEFAULT_CHUNK_SIZE = 65536
+DEFAULT_COMPLEVEL = 4
+READ_SIZE = 64 * 1024
+
+# Names of the file's own variables, which observation columns must not take
+RESERVED_NAMES = {
+    "network",
+    "station_id",
+    "station_name",
+    "lon",
+    "lat",
+    "alt",
+    "row_size",
+    "time",
+}
+
+EPOCH = np.datetime64("1970-01-01T00:00:00", "s")
+FILL_VALUE = np.nan
+
+
+def station_metadata(sesh, station_ids):
+    """Look up the name and location of each station, from its most recent history
+
+    :rtype: dict mapping ``station_id`` to (``station_name``, ``lon``, ``lat``, ``elevation``)
+    """
+    q = (
+        sesh.query(
+            History.station_id,
+            History.station_name,
+            History.lon,
+            History.lat,
+            History.elevation,
+        )
+        .filter(History.station_id.in_(station_ids))
+        .order_by(History.station_id, History.id)
+    )
+    return {station_id: tuple(row) for station_id, *row in q}
+
+
+def variable_attributes(sesh, vars_ids):
+    """Look up the CF attributes of the observation variables from their metadata
+
+    :rtype: dict mapping ``vars_id`` to a dict of the ``units``, ``standard_name``, ``long_name`` and ``cell_methods`` attributes which the variable has
+    """
+    q = sesh.query(
+        Variable.id,
+        Variable.unit,
+        Variable.standard_name,
+        Variable.description,
+        Variable.cell_method,
+    ).filter(Variable.id.in_(vars_ids))
+    names = ("units", "standard_name", "long_name", "cell_methods")
+    return {
+        vars_id: {name: value for name, value in zip(names, values) if value}
+        for vars_id, *values in q
+    }
+
+
+def column_names(found):
+    """Name the observation variables of the file
+
+    Variable names are only unique within a network, and networks may define variables of the same name differently, so a name used by several networks gets a column per network, prefixed with the network name.
+
+    :param found: list of ((``network_name``, ``native_id``), (``station_id``, [(``vars_id``, ``variable_name``), ...])) items
+    :rtype: dict mapping ``vars_id`` to a column name
+    """
+    networks = {}
+    for (net, native_id), (station_id, variables) in found:
+        for vars_id, name in variables:
+            networks.setdefault(name, {}).setdefault(net, set()).add(vars_id)
+    names = {}
+    for name, by_network in networks.items():
+        for net, vars_ids in by_network.items():
+            column = name if len(by_network) == 1 else f"{net}_{name}"
+            if column in RESERVED_NAMES:
+                column = f"obs_{column}"
+            for vars_id in vars_ids:
+                names[vars_id] = column
+    return names
+
+
+def write_dsg(
+    sesh,
+    stns,
+    clip_dates,
+    path,
+    climo=False,
+    batch_rows=DEFAULT_COLUMN_BATCH,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    complevel=DEFAULT_COMPLEVEL,
+    fetch_size=DEFAULT_FETCH_SIZE,
+):
+    """Write the observations of a set of stations to a netCDF file as a CF timeSeries discrete sampling geometry, in the contiguous ragged array representation
+
+    Stations are laid out along the ``station`` dimension, with their network, native id, name and location, and observations along the ``obs`` dimension, ordered by station and time, with one column per variable, which carries the units, standard name, long name and cell methods of the variable. ``row_size`` gives the number of observations of each station. Observations are pivoted from a single server-side cursor and written ``batch_rows`` at a time; the observation variables are chunked and compressed. Should a variable have several observations at the same time, the largest is written, as in the other download formats (see :func:`pdp_util.extract.merge_datum`).
+
+    netCDF has no fixed dimensions of length 0 (that length makes a dimension unlimited), so if none of the stations has any variables, no file is written.
+
+    :param sesh: database session
+    :type sesh: sqlalchemy.orm.session.Session
+    :param stns: A list of (``network_name``, ``native_id``) pairs
+    :param clip_dates: pair of datetime.datetime objects (or Nones) representing the start and end times for which data should be returned (inclusive)
+    :param path: path of the file to write
+    :type path: str
+    :param climo: Should climatologies rather than raw observations be returned?
+    :type climo: bool
+    :param batch_rows: number of observations to write at a time
+    :type batch_rows: int
+    :param chunk_size: netCDF chunk length of the observation variables
+    :type chunk_size: int
+    :param complevel: zlib compression level of the observation variables
+    :type complevel: int
+    :param fetch_size: number of rows to fetch from the server-side cursor at a time
+    :type fetch_size: int
+    :rtype: int, the number of stations written
+    """
+    columns = station_columns(sesh, stns, climo)
+    found = sorted(columns.items(), key=lambda item: item[1][0])
+    if not found:
+        return 0
+    station_ids = [station_id for stn, (station_id, variables) in found]
+    names = column_names(found)
+    metadata = station_metadata(sesh, station_ids)
+    attributes = variable_attributes(sesh, list(names))
+
+    with Dataset(path, "w", format="NETCDF4") as ds:
+        ds.Conventions = "CF-1.8"
+        ds.featureType = "timeSeries"
+        ds.title = "PCDS station observations"
+
+        ds.createDimension("station", len(found))
+        ds.createDimension("obs", None)
+
+        def station_var(name, datatype, values, **attrs):
+            var = ds.createVariable(name, datatype, ("station",))
+            var.setncatts(attrs)
+            if values:
+                var[:] = np.array(values, dtype=object if datatype is str else datatype)
+            return var
+
+        info = [metadata.get(station_id, (None,) * 4) for station_id in station_ids]
+        station_var(
+            "network",
+            str,
+            [net for (net, native_id), columns in found],
+            long_name="network",
+        )
+        station_var(
+            "station_id",
+            str,
+            [native_id for (net, native_id), columns in found],
+            long_name="native station id",
+            cf_role="timeseries_id",
+        )
+        station_var(
+            "station_name",
+            str,
+            [name or "" for name, lon, lat, elevation in info],
+            long_name="station name",
+        )
+        for name, i, attrs in (
+            ("lon", 1, dict(standard_name="longitude", units="degrees_east")),
+            ("lat", 2, dict(standard_name="latitude", units="degrees_north")),
+            ("alt", 3, dict(standard_name="height", units="m", positive="up")),
+        ):
+            station_var(
+                name,
+                "f8",
+                [np.nan if row[i] is None else float(row[i]) for row in info],
+                **attrs,
+            )
+        row_size = station_var(
+            "row_size",
+            "i4",
+            [],
+            long_name="number of observations for this station",
+            sample_dimension="obs",
+        )
+
+        obs_kwargs = dict(zlib=True, complevel=complevel, chunksizes=(chunk_size,))
+        time = ds.createVariable("time", "f8", ("obs",), **obs_kwargs)
+        time.setncatts(
+            dict(
+                standard_name="time",
+                units="seconds since 1970-01-01 00:00:00",
+                calendar="standard",
+            )
+        )
+        data = {}
+        for name in sorted(set(names.values())):
+            var = ds.createVariable(
+                name, "f8", ("obs",), fill_value=FILL_VALUE, **obs_kwargs
+            )
+            # Variables which share a column share their meaning, but not
+            # necessarily all of their metadata
+            for vars_id in sorted(
+                vars_id for vars_id, column in names.items() if column == name
+            ):
+                for attr, value in attributes.get(vars_id, {}).items():
+                    if attr not in var.ncattrs():
+                        var.setncattr(attr, value)
+            var.coordinates = "time lat lon alt station_id"
+            data[name] = var
+
+        counts = np.zeros(len(found), dtype="i4")
+        position = {station_id: i for i, station_id in enumerate(station_ids)}
+        rows = observations_query(sesh, station_ids, set(names), clip_dates).yield_per(
+            fetch_size
+        )
+        writer = ColumnBatches(time, data, batch_rows)
+        for (station_id, obs_time), group in groupby(
+            rows, key=lambda row: (row[0], row[1])
+        ):
+            values = {}
+            for s, t, vars_id, datum in group:
+                name = names[vars_id]
+                values[name] = merge_datum(values.get(name), datum)
+            writer.append(obs_time, values)
+            counts[position[station_id]] += 1
+        writer.flush()
+        row_size[:] = counts
+    return len(found)
+
+
+class ColumnBatches(object):
+    """Buffers observations as columns and appends them to the ``obs`` variables of a netCDF file in batches"""
+
+    def __init__(self, time, data, batch_rows):
+        self.time = time
+        self.data = data
+        self.batch_rows = batch_rows
+        self.written = 0
+        self._clear()
+
+    def _clear(self):
+        self.times = []
+        self.columns = {name: [] for name in self.data}
+
+    def append(self, obs_time, values):
+        self.times.append(obs_time)
+        for name, column in self.columns.items():
+            value = values.get(name)
+            column.append(FILL_VALUE if value is None else value)
+        if len(self.times) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.times:
+            return
+        start, end = self.written, self.written + len(self.times)
+        seconds = np.array(self.times, dtype="datetime64[s]") - EPOCH
+        self.time[start:end] = seconds.astype("f8")
+        for name, column in self.columns.items():
+            self.data[name][start:end] = np.array(column, dtype="f8")
+        self.written = end
+        self._clear()
+
+
+def get_dsg_responders(sesh, stns, clip_dates, climo=False, spool_dir=None, **kwargs):
+    """Generator of a single (``name``, ``generator``) pair, like :func:`pdp_util.agg.get_pcds_responders`, for a netCDF file holding all of the stations (see :func:`write_dsg`)
+
+    netCDF files cannot be written sequentially, so the file is written to a temporary file in ``spool_dir`` (by default the system's temporary directory) before it is streamed. If there is nothing to write (see :func:`write_dsg`), there is no member.
+
+    :param kwargs: passed on to :func:`write_dsg`
+    :rtype: iterator
+    """
+    f = NamedTemporaryFile(suffix=".nc", dir=spool_dir or None, delete=False)
+    f.close()
+    try:
+        if not write_dsg(sesh, stns, clip_dates, f.name, climo, **kwargs):
+            return
+        nc = open(f.name, "rb")
+    finally:
+        os.remove(f.name)
+
+    def content():
+        with nc:
+            while True:
+                block = nc.read(READ_SIZE)
+                if not block:
+                    return
+                yield block
+
+    yield DSG_FILENAME, content()
@@ -1,28 +1,179 @@
 from contextlib import contextmanager
+from threading import Lock
 
 import json
+import logging
 from webob.request import Request
-from sqlalchemy import func
+from sqlalchemy import func, text, select
 from dateutil.relativedelta import relativedelta
 
 from pycds import (
     CrmpNetworkGeoserver as cng,
+    Network,
+    Station,
     History,
+    VarsPerHistory,
+    CollapsedVariables,
     ObsCountPerMonthHistory,
     ClimoObsCount,
 )
-from pdp_util.util import get_stn_list, get_clip_dates
-from pdp_util.filters import validate_vars
+from paste.httpexceptions import HTTPBadRequest
+
+from pdp_util.util import (
+    get_stn_count,
+    get_stn_counts_by,
+    stn_list_query,
+    get_clip_dates,
+)
+from pdp_util.filters import validate_vars, canonical_filters
+from pdp_util.cache import (
+    MemoryCache,
+    cache_key,
+    DEFAULT_CACHE_ENTRIES,
+    DEFAULT_CACHE_TTL,
+)
 from pdp_util import session_scope
 
+logger = logging.getLogger(__name__)
+
+# The breakdowns of the station count which may be requested with the
+# ``breakdown`` parameter
+BREAKDOWNS = {
+    "network": cng.network_name,
+    "frequency": cng.freq,
+}
+
+# The tables and materialized views from which the counts are taken.
+# crmp_network_geoserver is a plain view, which never changes by itself, so
+# the relations underneath it are watched instead: the metadata tables, the
+# variables of each history and the period of record of each station.
+COUNT_VIEWS = (
+    Network,
+    Station,
+    History,
+    VarsPerHistory,
+    CollapsedVariables,
+    f"{History.__table__.schema}.station_obs_stats_mv",
+    ObsCountPerMonthHistory,
+    ClimoObsCount,
+)
+
+# A REFRESH rewrites a view into a new file, and a REFRESH ... CONCURRENTLY,
+# like any change to a table, shows up in its row change statistics: those
+# reported for committed transactions, plus those of the current one
+VIEWS_VERSION_QUERY = text(
+    """
+    SELECT name, pg_relation_filenode(c.oid),
+           coalesce(s.n_tup_ins, 0) + coalesce(s.n_tup_upd, 0) + coalesce(s.n_tup_del, 0)
+           + coalesce(x.n_tup_ins, 0) + coalesce(x.n_tup_upd, 0) + coalesce(x.n_tup_del, 0)
+    FROM unnest(CAST(:names AS text[])) AS name
+    JOIN pg_class c ON c.oid = to_regclass(name)
+    LEFT JOIN pg_stat_all_tables s ON s.relid = c.oid
+    LEFT JOIN pg_stat_xact_all_tables x ON x.relid = c.oid
+    ORDER BY name
+    """
+)
+
+
+def views_version(sesh, views=COUNT_VIEWS):
+    """A value which changes whenever one of the materialized views ``views`` is refreshed, or one of the tables among them is changed
+
+    Changes made by other sessions are seen once PostgreSQL has reported their statistics, which it does within a few seconds of their commit. Relations which do not exist are left out.
+
+    :param sesh: database session
+    :param views: ORM classes of the views and tables, or their qualified names
+    :rtype: tuple
+    """
+    names = [
+        view if isinstance(view, str) else view.__table__.fullname for view in views
+    ]
+    return tuple(
+        tuple(row) for row in sesh.execute(VIEWS_VERSION_QUERY, {"names": names})
+    )
+
+
+class CountsCache(object):
+    """A cache of the results of the count applications, keyed by a canonical fingerprint of the filters and clip dates of a request (see :func:`counts_key`)
+
+    Entries are bounded in number and expire as those of :class:`pdp_util.cache.MemoryCache` do. In addition, every lookup first checks whether the materialized views and tables the counts come from (:data:`COUNT_VIEWS`) have been refreshed or changed since the entries were computed, with a query of the system catalogs, and discards every entry if they have.
+
+    :param max_entries: maximum number of results to keep
+    :type max_entries: int
+    :param ttl: lifetime of a result in seconds, or None for no expiry
+    :type ttl: int
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES, ttl=DEFAULT_CACHE_TTL):
+        self.results = MemoryCache(max_entries, ttl)
+        self.version = None
+        self._lock = Lock()
+
+    def get(self, sesh, key, compute):
+        """The result with key ``key``, computed with ``compute()`` and kept if it is not already
+
+        :param sesh: database session with which to check the views
+        :param key: fingerprint of the request, from :func:`counts_key`
+        :param compute: callable returning the result
+        """
+        version = views_version(sesh)
+        with self._lock:
+            if version != self.version:
+                if self.version is not None:
+                    logger.info(
+                        "Count views have been refreshed, clearing counts cache"
+                    )
+                self.results.invalidate()
+                self.version = version
+        # A result computed across a refresh is kept under the old version
+        key = (version, key)
+        result = self.results.get(key)
+        if result is None:
+            result = compute()
+            self.results.set(key, result)
+        return result
+
+    def invalidate(self):
+        """Discard every result, e.g. after refreshing the views from this process"""
+        with self._lock:
+            self.results.invalidate()
+
+
+def counts_key(kind, filters, clip_dates=(None, None)):
+    """Fingerprint of a count request, which does not depend on the order of its filters
+
+    :param kind: name of the count, e.g. ``"stations"``
+    :param filters: list of constraints as returned by :func:`pdp_util.filters.validate_vars`
+    :param clip_dates: pair of datetime.datetime objects (or Nones)
+    :rtype: str
+    """
+    return cache_key(kind, canonical_filters(filters), clip_dates)
+
 
 class CountStationsApp(object):
-    """Application for counting the number of stations that meet the query parameters"""
+    """Application for counting the number of stations that meet the query parameters
+
+    The count is made in the database. A ``breakdown`` parameter, which may be repeated, adds the count of the selected stations for each network (``network``) and/or for each observation frequency (``frequency``) to the response, as ``by_network`` and ``by_frequency``.
+    """
 
-    def __init__(self, session_scope_factory=None):
+    def __init__(self, session_scope_factory=None, cache=None):
+        """Initialize the application
+
+        :param session_scope_factory: callable returning a context manager for a database session, used when the request environment has no ``sesh``
+        :param cache: optional cache of the counts, which may be shared with :class:`CountRecordLengthApp`
+        :type cache: :class:`CountsCache`
+        """
         self.session_scope_factory = session_scope_factory
+        self.cache = cache
 
     def __call__(self, environ, start_response):
+        breakdowns = sorted(set(Request(environ).params.getall("breakdown")))
+        unknown = [breakdown for breakdown in breakdowns if breakdown not in BREAKDOWNS]
+        if unknown:
+            return HTTPBadRequest(
+                f"Unknown breakdown {', '.join(unknown)}; "
+                f"choose from {', '.join(BREAKDOWNS)}"
+            )(environ, start_response)
+
         status = "200 OK"
         response_headers = [("Content-type", "application/json; charset=utf-8")]
         start_response(status, response_headers)
@@ -36,19 +187,60 @@ class CountStationsApp(object):
             yield sesh
 
         with self.session_scope_factory() if not sesh else dummy_context() as sesh:
-            stns = get_stn_list(sesh, filters)
+            if self.cache:
+                counts = self.cache.get(
+                    sesh,
+                    counts_key(("stations", *breakdowns), filters),
+                    lambda: count_stations(sesh, filters, breakdowns),
+                )
+            else:
+                counts = count_stations(sesh, filters, breakdowns)
+
+        return json.dumps(counts)
+
+
+def count_stations(sesh, filters, breakdowns=()):
+    """The number of stations selected by ``filters``, and its breakdowns
+
+    :param sesh: database session
+    :param filters: list of constraints as returned by :func:`pdp_util.filters.validate_vars`
+    :param breakdowns: names of the breakdowns to include, from :data:`BREAKDOWNS`
+    :rtype: dict with the key ``stations_selected`` and a ``by_<breakdown>`` dict for each breakdown
+    """
+    counts = {"stations_selected": get_stn_count(sesh, filters)}
+    for breakdown in breakdowns:
+        counts[f"by_{breakdown}"] = get_stn_counts_by(
+            sesh, filters, BREAKDOWNS[breakdown]
+        )
+    return counts
 
-        return json.dumps({"stations_selected": len(stns)})
 
+def get_counts(sesh, filters, sdate, edate, cache=None):
+    """The number of observations and of climatological values of the stations selected by ``filters``
 
-def get_counts(sesh, filters, sdate, edate):
-    stns = [stn[0] for stn in get_stn_list(sesh, filters, cng.station_id)]
+    The selection of the stations and both sums are made in a single query, so the station ids never leave the database.
 
-    rv = length_of_return_dataset(sesh, stns, sdate, edate)
-    obs_count = int(rv[0] if rv[0] else 0)
-    rv = length_of_return_climo(sesh, stns)
-    climo_count = int(rv[0] if rv[0] else 0)
-    return {"record_length": obs_count, "climo_length": climo_count}
+    :param sesh: database session
+    :param filters: list of constraints as returned by :func:`pdp_util.filters.validate_vars`
+    :param sdate: datetime.datetime (or None) from which to count observations
+    :param edate: datetime.datetime (or None) up to which to count observations
+    :param cache: optional cache of the results
+    :type cache: :class:`CountsCache`
+    :rtype: dict with the keys ``record_length`` and ``climo_length``
+    """
+    if cache:
+        return cache.get(
+            sesh,
+            counts_key("lengths", filters, (sdate, edate)),
+            lambda: get_counts(sesh, filters, sdate, edate),
+        )
+    stns = stn_list_query(sesh, filters, cng.station_id).cte("selected_stations")
+    stn_ids = select(stns.c.station_id)
+    obs_count, climo_count = sesh.query(
+        obs_count_query(sesh, stn_ids, sdate, edate).scalar_subquery(),
+        climo_count_query(sesh, stn_ids).scalar_subquery(),
+    ).one()
+    return {"record_length": int(obs_count or 0), "climo_length": int(climo_count or 0)}
 
 
 class CountRecordLengthApp(object):
@@ -56,9 +248,10 @@ class CountRecordLengthApp(object):
     by the stations which meet the given criteria
     """
 
-    def __init__(self, session_scope_factory, max_stns):
+    def __init__(self, session_scope_factory, max_stns, cache=None):
         self.session_scope_factory = session_scope_factory
         self.max_stns = int(max_stns)
+        self.cache = cache
 
     def __call__(self, environ, start_response):
         req = Request(environ)
@@ -74,7 +267,7 @@ class CountRecordLengthApp(object):
             yield sesh
 
         with self.session_scope_factory() if not sesh else dummy_context() as sesh:
-            counts = get_counts(sesh, filters, sdate, edate)
+            counts = get_counts(sesh, filters, sdate, edate, self.cache)
 
         status = "200 OK"
         response_headers = [("Content-type", "application/json; charset=utf-8")]
@@ -83,7 +276,14 @@ class CountRecordLengthApp(object):
         return json.dumps(counts)
 
 
-def length_of_return_dataset(sesh, stn_ids, sdate=None, edate=None):
+def obs_count_query(sesh, stn_ids, sdate=None, edate=None):
+    """Build a query of the number of observations of a set of stations, from the monthly counts
+
+    :param stn_ids: list of station ids, or a select of them
+    :param sdate: datetime.datetime (or None) from which to count
+    :param edate: datetime.datetime (or None) up to which to count, to the end of its month
+    :rtype: :py:class:`sqlalchemy.orm.query.Query`
+    """
     q = (
         sesh.query(func.sum(ObsCountPerMonthHistory.count))
         .join(History, History.id == ObsCountPerMonthHistory.history_id)
@@ -97,14 +297,25 @@ def length_of_return_dataset(sesh, stn_ids, sdate=None, edate=None):
             hour=0, minute=0, second=0, microsecond=0
         ) + relativedelta(months=1)
         q = q.filter(ObsCountPerMonthHistory.date_trunc <= edate)
+    return q
 
-    return sesh.execute(q).first()
 
+def length_of_return_dataset(sesh, stn_ids, sdate=None, edate=None):
+    return sesh.execute(obs_count_query(sesh, stn_ids, sdate, edate)).first()
 
-def length_of_return_climo(sesh, stn_ids):
-    q = (
+
+def climo_count_query(sesh, stn_ids):
+    """Build a query of the number of climatological values of a set of stations
+
+    :param stn_ids: list of station ids, or a select of them
+    :rtype: :py:class:`sqlalchemy.orm.query.Query`
+    """
+    return (
         sesh.query(func.sum(ClimoObsCount.count))
         .join(History, History.id == ClimoObsCount.history_id)
         .filter(History.station_id.in_(stn_ids))
     )
-    return sesh.execute(q).first()
+
+
+def length_of_return_climo(sesh, stn_ids):
+    return sesh.execute(climo_count_query(sesh, stn_ids)).first()
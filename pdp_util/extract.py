@@ -0,0 +1,427 @@
+"""
+This module provides direct database extraction of station observations for the PCDS download path. Rather than invoking a pydap handler (and at least one query) per station, it either pulls the observations for whole batches of stations in single, server-side-cursor queries and splits the rows into per-station CSV files as they stream past, or has PostgreSQL itself produce each station's CSV file with ``COPY``.
+
+The files are plain CSV tables, a ``time`` column followed by one column per variable, which are not laid out as the pydap CSV response is. They are therefore a data format of their own, ``table``, rather than a way of producing ``csv``.
+"""
+
+import math
+import logging
+from datetime import datetime
+from itertools import groupby
+from queue import Queue
+from threading import Thread, Lock, get_ident
+
+from sqlalchemy import tuple_, func, event
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.postgresql import array, psycopg2 as pg_psycopg2
+
+from pycds import Network, Station, History, Variable, VarsPerHistory, Obs
+from pycds import variable_tags
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_FETCH_SIZE = 10000
+ROWS_PER_CHUNK = 1000
+COPY_CHUNK_SIZE = 64 * 1024
+COPY_QUEUE_SIZE = 16
+# The data format of the files produced by direct extraction
+TABLE_FORMAT = "table"
+
+
+def station_columns(sesh, stns, climo=False):
+    """Look up the database id and the variables of each station in a batch with a single query
+
+    :param sesh: database session
+    :type sesh: sqlalchemy.orm.session.Session
+    :param stns: A list of (``network_name``, ``native_id``) pairs
+    :param climo: Should these be climatological variables?
+    :type climo: bool
+    :rtype: dict mapping (``network_name``, ``native_id``) to (``station_id``, [(``vars_id``, ``variable_name``), ...]), with variables ordered by name
+    """
+    q = (
+        sesh.query(
+            Network.name,
+            Station.native_id,
+            Station.id,
+            Variable.id,
+            Variable.name,
+        )
+        .select_from(Station)
+        .join(Network, Network.id == Station.network_id)
+        .join(History, History.station_id == Station.id)
+        .join(VarsPerHistory, VarsPerHistory.history_id == History.id)
+        .join(Variable, Variable.id == VarsPerHistory.vars_id)
+        .filter(tuple_(Network.name, Station.native_id).in_(list(stns)))
+        .filter(
+            variable_tags(Variable).contains(
+                array(["climatology" if climo else "observation"])
+            )
+        )
+        .distinct()
+        .order_by(Network.name, Station.native_id, Variable.name)
+    )
+    columns = {}
+    for net, native_id, station_id, vars_id, var_name in q:
+        station_id, variables = columns.setdefault((net, native_id), (station_id, []))
+        variables.append((vars_id, var_name))
+    return columns
+
+
+def observations_query(sesh, station_ids, vars_ids, clip_dates, since=None):
+    """Build a query for the observations of a set of stations, ordered by station and time
+
+    :param station_ids: database ids of the stations
+    :param vars_ids: database ids of the variables to include
+    :param clip_dates: pair of datetime.datetime objects (or Nones) giving the inclusive time range to return
+    :param since: if given, only return the observations at the times at which one of the station's observations was inserted or changed after this datetime (see :mod:`pdp_util.incremental`). All of the variables at those times are returned, so that each row is complete.
+    :rtype: :py:class:`sqlalchemy.orm.query.Query` of (``station_id``, ``time``, ``vars_id``, ``datum``) rows
+    """
+    sdate, edate = clip_dates
+    q = (
+        sesh.query(History.station_id, Obs.time, Obs.vars_id, Obs.datum)
+        .select_from(Obs)
+        .join(History, History.id == Obs.history_id)
+        .filter(History.station_id.in_(station_ids))
+        .filter(Obs.vars_id.in_(vars_ids))
+    )
+    if sdate:
+        q = q.filter(Obs.time >= sdate)
+    if edate:
+        q = q.filter(Obs.time <= edate)
+    if since:
+        changed_obs, changed_history = aliased(Obs), aliased(History)
+        changed = (
+            sesh.query(changed_history.station_id, changed_obs.time)
+            .select_from(changed_obs)
+            .join(changed_history, changed_history.id == changed_obs.history_id)
+            .filter(changed_history.station_id.in_(station_ids))
+            .filter(changed_obs.vars_id.in_(vars_ids))
+            .filter(changed_obs.mod_time > since)
+        )
+        q = q.filter(tuple_(History.station_id, Obs.time).in_(changed))
+    return q.order_by(History.station_id, Obs.time)
+
+
+def format_value(value):
+    """Format a value as PostgreSQL's ``COPY ... (FORMAT csv)`` does, so that bulk extraction and :func:`get_copy_responders` produce the same files"""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        if math.isnan(value):
+            return "NaN"
+        if math.isinf(value):
+            return "Infinity" if value > 0 else "-Infinity"
+        # Both write the shortest exact representation, but PostgreSQL
+        # leaves off the fraction of integral values
+        text = repr(value)
+        return text[:-2] if text.endswith(".0") else text
+    text = str(value)
+    if isinstance(value, datetime) and value.microsecond:
+        text = text.rstrip("0")
+    return text
+
+
+def merge_datum(kept, datum):
+    """The value to keep for a variable with several observations at the same time (from different histories), given the one ``kept`` so far and another, ``datum``: the largest which is not null, as in :func:`pivot_query`"""
+    if datum is None:
+        return kept
+    return datum if kept is None or datum > kept else kept
+
+
+def csv_rows(variables, rows):
+    """Pivot (``time``, ``vars_id``, ``datum``) rows, ordered by time, into CSV text with a ``time`` column followed by one column per variable
+
+    :param variables: list of (``vars_id``, ``variable_name``) pairs giving the columns
+    :param rows: iterable of (``time``, ``vars_id``, ``datum``) rows. Rows of other variables are skipped. Should a variable have several observations at the same time (from different histories), the largest is written, as in :func:`pivot_query`.
+    :rtype: iterator of bytes, each holding a number of complete lines
+    """
+    positions = {vars_id: i for i, (vars_id, name) in enumerate(variables)}
+    header = ",".join(["time"] + [name for vars_id, name in variables]) + "\n"
+    lines = [header]
+    # The rows of a batch may include variables which are not (or no longer)
+    # among this station's, e.g. when VarsPerHistory is out of date
+    rows = (row for row in rows if row[1] in positions)
+    for time, group in groupby(rows, key=lambda row: row[0]):
+        values = [None] * len(variables)
+        for time, vars_id, datum in group:
+            position = positions[vars_id]
+            values[position] = merge_datum(values[position], datum)
+        lines.append(",".join(format_value(value) for value in [time] + values) + "\n")
+        if len(lines) >= ROWS_PER_CHUNK:
+            yield "".join(lines).encode("utf-8")
+            lines = []
+    if lines:
+        yield "".join(lines).encode("utf-8")
+
+
+def get_bulk_responders(
+    sesh,
+    stns,
+    clip_dates,
+    climo=False,
+    batch_size=DEFAULT_BATCH_SIZE,
+    fetch_size=DEFAULT_FETCH_SIZE,
+    since=None,
+):
+    """Generator of (``name``, ``generator``) pairs, like :func:`pdp_util.agg.get_pcds_responders`, which produces a CSV file for every station using two queries per batch of ``batch_size`` stations
+
+    Within a batch, members are produced in order of database station id, followed by any stations which have no variables of the requested kind (these get a file with only a header). All members of a batch share one server-side cursor, so each member must be consumed completely before the next one is requested; the responders can therefore not be prefetched in parallel.
+
+    :param sesh: database session
+    :type sesh: sqlalchemy.orm.session.Session
+    :param stns: A list of (``network_name``, ``native_id``) pairs representing the stations for which data should be returned
+    :param clip_dates: pair of datetime.datetime objects (or Nones) representing the start and end times for which data should be returned (inclusive)
+    :param climo: Should climatologies rather than raw observations be returned?
+    :type climo: bool
+    :param batch_size: number of stations to extract per query
+    :type batch_size: int
+    :param fetch_size: number of rows to fetch from the server-side cursor at a time
+    :type fetch_size: int
+    :param since: if given, only export the rows at which something was inserted or changed after this datetime (see :func:`observations_query`)
+    :rtype: iterator
+    """
+    stns = list(stns)
+    for start in range(0, len(stns), batch_size):
+        batch = stns[start : start + batch_size]
+        columns = station_columns(sesh, batch, climo)
+        found = sorted(columns.items(), key=lambda item: item[1][0])
+        missing = [stn for stn in batch if stn not in columns]
+
+        if found:
+            station_ids = [station_id for stn, (station_id, variables) in found]
+            vars_ids = {
+                vars_id
+                for stn, (station_id, variables) in found
+                for vars_id, name in variables
+            }
+            rows = observations_query(
+                sesh, station_ids, vars_ids, clip_dates, since
+            ).yield_per(fetch_size)
+            stations = groupby(rows, key=lambda row: row[0])
+            current = next(stations, None)
+
+            for (net, native_id), (station_id, variables) in found:
+                if current is not None and current[0] == station_id:
+                    station_rows = ((row[1], row[2], row[3]) for row in current[1])
+                    yield f"{net}/{native_id}.csv", csv_rows(variables, station_rows)
+                    # groupby skips any rows the consumer left behind
+                    current = next(stations, None)
+                else:
+                    yield f"{net}/{native_id}.csv", csv_rows(variables, [])
+
+        for net, native_id in missing:
+            yield f"{net}/{native_id}.csv", csv_rows([], [])
+
+
+def pivot_query(sesh, station_id, variables, clip_dates, since=None):
+    """Build a query which pivots the observations of one station into a ``time`` column followed by one column per variable, in the layout of :func:`csv_rows`
+
+    Should a station have several observations of a variable at the same time (from different histories), the largest is returned.
+
+    :param station_id: database id of the station
+    :param variables: list of (``vars_id``, ``variable_name``) pairs giving the columns
+    :param clip_dates: pair of datetime.datetime objects (or Nones) giving the inclusive time range to return
+    :param since: if given, only return the rows with an observation which was inserted or changed after this datetime
+    :rtype: :py:class:`sqlalchemy.orm.query.Query`
+    """
+    sdate, edate = clip_dates
+    q = (
+        sesh.query(
+            Obs.time.label("time"),
+            *[
+                func.max(Obs.datum).filter(Obs.vars_id == vars_id).label(name)
+                for vars_id, name in variables
+            ],
+        )
+        .select_from(Obs)
+        .join(History, History.id == Obs.history_id)
+        .filter(History.station_id == station_id)
+        .filter(Obs.vars_id.in_([vars_id for vars_id, name in variables]))
+    )
+    if sdate:
+        q = q.filter(Obs.time >= sdate)
+    if edate:
+        q = q.filter(Obs.time <= edate)
+    q = q.group_by(Obs.time)
+    if since:
+        q = q.having(func.max(Obs.mod_time) > since)
+    return q.order_by(Obs.time)
+
+
+class CopyAborted(Exception):
+    pass
+
+
+class QueueWriter(object):
+    """A file-like object for ``copy_expert`` which hands what is written to it to a consumer through a bounded queue, in chunks of about ``chunk_size`` bytes"""
+
+    def __init__(self, queue, chunk_size=COPY_CHUNK_SIZE):
+        self.queue = queue
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.aborted = False
+
+    def write(self, data):
+        if self.aborted:
+            raise CopyAborted()
+        self.buffer += data.encode("utf-8") if isinstance(data, str) else data
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.queue.put(bytes(self.buffer))
+            self.buffer.clear()
+
+
+def copy_csv(sesh, query, chunk_size=COPY_CHUNK_SIZE):
+    """Stream the result of ``query`` as CSV text, with a header, produced by PostgreSQL's ``COPY ... TO STDOUT``
+
+    ``COPY`` runs in a helper thread on the session's connection, so the session must not be used for anything else until the generator is exhausted or closed. Closing it early cancels the ``COPY``, discards the connection and rolls the session back.
+
+    :param sesh: database session on a psycopg2 connection
+    :type sesh: sqlalchemy.orm.session.Session
+    :param query: query to export
+    :type query: :py:class:`sqlalchemy.orm.query.Query`
+    :rtype: iterator of bytes
+    """
+    compiled = query.statement.compile(dialect=pg_psycopg2.dialect())
+    connection = sesh.connection()
+    cursor = connection.connection.cursor()
+    sql = cursor.mogrify(str(compiled), compiled.params).decode("utf-8")
+    copy = f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER)"
+
+    queue = Queue(COPY_QUEUE_SIZE)
+    writer = QueueWriter(queue, chunk_size)
+    result = {}
+
+    def run():
+        try:
+            cursor.copy_expert(copy, writer)
+            writer.flush()
+        except Exception as e:
+            result["error"] = e
+        finally:
+            queue.put(None)
+
+    thread = Thread(target=run, name="copy-csv", daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = queue.get()
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        if thread.is_alive():
+            # Abandoned: stop the server, then unblock the writer so that it
+            # notices the abort
+            writer.aborted = True
+            connection.connection.cancel()
+            while queue.get() is not None:
+                pass
+            thread.join()
+            # The connection was interrupted mid-COPY; don't return it to the pool
+            connection.invalidate()
+            sesh.rollback()
+        else:
+            cursor.close()
+    if "error" in result:
+        raise result["error"]
+
+
+def cancel_query(sesh):
+    """Cancel the query which the session ``sesh`` may be running, through psycopg2, and roll the session back
+
+    The connection is invalidated rather than returned to the pool, where a cancellation arriving late could interrupt someone else's query. A session which holds no connection is left alone.
+
+    :param sesh: database session on a psycopg2 connection
+    :type sesh: sqlalchemy.orm.session.Session
+    """
+    if not sesh.in_transaction():
+        return
+    try:
+        connection = sesh.connection()
+        connection.connection.cancel()
+        connection.invalidate()
+        sesh.rollback()
+    except Exception:
+        logger.exception("Failed to cancel an abandoned query")
+
+
+# The DBAPI connection on which each thread (by ident) is running queries,
+# for the engines passed to track_queries
+_thread_connections = {}
+_thread_connections_lock = Lock()
+
+
+def track_queries(engine):
+    """Record the connection on which each thread runs its queries through ``engine``, for as long as the thread has it checked out of the pool, so that another thread can cancel them (see :func:`cancel_thread_query`)
+
+    This is how queries run by code which does not hand out its session, such as the pydap handlers, can be cancelled. It is safe to call more than once for the same engine.
+
+    :type engine: sqlalchemy.engine.Engine
+    """
+    if not event.contains(engine, "before_cursor_execute", _query_started):
+        event.listen(engine, "before_cursor_execute", _query_started)
+        event.listen(engine, "checkin", _connection_returned)
+
+
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    with _thread_connections_lock:
+        _thread_connections[get_ident()] = cursor.connection
+
+
+def _connection_returned(dbapi_connection, connection_record):
+    with _thread_connections_lock:
+        for ident, connection in list(_thread_connections.items()):
+            if connection is dbapi_connection:
+                del _thread_connections[ident]
+
+
+def cancel_thread_query(thread):
+    """Cancel the query which ``thread`` may be running on an engine passed to :func:`track_queries`, through psycopg2
+
+    :type thread: threading.Thread
+    """
+    with _thread_connections_lock:
+        connection = _thread_connections.get(thread.ident)
+    if connection is None:
+        return
+    try:
+        connection.cancel()
+    except Exception:
+        logger.exception("Failed to cancel an abandoned query")
+
+
+def get_copy_responders(
+    sesh, stns, clip_dates, climo=False, batch_size=DEFAULT_BATCH_SIZE, since=None
+):
+    """Generator of (``name``, ``generator``) pairs, like :func:`get_bulk_responders` and with the same file layout, in which PostgreSQL produces each station's CSV file with ``COPY``
+
+    Stations are looked up ``batch_size`` at a time, and members come in the order of ``stns``. Each member holds the session's connection until it is exhausted, so the members must be consumed one after the other; the responders can therefore not be prefetched in parallel.
+
+    :param sesh: database session on a psycopg2 connection
+    :type sesh: sqlalchemy.orm.session.Session
+    :param stns: A list of (``network_name``, ``native_id``) pairs representing the stations for which data should be returned
+    :param clip_dates: pair of datetime.datetime objects (or Nones) representing the start and end times for which data should be returned (inclusive)
+    :param climo: Should climatologies rather than raw observations be returned?
+    :type climo: bool
+    :param batch_size: number of stations to look up per query
+    :type batch_size: int
+    :param since: if given, only export the rows at which something was inserted or changed after this datetime (see :func:`pivot_query`)
+    :rtype: iterator
+    """
+    stns = list(stns)
+    for start in range(0, len(stns), batch_size):
+        batch = stns[start : start + batch_size]
+        columns = station_columns(sesh, batch, climo)
+        for net, native_id in batch:
+            name = f"{net}/{native_id}.csv"
+            if (net, native_id) not in columns:
+                yield name, csv_rows([], [])
+                continue
+            station_id, variables = columns[(net, native_id)]
+            query = pivot_query(sesh, station_id, variables, clip_dates, since)
+            yield name, copy_csv(sesh, query)
@@ -0,0 +1,93 @@
+"""
+This module provides the isolation of per-station failures in PCDS downloads: a station whose query fails is retried with backoff and, if it still fails, left out (or cut short) and reported in an ``errors.txt`` member, so that one bad station no longer aborts an archive whose other members have already been built
+"""
+
+import time
+import logging
+
+from pdp_util.util import close_iterator
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RETRY_BACKOFF = 1.0
+ERRORS_FILENAME = "errors.txt"
+
+
+class MemberFailure(object):
+    """A member of a download which could not be produced
+
+    :param name: name of the member
+    :param error: the last error
+    :param attempts: number of attempts made
+    :param partial: whether part of the member had already been written when it failed, in which case it is truncated in the archive rather than missing
+    """
+
+    def __init__(self, name, error, attempts, partial=False):
+        self.name = name
+        self.error = error
+        self.attempts = attempts
+        self.partial = partial
+
+    def __str__(self):
+        what = "truncated" if self.partial else "missing"
+        return (
+            f"{self.name}: {what} after {self.attempts} attempt(s): "
+            f"{type(self.error).__name__}: {self.error}"
+        )
+
+
+def retrying(name, factory, failures, retries=0, backoff=DEFAULT_RETRY_BACKOFF):
+    """Generator of the chunks of a member, which calls ``factory()`` for them again when they fail, and records the failure rather than raising it when they keep failing
+
+    A failure can only be retried before any of the member has been passed on; a failure after that ends the member where it is.
+
+    :param name: name of the member
+    :param factory: callable returning an iterable of the chunks of the member, e.g. a pydap handler response
+    :param failures: list to which a :class:`MemberFailure` is appended if the member cannot be produced
+    :type failures: list
+    :param retries: number of times to try again
+    :type retries: int
+    :param backoff: number of seconds to wait before the first retry, doubled for every retry after that
+    :type backoff: float
+    :rtype: iterator
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        sent = False
+        chunks = None
+        try:
+            chunks = factory()
+            for chunk in chunks:
+                sent = True
+                yield chunk
+            return
+        except Exception as e:
+            if sent or attempt > retries:
+                failure = MemberFailure(name, e, attempt, sent)
+                logger.warning(f"Download member failed: {failure}")
+                failures.append(failure)
+                return
+            delay = backoff * 2 ** (attempt - 1)
+            logger.info(f"Retrying {name} in {delay}s after {e!r}")
+        finally:
+            close_iterator(chunks)
+        time.sleep(delay)
+
+
+def get_error_responders(failures):
+    """Generator of a (``name``, ``generator``) pair for an ``errors.txt`` file listing ``failures``, if there are any
+
+    ``failures`` is only looked at once the generator is advanced, so it should come after all of the members which may fail.
+
+    :param failures: list of :class:`MemberFailure`
+    :rtype: iterator
+    """
+    if not failures:
+        return
+    lines = [
+        "The following files could not be produced in full. "
+        "The rest of the archive is complete.\n\n"
+    ]
+    lines.extend(f"{failure}\n" for failure in failures)
+    yield ERRORS_FILENAME, iter(["".join(lines).encode("utf-8")])
@@ -8,6 +8,7 @@ from sqlalchemy import func, or_
 from pycds import CrmpNetworkGeoserver as cng
 
 from sqlalchemy.sql.functions import GenericFunction
+from sqlalchemy.sql.expression import ClauseElement
 from sqlalchemy.types import String
 from sqlalchemy.dialects import postgresql
 from geoalchemy2.functions import ST_GeomFromText, ST_Intersects
@@ -209,4 +210,23 @@ def validate_vars(environ):
     return valid_filters
 
 
+def canonical_filters(filters):
+    """Reduce a list of constraints from :func:`validate_vars` to a canonical, order-independent form
+
+    Each constraint is compiled for PostgreSQL and represented by its SQL text along with its bound parameters, so that two requests which select the same stations with the same filters produce equal results regardless of the order of the form fields. The result is suitable for hashing into a cache key.
+
+    :param filters: list of constraints as returned by :func:`validate_vars`
+    :rtype: tuple of (sql, params) string pairs
+    """
+    canonical = set()
+    for constraint in filters:
+        if isinstance(constraint, ClauseElement):
+            compiled = constraint.compile(dialect=postgresql.dialect())
+            canonical.add((str(compiled), repr(sorted(compiled.params.items()))))
+        else:
+            # Filters for empty lists reduce to plain True
+            canonical.add((repr(constraint), ""))
+    return tuple(sorted(canonical))
+
+
 __all__ = form_filters
@@ -0,0 +1,173 @@
+"""
+This module provides incremental ("since last download") PCDS exports: given the token of a previous download, or a timestamp, only the observations inserted or changed since then are exported, and a manifest member describes the delta and carries the token for the next download
+"""
+
+import json
+import base64
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, text, tuple_
+from sqlalchemy.dialects.postgresql import array
+from webob.request import Request
+
+from pycds import Network, Station, History, Variable, Obs, variable_tags
+
+SINCE_PARAM = "since"
+MANIFEST_FILENAME = "manifest.json"
+TIMESTAMP_FORMATS = ("%Y/%m/%d", "%Y/%m/%d %H:%M:%S")
+# Allowance for observations whose mod_time lags behind the commit of their
+# transaction by more than the transaction's age, e.g. from another clock
+SNAPSHOT_OVERLAP = timedelta(minutes=1)
+
+# Observations which other transactions have written but not yet committed are
+# invisible now, and will carry a mod_time no earlier than the start of their
+# transaction
+SNAPSHOT_QUERY = text(
+    """
+    SELECT least(now(), min(xact_start)) - CAST(:overlap AS interval)
+    FROM pg_stat_activity
+    WHERE datname = current_database()
+    """
+)
+
+MANIFEST_NOTE = (
+    "Each station file holds the rows at which an observation was inserted or "
+    "changed after 'since', with all of the station's variables at those times; "
+    "they replace any rows already held for the same station and time. "
+    "Observations which were deleted are not reported. Pass 'next_token' as the "
+    "'since' parameter of the next download to continue from this one. The "
+    "downloads overlap a little, so a row may come again in the next one; it "
+    "simply replaces itself."
+)
+
+
+def make_token(snapshot):
+    """The download token for an export taken at ``snapshot``, from which the next incremental download carries on
+
+    :param snapshot: database time at which the export was taken
+    :type snapshot: datetime.datetime
+    :rtype: str
+    """
+    encoded = base64.urlsafe_b64encode(snapshot.isoformat().encode("utf-8"))
+    return encoded.decode("ascii").rstrip("=")
+
+
+def parse_since(value):
+    """Translate the ``since`` parameter of a download into a datetime
+
+    :param value: a token from the manifest of a previous download (see :func:`make_token`), or a timestamp, either ``YYYY/MM/DD`` (optionally followed by ``HH:MM:SS``) or ISO 8601
+    :type value: str
+    :rtype: datetime.datetime
+    :raises ValueError: if ``value`` is neither
+    """
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(value, timestamp_format)
+        except ValueError:
+            pass
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    try:
+        padded = value + "=" * (-len(value) % 4)
+        return datetime.fromisoformat(
+            base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8")
+        )
+    except ValueError:
+        raise ValueError(f"Invalid {SINCE_PARAM} parameter: {value!r}")
+
+
+def get_since(environ):
+    """Extract the time from which a download is incremental from the request parameters
+
+    :param environ: WSGI request environment dictionary
+    :rtype: datetime.datetime, or None for a full download
+    :raises ValueError: if the ``since`` parameter is invalid
+    """
+    value = Request(environ).params.get(SINCE_PARAM, "").strip()
+    return parse_since(value) if value else None
+
+
+def snapshot_time(sesh, overlap=SNAPSHOT_OVERLAP):
+    """The time from which the next incremental download should carry on: the start of the session's transaction, or of the oldest transaction still open in the database if that is earlier, less ``overlap``
+
+    A transaction which is still open may yet commit observations whose ``mod_time`` is before the start of ours; this download cannot see them, so the next one has to. The changes should be looked up and extracted in the same repeatable read transaction as this is called in, so that the download is of a single state of the database. The next download may send a few rows again, which is harmless since they replace themselves.
+
+    Using the database's clock rather than ours keeps tokens consistent with the ``mod_time`` of the observations.
+
+    :param sesh: database session
+    :type sesh: sqlalchemy.orm.session.Session
+    :param overlap: allowance for observations whose ``mod_time`` lags behind their commit
+    :type overlap: datetime.timedelta
+    :rtype: datetime.datetime
+    """
+    return sesh.execute(SNAPSHOT_QUERY, {"overlap": overlap}).scalar()
+
+
+def changed_stations(sesh, stns, since, clip_dates=(None, None)):
+    """Find the stations which have observations that were inserted or changed after ``since``
+
+    Only the observation variables count, as only they are exported (see :func:`pdp_util.extract.station_columns`).
+
+    :param sesh: database session
+    :type sesh: sqlalchemy.orm.session.Session
+    :param stns: A list of (``network_name``, ``native_id``) pairs
+    :param since: datetime after which changes count
+    :param clip_dates: pair of datetime.datetime objects (or Nones) representing the start and end times of the observations to consider (inclusive)
+    :rtype: pair (``changed``, ``counts``): the list of the changed stations, in the order of ``stns``, and a dict mapping each of them to its number of changed observations
+    """
+    stns = [tuple(stn) for stn in stns]
+    if not stns:
+        return [], {}
+    sdate, edate = clip_dates
+    q = (
+        sesh.query(Network.name, Station.native_id, func.count(Obs.id))
+        .select_from(Obs)
+        .join(History, History.id == Obs.history_id)
+        .join(Station, Station.id == History.station_id)
+        .join(Network, Network.id == Station.network_id)
+        .join(Variable, Variable.id == Obs.vars_id)
+        .filter(tuple_(Network.name, Station.native_id).in_(stns))
+        .filter(variable_tags(Variable).contains(array(["observation"])))
+        .filter(Obs.mod_time > since)
+    )
+    if sdate:
+        q = q.filter(Obs.time >= sdate)
+    if edate:
+        q = q.filter(Obs.time <= edate)
+    counts = {
+        (net, native_id): count
+        for net, native_id, count in q.group_by(Network.name, Station.native_id)
+    }
+    return [stn for stn in stns if stn in counts], counts
+
+
+def get_manifest_responders(since, snapshot, counts, unchanged, extension="csv"):
+    """Generator of a (``name``, ``generator``) pair for the ``manifest.json`` of an incremental download
+
+    :param since: datetime from which the download is incremental
+    :param snapshot: database time at which the download was taken (see :func:`snapshot_time`)
+    :param counts: dict mapping each changed (``network_name``, ``native_id``) to its number of changed observations (see :func:`changed_stations`)
+    :param unchanged: number of the selected stations which have no changes
+    :type unchanged: int
+    :param extension: extension of the station files
+    :rtype: iterator
+    """
+    manifest = {
+        "since": since.isoformat(),
+        "until": snapshot.isoformat(),
+        "next_token": make_token(snapshot),
+        "stations": [
+            {
+                "network_name": net,
+                "native_id": native_id,
+                "file": f"{net}/{native_id}.{extension}",
+                "changed_observations": count,
+            }
+            for (net, native_id), count in counts.items()
+        ],
+        "unchanged_stations": unchanged,
+        "note": MANIFEST_NOTE,
+    }
+    yield MANIFEST_FILENAME, iter([json.dumps(manifest, indent=2).encode("utf-8")])
@@ -0,0 +1,163 @@
+"""
+This module provides per-member and per-request instrumentation of the PCDS download path, so that the time of a slow download can be attributed to the database, to encoding, to compression or to the client
+"""
+
+import time
+import logging
+from threading import Lock
+
+from pdp_util.util import close_iterator
+
+logger = logging.getLogger(__name__)
+
+# Output formats whose lines can be counted as rows
+TEXT_EXTENSIONS = {"csv", "ascii"}
+
+
+class MemberStats(object):
+    """Figures for a single archive member
+
+    ``query_time`` is the time until a responder produced its first chunk (which is where the data query runs), ``encode_time`` the time it took to produce the rest, and ``compress_time`` the time spent compressing the content into the archive. ``rows`` is the number of lines of output for text formats (headers included), and None otherwise.
+    """
+
+    fields = (
+        "query_time",
+        "encode_time",
+        "compress_time",
+        "raw_bytes",
+        "compressed_bytes",
+        "rows",
+    )
+
+    def __init__(self, name):
+        self.name = name
+        self.query_time = 0.0
+        self.encode_time = 0.0
+        self.compress_time = 0.0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.rows = None
+
+    def as_dict(self):
+        return dict(
+            name=self.name, **{field: getattr(self, field) for field in self.fields}
+        )
+
+
+class Instrumentation(object):
+    """Collects :class:`MemberStats` for the members of one download and reports them
+
+    Each finished member is logged at DEBUG level and the request summary at INFO level, through the ``pdp_util.instrument`` logger. If a ``callback`` is given, it is also called as ``callback(event, stats)`` with event ``"member"`` and the member's figures, or ``"request"`` and the summary, both as dicts; this is the hook for metrics systems. Errors raised by the callback are logged and otherwise ignored.
+
+    :param callback: optional callable receiving (``event``, ``stats``)
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.members = {}
+        self.send_time = 0.0
+        self.total_time = 0.0
+        self.response_bytes = 0
+        self._lock = Lock()
+
+    def member(self, name):
+        """The :class:`MemberStats` for member ``name``, created on first use"""
+        with self._lock:
+            try:
+                return self.members[name]
+            except KeyError:
+                stats = self.members[name] = MemberStats(name)
+                return stats
+
+    def timed(self, name, chunks, count_rows=False):
+        """Pass through the chunks of a responder, timing the production of its first chunk as ``query_time`` and of the rest as ``encode_time``
+
+        :param name: name of the member
+        :param chunks: iterable of chunks making up the member
+        :param count_rows: if True, count the lines of output as rows
+        :type count_rows: bool
+        :rtype: iterator
+        """
+        stats = self.member(name)
+        if count_rows:
+            stats.rows = 0
+        first = True
+        t0 = time.perf_counter()
+        for chunk in chunks:
+            t1 = time.perf_counter()
+            if first:
+                stats.query_time += t1 - t0
+                first = False
+            else:
+                stats.encode_time += t1 - t0
+            if count_rows:
+                stats.rows += chunk.count("\n" if isinstance(chunk, str) else b"\n")
+            yield chunk
+            t0 = time.perf_counter()
+        if first:
+            stats.query_time += time.perf_counter() - t0
+        else:
+            stats.encode_time += time.perf_counter() - t0
+
+    def timed_responders(self, responders, count_rows=False):
+        """Apply :meth:`timed` to each of a sequence of (``name``, ``generator``) pairs"""
+        try:
+            for name, chunks in responders:
+                yield name, self.timed(name, chunks, count_rows)
+        finally:
+            close_iterator(responders)
+
+    def member_done(self, name):
+        """Report the figures of a finished member"""
+        stats = self.member(name).as_dict()
+        logger.debug(f"Download member: {stats}")
+        self._notify("member", stats)
+
+    def summary(self):
+        """A dict of the figures of the whole download: the member totals, plus the time spent waiting for the client to take the response (``send_time``) and overall (``total_time``)"""
+        with self._lock:
+            members = list(self.members.values())
+        summary = {
+            field: sum(getattr(stats, field) or 0 for stats in members)
+            for field in MemberStats.fields
+        }
+        summary.update(
+            members=len(members),
+            send_time=self.send_time,
+            total_time=self.total_time,
+            response_bytes=self.response_bytes,
+        )
+        return summary
+
+    def request_done(self):
+        """Report the summary of the download"""
+        summary = self.summary()
+        logger.info(f"Download summary: {summary}")
+        self._notify("request", summary)
+
+    def measure(self, response):
+        """Pass through the blocks of a response, timing the whole response and the time spent outside of the generator (i.e. sending blocks to the client), and reporting the summary once the response is finished or abandoned
+
+        :param response: iterable of bytes
+        :rtype: iterator of bytes
+        """
+        start = time.perf_counter()
+        try:
+            for block in response:
+                self.response_bytes += len(block)
+                t1 = time.perf_counter()
+                yield block
+                t0 = time.perf_counter()
+                self.send_time += t0 - t1
+        finally:
+            close_iterator(response)
+            self.total_time = time.perf_counter() - start
+            self.request_done()
+
+    def _notify(self, event, stats):
+        if self.callback is None:
+            return
+        try:
+            self.callback(event, stats)
+        except Exception:
+            logger.exception(f"Instrumentation callback failed for {event} event")
@@ -0,0 +1,427 @@
+"""
+This module provides background PCDS downloads: a request is turned into a job at once, a local pool of threads builds the archive into a filesystem result store, and the client polls the job's status and fetches the archive once it is done, so that no single HTTP request has to outlive a proxy timeout
+"""
+
+import os
+import time
+import json
+import uuid
+import socket
+import sqlite3
+import logging
+from threading import Lock
+from io import BytesIO
+from contextlib import closing
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+from webob.request import Request
+from paste.httpexceptions import (
+    HTTPBadRequest,
+    HTTPNotFound,
+    HTTPConflict,
+    HTTPServiceUnavailable,
+)
+
+from pdp_util.agg import agg_generator
+from pdp_util.columnar import DSG_FORMAT
+from pdp_util.extract import TABLE_FORMAT
+from pdp_util.util import get_extension, file_response, close_iterator
+from pdp_util.zipstream import DEFAULT_BLOCK_SIZE
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOB_WORKERS = 2
+DEFAULT_JOB_TTL = 24 * 3600
+DEFAULT_MAX_QUEUED_JOBS = 100
+DEFAULT_RETRY_AFTER = 60
+PROGRESS_INTERVAL = 5
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Request headers which make sense only for the request which carries them,
+# not for the download built in the background
+CONDITIONAL_HEADERS = (
+    "HTTP_RANGE",
+    "HTTP_IF_RANGE",
+    "HTTP_IF_MATCH",
+    "HTTP_IF_NONE_MATCH",
+    "HTTP_IF_MODIFIED_SINCE",
+    "HTTP_IF_UNMODIFIED_SINCE",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    owner TEXT
+)
+"""
+
+JOB_FIELDS = (
+    "id",
+    "status",
+    "params",
+    "created",
+    "updated",
+    "bytes",
+    "error",
+    "owner",
+)
+
+
+def process_owner():
+    """The owner of the jobs created by this process: ``<host>:<pid>``"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def owner_is_gone(owner):
+    """Whether the process ``owner`` (from :func:`process_owner`) is known to have gone away
+
+    Only processes on this host can be checked; those on other hosts are assumed to be alive. Jobs without an owner date from before jobs had owners, and so from a process which has since been restarted.
+    """
+    if not owner:
+        return True
+    host, _, pid = owner.rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+class JobStore(object):
+    """The jobs and their results, kept in a directory: a SQLite table of the jobs next to the archives they produce
+
+    Finished (or failed) jobs are expired ``ttl`` seconds after they last changed, along with their archives. Each job records the process (host and pid) which runs it, so that several processes, e.g. the workers of a WSGI server, can share a store.
+
+    :param directory: directory of the store, which is created if need be
+    :type directory: str
+    :param ttl: number of seconds for which finished jobs are kept
+    :type ttl: int
+    """
+
+    def __init__(self, directory, ttl=DEFAULT_JOB_TTL):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.ttl = ttl
+        self.db_path = os.path.join(directory, "jobs.sqlite")
+        self._execute(SCHEMA)
+        columns = {row[1] for row in self._execute("PRAGMA table_info(jobs)")}
+        if "owner" not in columns:
+            # A store created before jobs had owners
+            self._execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+    def _execute(self, sql, params=()):
+        # One connection per call, so that the store can be shared by threads
+        with closing(sqlite3.connect(self.db_path, timeout=30)) as db:
+            with db:
+                return db.execute(sql, params).fetchall()
+
+    def path(self, job_id):
+        """The path of the archive of job ``job_id``"""
+        return os.path.join(self.directory, f"{job_id}.zip")
+
+    def create(self, params):
+        """Record a new, queued job for the download parameters ``params``
+
+        :param params: list of (``name``, ``value``) pairs
+        :rtype: str, the id of the job
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._execute(
+            "INSERT INTO jobs (id, status, params, created, updated, owner) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, QUEUED, json.dumps(params), now, now, process_owner()),
+        )
+        return job_id
+
+    def get(self, job_id):
+        """The job ``job_id`` as a dict, or None if there is no such job"""
+        rows = self._execute(
+            f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE id = ?", (job_id,)
+        )
+        if not rows:
+            return None
+        job = dict(zip(JOB_FIELDS, rows[0]))
+        job["params"] = json.loads(job["params"])
+        return job
+
+    def update(self, job_id, **fields):
+        """Set the ``status``, ``bytes`` and/or ``error`` of job ``job_id``"""
+        fields["updated"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        self._execute(
+            f"UPDATE jobs SET {assignments} WHERE id = ?",
+            tuple(fields.values()) + (job_id,),
+        )
+
+    def expire(self):
+        """Remove the finished jobs, and their archives, which have outlived the ttl"""
+        cutoff = time.time() - self.ttl
+        rows = self._execute(
+            "SELECT id FROM jobs WHERE status IN (?, ?) AND updated < ?",
+            (DONE, FAILED, cutoff),
+        )
+        for (job_id,) in rows:
+            for path in (self.path(job_id), self.path(job_id) + ".tmp"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        return len(rows)
+
+    def recover(self):
+        """Fail the jobs which were queued or running when the process that owned them went away
+
+        Jobs whose process is still alive, or runs on another host, are left alone.
+        """
+        unfinished = self._execute(
+            "SELECT id, owner FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)
+        )
+        interrupted = [job_id for job_id, owner in unfinished if owner_is_gone(owner)]
+        for job_id in interrupted:
+            self.update(job_id, status=FAILED, error="Interrupted by a restart")
+        return len(interrupted)
+
+
+def job_environ(environ, params):
+    """A copy of the request environment ``environ`` in which to run a download in the background: the parameters ``params``, which may have come in a POST body, are moved into the query string, and range and conditional headers (:data:`CONDITIONAL_HEADERS`) are dropped, so that the whole archive is built"""
+    env = {
+        key: value
+        for key, value in environ.items()
+        if not key.startswith("webob.") and key not in CONDITIONAL_HEADERS
+    }
+    env.update(
+        {
+            "REQUEST_METHOD": "GET",
+            "PATH_INFO": "",
+            "QUERY_STRING": urlencode(params),
+            "CONTENT_LENGTH": "0",
+            "wsgi.input": BytesIO(),
+        }
+    )
+    env.pop("CONTENT_TYPE", None)
+    return env
+
+
+class JobApp(object):
+    """WSGI application which runs downloads of the application ``app`` (a :class:`pdp_util.agg.PcdsZipApp`) as background jobs
+
+    .. hlist::
+       * A request to the root (e.g. ``POST /``) with the usual download parameters creates a job and responds at once with ``202 Accepted`` and a JSON description of the job
+       * ``GET /<id>`` responds with the status of the job: ``queued``, ``running`` (with the number of bytes written so far), ``done`` or ``failed`` (with the error)
+       * ``GET /<id>/result`` responds with the archive of a finished job, through the server's ``wsgi.file_wrapper`` where there is one; byte ranges of it may be requested, to resume an interrupted transfer
+
+    Jobs which were queued or running in a process which has since gone away (on this host) are marked as failed when the application starts. At most ``max_queued`` jobs may wait for a worker in each process; beyond that, new jobs are turned away with a 503.
+
+    :param app: the download application
+    :param store: where the jobs and their archives are kept
+    :type store: :class:`JobStore`
+    :param workers: number of jobs which run at once
+    :type workers: int
+    :param block_size: size of the blocks in which results are sent when there is no ``wsgi.file_wrapper``
+    :type block_size: int
+    :param max_queued: maximum number of jobs waiting for a worker
+    :type max_queued: int
+    :param retry_after: number of seconds which turned away clients are asked to wait before trying again
+    :type retry_after: int
+    """
+
+    def __init__(
+        self,
+        app,
+        store,
+        workers=DEFAULT_JOB_WORKERS,
+        block_size=DEFAULT_BLOCK_SIZE,
+        max_queued=DEFAULT_MAX_QUEUED_JOBS,
+        retry_after=DEFAULT_RETRY_AFTER,
+    ):
+        self.app = app
+        self.store = store
+        self.block_size = block_size
+        self.workers = workers
+        self.max_queued = max_queued
+        self.retry_after = retry_after
+        self.pending = 0
+        self._lock = Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="pcds-job"
+        )
+        recovered = store.recover()
+        if recovered:
+            logger.warning(f"Marked {recovered} interrupted download jobs as failed")
+
+    def __call__(self, environ, start_response):
+        req = Request(environ)
+        parts = [part for part in req.path_info.split("/") if part]
+        if not parts:
+            return self.submit(req, environ, start_response)
+        if len(parts) == 1:
+            return self.status(req, parts[0], environ, start_response)
+        if len(parts) == 2 and parts[1] == "result":
+            return self.result(parts[0], environ, start_response)
+        return HTTPNotFound(f"PATH {req.path_info} not found")(environ, start_response)
+
+    def submit(self, req, environ, start_response):
+        if not get_extension(environ, [DSG_FORMAT, TABLE_FORMAT]):
+            return HTTPBadRequest("Requested extension not supported")(
+                environ, start_response
+            )
+        with self._lock:
+            if self.pending >= self.workers + self.max_queued:
+                return HTTPServiceUnavailable(
+                    "Too many download jobs waiting",
+                    headers=[("Retry-After", str(self.retry_after))],
+                )(environ, start_response)
+            self.pending += 1
+        job_id = None
+        try:
+            self.store.expire()
+            params = list(req.params.items())
+            job_id = self.store.create(params)
+            self.executor.submit(self.run, job_id, job_environ(environ, params))
+        except BaseException as e:
+            # The job will never run to give back its place
+            with self._lock:
+                self.pending -= 1
+            if job_id is not None:
+                self.store.update(job_id, status=FAILED, error=str(e))
+            raise
+        logger.info(f"Queued download job {job_id}")
+
+        body = self.describe(req, self.store.get(job_id))
+        start_response(
+            "202 Accepted",
+            [
+                ("Content-type", "application/json; charset=utf-8"),
+                ("Location", body["status_url"]),
+            ],
+        )
+        return [json.dumps(body).encode("utf-8")]
+
+    def status(self, req, job_id, environ, start_response):
+        job = self.store.get(job_id)
+        if job is None:
+            return HTTPNotFound(f"No such job: {job_id}")(environ, start_response)
+        start_response("200 OK", [("Content-type", "application/json; charset=utf-8")])
+        return [json.dumps(self.describe(req, job)).encode("utf-8")]
+
+    def result(self, job_id, environ, start_response):
+        job = self.store.get(job_id)
+        if job is None:
+            return HTTPNotFound(f"No such job: {job_id}")(environ, start_response)
+        if job["status"] != DONE:
+            return HTTPConflict(
+                f"Job {job_id} is {job['status']}"
+                + (f": {job['error']}" if job["error"] else "")
+            )(environ, start_response)
+        try:
+            f = open(self.store.path(job_id), "rb")
+        except FileNotFoundError:
+            return HTTPNotFound(f"The result of job {job_id} has expired")(
+                environ, start_response
+            )
+        return file_response(
+            environ,
+            start_response,
+            f,
+            [
+                ("Content-type", "application/zip"),
+                ("Content-Disposition", 'filename="pcds_data.zip"'),
+            ],
+            etag=job_id,
+            block_size=self.block_size,
+        )
+
+    def describe(self, req, job):
+        """The JSON description of ``job`` for the client"""
+        base = f"{req.application_url}/{job['id']}"
+        body = {
+            "id": job["id"],
+            "status": job["status"],
+            "bytes": job["bytes"],
+            "created": job["created"],
+            "updated": job["updated"],
+            "status_url": base,
+        }
+        if job["status"] == DONE:
+            body["result_url"] = f"{base}/result"
+        if job["error"]:
+            body["error"] = job["error"]
+        return body
+
+    def run(self, job_id, environ):
+        """Build the archive of job ``job_id`` into the store, reporting progress as it goes"""
+        try:
+            self._run(job_id, environ)
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def _run(self, job_id, environ):
+        self.store.update(job_id, status=RUNNING)
+        path = self.store.path(job_id)
+        tmp = path + ".tmp"
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = status
+
+        written = 0
+        try:
+            blocks = self.app(environ, start_response)
+            try:
+                last = time.monotonic()
+                with open(tmp, "wb") as f:
+                    for block in blocks:
+                        f.write(block)
+                        written += len(block)
+                        if time.monotonic() - last >= PROGRESS_INTERVAL:
+                            self.store.update(job_id, bytes=written)
+                            last = time.monotonic()
+            finally:
+                close_iterator(blocks)
+            if not response.get("status", "").startswith("200"):
+                raise ValueError(f"Download failed: {response.get('status')}")
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.exception(f"Download job {job_id} failed")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            self.store.update(job_id, status=FAILED, bytes=written, error=str(e))
+            return
+        self.store.update(job_id, status=DONE, bytes=written)
+        logger.info(f"Download job {job_id} is done ({written} bytes)")
+
+
+def jobs_generator(global_conf, **kwargs):
+    """Factory function for a :class:`JobApp` running a :class:`pdp_util.agg.PcdsZipApp`
+
+    :param global_conf: dict of the configuration accepted by :func:`pdp_util.agg.agg_generator`, plus the key job_dir and the optional keys job_workers, job_ttl and job_max_queued
+    :param kwargs: ignored
+    """
+    return JobApp(
+        agg_generator(global_conf),
+        JobStore(
+            global_conf["job_dir"],
+            int(global_conf.get("job_ttl", DEFAULT_JOB_TTL)),
+        ),
+        workers=int(global_conf.get("job_workers", DEFAULT_JOB_WORKERS)),
+        block_size=int(global_conf.get("block_size", DEFAULT_BLOCK_SIZE)),
+        max_queued=int(global_conf.get("job_max_queued", DEFAULT_MAX_QUEUED_JOBS)),
+    )
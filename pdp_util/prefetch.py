@@ -0,0 +1,274 @@
+"""
+This module provides bounded, order-preserving prefetching of (``name``, ``generator``) responder pairs, so that the database queries and encoding for upcoming archive members run in the background while the current member is being written
+"""
+
+from collections import deque
+from tempfile import TemporaryFile
+from threading import Thread, Lock, Condition, current_thread
+
+from pdp_util.util import close_iterator
+
+DEFAULT_PREFETCH_BYTES = 64 * 1024**2
+SPILL_READ_SIZE = 64 * 1024
+
+
+class PrefetchMember(object):
+    """The buffered output of a single responder, filled by a worker thread and drained by the consumer
+
+    Chunks are held in memory until the member is first refused memory; from then on they are appended to a temporary spill file, which keeps the member's content in order.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.chunks = deque()
+        self.spill = None
+        self.spill_written = 0
+        self.spill_read = 0
+        self.done = False
+        self.error = None
+
+    @property
+    def pending(self):
+        return bool(self.chunks) or self.spill_read < self.spill_written
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+
+
+class PrefetchedResponders(object):
+    """An iterable of (``name``, ``generator``) pairs which drains up to ``workers`` responders ahead of the one being consumed
+
+    Responders are taken from ``responders`` strictly in order and are yielded in that same order, so archive member order is deterministic. Each worker thread iterates one responder at a time (which is where the pydap handlers run their data queries and encode their output) and buffers the resulting chunks. The number of bytes buffered in memory is capped at ``max_bytes`` and, if a ``budget`` is given, is also reserved from it. A worker ahead of the consumer which cannot buffer a chunk in memory either spills it to disk (if ``spill_dir`` is set) or waits for space, which lowers the effective concurrency. The member currently being consumed may always make progress, so the pipeline cannot deadlock.
+
+    Chunks are passed through unchanged, except that chunks read back from disk are bytes; their ``len()`` is what counts towards ``max_bytes``.
+
+    Note that ``next()`` is called on ``responders`` by one worker at a time, so any work done while *creating* a responder is serialized; only the iteration of responders runs in parallel.
+
+    :param responders: iterable of (``name``, ``generator``) pairs
+    :param workers: maximum number of responders to run concurrently
+    :type workers: int
+    :param max_bytes: cap on the number of bytes buffered in memory across all members
+    :type max_bytes: int
+    :param budget: optional memory budget of the download, from which buffered bytes are reserved
+    :type budget: :class:`pdp_util.budget.MemoryBudget`
+    :param spill_dir: directory in which to spill members that do not fit in memory, or None to wait for memory instead. An empty string means the system's default temporary directory.
+    :type spill_dir: str
+    :param cancel: optional callable which is passed each worker thread that is still running a responder when the responders are closed, to interrupt work that the thread cannot give up by itself, e.g. a database query (see :func:`pdp_util.extract.cancel_thread_query`)
+    """
+
+    def __init__(
+        self,
+        responders,
+        workers=4,
+        max_bytes=DEFAULT_PREFETCH_BYTES,
+        budget=None,
+        spill_dir=None,
+        cancel=None,
+    ):
+        if workers < 1:
+            raise ValueError("At least one prefetch worker is required")
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.cancel = cancel
+        self.buffered = 0
+        self._responders = iter(responders)
+        self._source_lock = Lock()
+        self._cond = Condition()
+        self._members = {}
+        self._next_index = 0
+        self._head = 0
+        self._exhausted = False
+        self._closed = False
+        self._threads = []
+        self._busy = set()
+
+    def __iter__(self):
+        self._start()
+        index = 0
+        try:
+            while True:
+                with self._cond:
+                    while index not in self._members and not (
+                        self._exhausted and index >= self._next_index
+                    ):
+                        self._cond.wait()
+                    if index not in self._members:
+                        return
+                    member = self._members[index]
+                if member.name is None:
+                    raise member.error
+                yield member.name, self._drain(member)
+                with self._cond:
+                    # Discard anything the consumer left behind
+                    del self._members[index]
+                    self._discard(member)
+                    index += 1
+                    self._head = index
+                    self._cond.notify_all()
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the worker threads from starting or buffering any more work, closing the responders they are running (after cancelling them, if there is a ``cancel`` callable) and then the source of responders"""
+        with self._cond:
+            self._closed = True
+            for member in self._members.values():
+                self._discard(member)
+            busy = list(self._busy)
+            self._cond.notify_all()
+        if self.cancel is not None:
+            for thread in busy:
+                self.cancel(thread)
+        if not self._threads:
+            with self._source_lock:
+                self._exhausted = True
+                close_iterator(self._responders)
+
+    def _start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = Thread(target=self._work, name=f"prefetch-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _admit(self, nbytes):
+        """Make room in memory for ``nbytes`` if there is any"""
+        if self.buffered + nbytes > self.max_bytes:
+            return False
+        if self.budget is not None and not self.budget.try_reserve(nbytes):
+            return False
+        self.buffered += nbytes
+        return True
+
+    def _reserve(self, nbytes):
+        self.buffered += nbytes
+        if self.budget is not None:
+            self.budget.reserve(nbytes)
+
+    def _release(self, nbytes):
+        self.buffered -= nbytes
+        if self.budget is not None:
+            self.budget.release(nbytes)
+
+    def _discard(self, member):
+        self._release(sum(len(chunk) for chunk in member.chunks))
+        member.chunks.clear()
+        member.close()
+
+    def _spill(self, member, chunk):
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        if member.spill is None:
+            member.spill = TemporaryFile(dir=self.spill_dir or None)
+        member.spill.seek(0, 2)
+        member.spill.write(chunk)
+        member.spill_written += len(chunk)
+        if self.budget is not None:
+            self.budget.record_spill(len(chunk))
+
+    def _drain(self, member):
+        while True:
+            with self._cond:
+                while not member.pending and not member.done:
+                    self._cond.wait()
+                if member.chunks:
+                    chunk = member.chunks.popleft()
+                    self._release(len(chunk))
+                    self._cond.notify_all()
+                elif member.spill_read < member.spill_written:
+                    member.spill.seek(member.spill_read)
+                    chunk = member.spill.read(
+                        min(SPILL_READ_SIZE, member.spill_written - member.spill_read)
+                    )
+                    member.spill_read += len(chunk)
+                elif member.error is not None:
+                    raise member.error
+                else:
+                    return
+            yield chunk
+
+    def _next_responder(self):
+        """Take the next responder from the source, returning (index, member, responder) or None when there are no more"""
+        with self._source_lock:
+            if self._closed and not self._exhausted:
+                # Only a worker may touch the source, as one may be reading from it
+                self._exhausted = True
+                close_iterator(self._responders)
+            if self._closed or self._exhausted:
+                return None
+            responder = None
+            try:
+                name, responder = next(self._responders)
+                member = PrefetchMember(name)
+            except StopIteration:
+                with self._cond:
+                    self._exhausted = True
+                    self._cond.notify_all()
+                return None
+            except Exception as e:
+                # Hand the error to the consumer in order, then stop
+                member = PrefetchMember(None)
+                member.error = e
+                member.done = True
+                self._exhausted = True
+            with self._cond:
+                index = self._next_index
+                self._members[index] = member
+                self._next_index += 1
+                self._cond.notify_all()
+            return index, member, responder
+
+    def _buffer(self, index, member, chunk):
+        """Buffer one chunk of member ``index``, waiting for memory if need be. Returns False if the chunk is no longer wanted."""
+        throttled = False
+        with self._cond:
+            while True:
+                if self._closed or index < self._head:
+                    # Closed, or the consumer has moved past this member
+                    return False
+                if member.spill is not None:
+                    self._spill(member, chunk)
+                elif self._admit(len(chunk)):
+                    member.chunks.append(chunk)
+                elif index == self._head and not member.pending:
+                    # The consumer is waiting for this very chunk
+                    self._reserve(len(chunk))
+                    member.chunks.append(chunk)
+                elif self.spill_dir is not None:
+                    self._spill(member, chunk)
+                else:
+                    if not throttled and self.budget is not None:
+                        self.budget.record_throttle()
+                    throttled = True
+                    self._cond.wait()
+                    continue
+                self._cond.notify_all()
+                return True
+
+    def _work(self):
+        while True:
+            job = self._next_responder()
+            if job is None:
+                return
+            index, member, responder = job
+            if member.done:
+                return
+            with self._cond:
+                self._busy.add(current_thread())
+            try:
+                for chunk in responder:
+                    if not self._buffer(index, member, chunk):
+                        break
+            except Exception as e:
+                member.error = e
+            finally:
+                # Stops the responder's query if it was abandoned
+                close_iterator(responder)
+                with self._cond:
+                    self._busy.discard(current_thread())
+                    member.done = True
+                    self._cond.notify_all()
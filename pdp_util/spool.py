@@ -0,0 +1,104 @@
+"""
+This module provides the decoupling of the database side of a download from the client side: each station responder is drained into a spool as fast as the database can produce it, so that its cursor and connection are released before the client, at its own pace, reads the member back
+"""
+
+from tempfile import SpooledTemporaryFile
+
+from pdp_util.util import close_iterator
+
+DEFAULT_SPOOL_MEMORY = 8 * 1024**2
+READ_SIZE = 64 * 1024
+
+
+def spooled_responders(
+    responders,
+    max_memory=DEFAULT_SPOOL_MEMORY,
+    spill_dir=None,
+    release=None,
+    budget=None,
+):
+    """Generator of (``name``, ``generator``) pairs which drains each responder of ``responders`` completely before handing it on
+
+    Each member is held in memory up to ``max_memory`` bytes, and on disk beyond that. Once a responder is drained it is closed, which is where the pydap handlers give their connection back to the pool, and ``release`` is called, e.g. to end the transaction of a session that the responders share. A member's spool is discarded as soon as it has been read back, or abandoned.
+
+    :param responders: iterable of (``name``, ``generator``) pairs
+    :param max_memory: number of bytes of a member to keep in memory
+    :type max_memory: int
+    :param spill_dir: directory for members that outgrow ``max_memory``, or None for the system's default temporary directory
+    :type spill_dir: str
+    :param release: optional callable, called after each responder has been drained
+    :param budget: optional memory budget of the download, from which the in-memory part of the spool is reserved (and limited to what is available)
+    :type budget: :class:`pdp_util.budget.MemoryBudget`
+    :rtype: iterator
+    """
+    try:
+        for name, chunks in responders:
+            size = max_memory
+            if budget is not None:
+                size = min(size, budget.available)
+                budget.reserve(size)
+            spool = spool_file(size, spill_dir)
+            try:
+                try:
+                    for chunk in chunks:
+                        spool.write(
+                            chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+                        )
+                finally:
+                    close_iterator(chunks)
+                if release is not None:
+                    release()
+                spool.seek(0)
+            except BaseException:
+                discard(spool, size, budget)
+                raise
+            yield name, SpoolReader(spool, size, budget)
+    finally:
+        close_iterator(responders)
+
+
+def spool_file(max_size, spill_dir=None):
+    """A :py:class:`SpooledTemporaryFile` which holds up to ``max_size`` bytes in memory
+
+    A ``max_size`` of 0 would mean no limit at all to :py:class:`SpooledTemporaryFile`; here it means that there is no memory to spare, so the file is on disk from the start.
+
+    :param max_size: number of bytes to keep in memory
+    :type max_size: int
+    :param spill_dir: directory for the file once it is on disk, or None for the system's default temporary directory
+    :type spill_dir: str
+    """
+    spool = SpooledTemporaryFile(max(max_size, 1), dir=spill_dir or None)
+    if max_size <= 0:
+        spool.rollover()
+    return spool
+
+
+class SpoolReader(object):
+    """Iterator over the blocks of a drained member's spool, which is discarded (and its memory given back to the budget) once it has been read, or when it is closed, even if it was never read at all"""
+
+    def __init__(self, spool, size=0, budget=None):
+        self.spool = spool
+        self.size = size
+        self.budget = budget
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.spool.closed:
+            raise StopIteration
+        block = self.spool.read(READ_SIZE)
+        if not block:
+            self.close()
+            raise StopIteration
+        return block
+
+    def close(self):
+        discard(self.spool, self.size, self.budget)
+
+
+def discard(spool, size, budget):
+    if not spool.closed:
+        spool.close()
+        if budget is not None:
+            budget.release(size)
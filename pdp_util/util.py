@@ -1,6 +1,12 @@
+import os
+import re
 from datetime import datetime
+from zipfile import ZIP_STORED, ZIP_DEFLATED
 
 from webob.request import Request
+from webob.response import Response
+from webob.static import FileIter
+from sqlalchemy import func
 
 from pdp_util.filters import form_filters
 from pydap.responses.lib import load_responses
@@ -22,6 +28,46 @@ def get_stn_list(
     :param to_select: A list of ORM columns to select. These columns must be columns
         from the ORM classes CrmpNetworkGeoserver, Station, Network.
     """
+    return stn_list_query(sesh, sql_constraints, to_select).all()
+
+
+def get_stn_count(sesh, sql_constraints):
+    """Count the stations which :func:`get_stn_list` would return, in the database
+
+    :param sesh: The SQLAlchemy database session
+    :type sesh: :py:class:`sqlalchemy.orm.session.Session`
+    :param sql_constraints: A list of filters, as for :func:`get_stn_list`
+    :rtype: int
+    """
+    return stn_list_query(sesh, sql_constraints, [func.count()]).scalar()
+
+
+def get_stn_counts_by(sesh, sql_constraints, column):
+    """Count the stations which :func:`get_stn_list` would return for each value of ``column``, in the database
+
+    :param sesh: The SQLAlchemy database session
+    :type sesh: :py:class:`sqlalchemy.orm.session.Session`
+    :param sql_constraints: A list of filters, as for :func:`get_stn_list`
+    :param column: ORM column by which to break the count down, e.g. ``CrmpNetworkGeoserver.network_name``
+    :rtype: dict mapping each value of ``column`` to its number of stations
+    """
+    q = stn_list_query(sesh, sql_constraints, [column, func.count()]).group_by(column)
+    return dict(q.all())
+
+
+def stn_list_query(
+    sesh,
+    sql_constraints,
+    to_select=[CrmpNetworkGeoserver.network_name, CrmpNetworkGeoserver.native_id],
+):
+    """Build the query behind :func:`get_stn_list`, e.g. to use it as a subquery rather than fetching its rows
+
+    :param sesh: The SQLAlchemy database session
+    :type sesh: :py:class:`sqlalchemy.orm.session.Session`
+    :param sql_constraints: A list of filters, as for :func:`get_stn_list`
+    :param to_select: A list of ORM columns to select, as for :func:`get_stn_list`
+    :rtype: :py:class:`sqlalchemy.orm.query.Query`
+    """
     # to_select must be a list
     if not hasattr(to_select, "__len__"):
         to_select = [to_select]
@@ -33,21 +79,51 @@ def get_stn_list(
     )
     for constraint in sql_constraints:
         q = q.filter(constraint)
-    q = q.filter(Network.publish == True)
+    return q.filter(Network.publish == True)
 
-    return q.all()
 
+def get_extension(environ, extra_formats=()):
+    """Extract the data format extension from request parameters and check that they are supported
 
-def get_extension(environ):
-    """Extract the data format extension from request parameters and check that they are supported"""
+    :param extra_formats: formats which the calling application supports in addition to the pydap responses
+    """
     req = Request(environ)
     form = req.params
-    if form.has_key("data-format") and form["data-format"] in load_responses().keys():
+    if form.has_key("data-format") and (
+        form["data-format"] in load_responses().keys()
+        or form["data-format"] in extra_formats
+    ):
         return form["data-format"]
     else:
         return None
 
 
+compression_methods = {"stored": ZIP_STORED, "deflated": ZIP_DEFLATED}
+
+
+def get_compression(environ):
+    """Extract the requested archive compression method and level from request parameters
+
+    :param environ: WSGI request environment dictionary
+    :rtype: tuple (method, level) where method is one of the :py:mod:`zipfile` compression constants and level is an int. Either is None if not requested.
+    :raises: ValueError if either parameter has an unsupported value
+    """
+    req = Request(environ)
+    form = req.params
+    method, level = None, None
+    if form.has_key("compression"):
+        try:
+            method = compression_methods[form["compression"]]
+        except KeyError:
+            raise ValueError(f"Unsupported compression method {form['compression']}")
+    if form.has_key("compression-level"):
+        level = form["compression-level"]
+        if not re.match(r"^[0-9]$", level):
+            raise ValueError("Compression level must be between 0 and 9")
+        level = int(level)
+    return (method, level)
+
+
 def get_clip_dates(environ):
     """Extract dates from request parameters
 
@@ -67,3 +143,110 @@ def get_clip_dates(environ):
             datetime.strptime(sdate, "%Y/%m/%d") if sdate else None,
             datetime.strptime(edate, "%Y/%m/%d") if edate else None,
         )
+
+
+def file_iterator(environ, f, block_size=64 * 1024):
+    """Return a WSGI response iterable for the open binary file ``f``, using the server's ``wsgi.file_wrapper`` when one is available so that no Python-level copying takes place
+
+    :param environ: WSGI request environment dictionary
+    :param f: open binary file object, which will be closed when the response is
+    :param block_size: size of the blocks to read when no file wrapper is available
+    :type block_size: int
+    """
+    file_wrapper = environ.get("wsgi.file_wrapper")
+    if file_wrapper:
+        return file_wrapper(f, block_size)
+
+    def read_blocks():
+        with f:
+            for block in iter(lambda: f.read(block_size), b""):
+                yield block
+
+    return read_blocks()
+
+
+class ClosingFileIter(FileIter):
+    """A :class:`webob.static.FileIter` which closes its file when it is closed, including when webob answers with no body (``304``, ``416``) and never iterates it"""
+
+    def close(self):
+        self.file.close()
+
+
+def file_response(environ, start_response, f, headers, etag=None, block_size=64 * 1024):
+    """Respond with the open binary file ``f``, with its Content-Length and, if given, a strong ETag, honouring conditional (``If-None-Match``) and byte range (``Range``, ``If-Range``) requests, so that interrupted downloads can be resumed. Complete responses are sent through :func:`file_iterator`.
+
+    :param environ: WSGI request environment dictionary
+    :param start_response: WSGI start_response callable
+    :param f: open binary file object, which will be closed when the response is
+    :param headers: list of (``name``, ``value``) response headers, including the Content-type
+    :param etag: optional entity tag of the file's contents (without quotes)
+    :type etag: str
+    :param block_size: size of the blocks in which a complete response is read when there is no ``wsgi.file_wrapper``
+    :type block_size: int
+    """
+    req = Request(environ)
+    size = os.fstat(f.fileno()).st_size
+    if req.range or req.if_none_match:
+        response = Response(
+            headerlist=list(headers),
+            app_iter=ClosingFileIter(f),
+            conditional_response=True,
+        )
+        response.content_length = size
+        response.accept_ranges = "bytes"
+        if etag:
+            response.etag = etag
+        return response(environ, start_response)
+
+    headers = list(headers) + [
+        ("Content-Length", str(size)),
+        ("Accept-Ranges", "bytes"),
+    ]
+    if etag:
+        headers.append(("ETag", f'"{etag}"'))
+    start_response("200 OK", headers)
+    return file_iterator(environ, f, block_size)
+
+
+def asbool(value):
+    """Interpret a configuration value, which may be a string from a config file, as a boolean"""
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "yes", "on", "y", "t", "1")
+    return bool(value)
+
+
+class ClosingIterator(object):
+    """An iterator over ``iterable`` which calls ``callback`` once it is closed, after closing ``iterable``, whether or not it was ever iterated
+
+    A generator's ``finally`` clause does not run if it is closed before it has started, so this is how resources which are acquired before the iteration are released reliably.
+
+    :param iterable: the iterable to pass through
+    :param callback: callable taking no arguments
+    """
+
+    def __init__(self, iterable, callback):
+        self.iterator = iter(iterable)
+        self.callback = callback
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.iterator)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            close_iterator(self.iterator)
+        finally:
+            self.callback()
+
+
+def close_iterator(iterator):
+    """Close ``iterator`` (e.g. a generator or a WSGI response) if it can be closed, so that whatever it holds is released now rather than when it is garbage collected"""
+    close = getattr(iterator, "close", None)
+    if close is not None:
+        close()
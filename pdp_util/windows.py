@@ -0,0 +1,205 @@
+"""
+This module provides the splitting of long station histories into time windows, so that the PCDS download path can export each station as several bounded members rather than as one unbounded query and response, and the pruning of stations which have no observations at all in the requested time range
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, tuple_
+from dateutil.relativedelta import relativedelta
+
+from pycds import Network, Station, History, ObsCountPerMonthHistory
+
+YEAR = "year"
+
+
+def parse_window(value):
+    """Parse a window setting: ``year`` for one member per calendar year, or a number of rows per member
+
+    :rtype: ``"year"``, int or None
+    """
+    if value is None or value == "":
+        return None
+    if value == YEAR:
+        return YEAR
+    rows = int(value)
+    if rows < 1:
+        raise ValueError(f"Invalid window: {value}")
+    return rows
+
+
+def month_windows(months, window):
+    """Group the months in which a station has observations into windows
+
+    :param months: list of (``month``, ``count``) pairs ordered by month, where ``month`` is the datetime of the start of the month and ``count`` the number of observations in it
+    :param window: ``"year"`` for calendar years, or the number of rows after which to start a new window. Windows are made of whole months, so a window holds at least that many rows (except for the last) and more if a month overflows it.
+    :rtype: list of (``start``, ``end``) datetime pairs, each a half-open interval. The windows are contiguous: a stretch of months without observations belongs to the window before it.
+    """
+    windows = []
+    if window == YEAR:
+        for year in sorted({month.year for month, count in months}):
+            windows.append((datetime(year, 1, 1), datetime(year + 1, 1, 1)))
+        return contiguous(windows)
+
+    start, rows = None, 0
+    for month, count in months:
+        if start is None:
+            start = month
+        rows += count
+        if rows >= window:
+            end = month + relativedelta(months=1)
+            windows.append((start, end))
+            start, rows = None, 0
+    if start is not None:
+        windows.append((start, months[-1][0] + relativedelta(months=1)))
+    return contiguous(windows)
+
+
+def contiguous(windows):
+    """Extend each of ``windows`` up to the start of the next one"""
+    return [
+        (start, windows[i + 1][0] if i + 1 < len(windows) else end)
+        for i, (start, end) in enumerate(windows)
+    ]
+
+
+def get_station_windows(sesh, stns, clip_dates, window):
+    """Compute the time windows of a set of stations from the monthly observation counts in the database, with a single query
+
+    :param sesh: database session
+    :type sesh: sqlalchemy.orm.session.Session
+    :param stns: A list of (``network_name``, ``native_id``) pairs
+    :param clip_dates: pair of datetime.datetime objects (or Nones) representing the start and end times for which data will be returned (inclusive). Months outside this range are disregarded.
+    :param window: ``"year"`` or a number of rows (see :func:`month_windows`)
+    :rtype: dict mapping (``network_name``, ``native_id``) to a list of (``start``, ``end``) pairs. Stations without monthly counts are absent. The counts may be out of date, so the first window of a station should be exported without a start and its last without an end (see :func:`window_constraints`).
+    """
+    month = ObsCountPerMonthHistory.date_trunc
+    q = (
+        monthly_counts_query(
+            sesh,
+            stns,
+            clip_dates,
+            month,
+            func.sum(ObsCountPerMonthHistory.count),
+        )
+        .group_by(Network.name, Station.native_id, month)
+        .order_by(Network.name, Station.native_id, month)
+    )
+
+    months = {}
+    for net, native_id, start, count in q:
+        start = datetime(start.year, start.month, 1)
+        months.setdefault((net, native_id), []).append((start, count or 0))
+    return {stn: month_windows(rows, window) for stn, rows in months.items()}
+
+
+def monthly_counts_query(sesh, stns, clip_dates, *columns):
+    """Query the monthly observation counts of a set of stations which fall within the clip dates, selecting the network name and native id of the station followed by ``columns``"""
+    month = ObsCountPerMonthHistory.date_trunc
+    q = (
+        sesh.query(Network.name, Station.native_id, *columns)
+        .select_from(ObsCountPerMonthHistory)
+        .join(History, History.id == ObsCountPerMonthHistory.history_id)
+        .join(Station, Station.id == History.station_id)
+        .join(Network, Network.id == Station.network_id)
+        .filter(
+            tuple_(Network.name, Station.native_id).in_([tuple(stn) for stn in stns])
+        )
+    )
+    sdate, edate = clip_dates
+    if sdate:
+        q = q.filter(
+            month >= sdate.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        )
+    if edate:
+        q = q.filter(month <= edate)
+    return q
+
+
+def prune_stations(sesh, stns, clip_dates):
+    """Separate the stations which have no observations between the clip dates, so that they need not be queried
+
+    Stations are checked against their monthly observation counts, which are a materialized view and so only as up to date as its last refresh. Observations made since then are not counted, so nothing is pruned unless the clip dates end before the latest month in the view. The counts are by month, so a station with observations in the months of the clip dates is kept, even if they fall just outside of them.
+
+    :param sesh: database session
+    :type sesh: sqlalchemy.orm.session.Session
+    :param stns: A list of (``network_name``, ``native_id``) pairs
+    :param clip_dates: pair of datetime.datetime objects (or Nones) representing the start and end times for which data will be returned (inclusive). Without an end date, nothing is pruned.
+    :rtype: pair of lists (``kept``, ``pruned``) of (``network_name``, ``native_id``) pairs, each in the order of ``stns``
+    """
+    stns = [tuple(stn) for stn in stns]
+    sdate, edate = clip_dates
+    if not edate or not stns:
+        return stns, []
+    # The latest month may be only partly counted
+    latest = sesh.query(func.max(ObsCountPerMonthHistory.date_trunc)).scalar()
+    if latest is None or edate >= latest:
+        return stns, []
+
+    q = (
+        monthly_counts_query(sesh, stns, clip_dates)
+        .filter(ObsCountPerMonthHistory.count > 0)
+        .distinct()
+    )
+    with_data = {tuple(row) for row in q}
+    return (
+        [stn for stn in stns if stn in with_data],
+        [stn for stn in stns if stn not in with_data],
+    )
+
+
+def window_constraints(window, clip_dates, first=False, last=False):
+    """Build the ``station_observations.time`` constraints for one window, clipped to the requested dates
+
+    :param window: (``start``, ``end``) pair, a half-open interval
+    :param clip_dates: pair of datetime.datetime objects (or Nones) representing the inclusive start and end times requested
+    :param first: if True, the window is the first of its station and has no start (other than the requested one), so that it takes in any observations before the months that were counted
+    :type first: bool
+    :param last: if True, the window is the last of its station and has no end (other than the requested one), so that it takes in any observations made since the counts were last refreshed
+    :type last: bool
+    :rtype: list of constraint strings, or None if the window lies outside of the requested dates
+    """
+    bounds = window_bounds(window, clip_dates, first, last)
+    if bounds is None:
+        return None
+    lower, upper, inclusive = bounds
+    qs = []
+    if lower:
+        qs.append(f"station_observations.time>='{lower}'")
+    if upper:
+        op = "<=" if inclusive else "<"
+        qs.append(f"station_observations.time{op}'{upper}'")
+    return qs
+
+
+def window_bounds(window, clip_dates, first=False, last=False):
+    """The time bounds of one window as they are exported, clipped to the requested dates (see :func:`window_constraints`)
+
+    :rtype: (``lower``, ``upper``, ``inclusive``) triple, where ``lower`` is the inclusive start time and ``upper`` the end time, inclusive if ``inclusive`` is True (when it is the requested end) and exclusive otherwise; either is None where the window is open-ended. None if the window lies outside of the requested dates.
+    """
+    start, end = window
+    start = None if first else start
+    end = None if last else end
+    sdate, edate = clip_dates
+    if (sdate and end and end <= sdate) or (edate and start and start > edate):
+        return None
+    lower = max(start, sdate) if start and sdate else start or sdate
+    if end and not (edate and edate < end):
+        return lower, end, False
+    return lower, edate, True
+
+
+def window_name(
+    net, stn, window, extension, clip_dates=(None, None), first=False, last=False
+):
+    """The archive member name for one window of a station, e.g. ``EC_raw/1046332/1046332_20000101-20001231.csv``
+
+    The dates are those of the observations which the member is exported with (see :func:`window_bounds`): an open-ended first or last window is named from its requested date or else ``start`` or ``end``, e.g. ``EC_raw/1046332/1046332_start-19991231.csv``.
+    """
+    bounds = window_bounds(window, clip_dates, first, last)
+    if bounds is None:
+        return None
+    lower, upper, inclusive = bounds
+    upper = upper if inclusive or upper is None else upper - timedelta(days=1)
+    begins = f"{lower:%Y%m%d}" if lower else "start"
+    ends = f"{upper:%Y%m%d}" if upper else "end"
+    return f"{net}/{stn}/{stn}_{begins}-{ends}.{extension}"
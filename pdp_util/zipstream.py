@@ -0,0 +1,389 @@
+"""
+This module provides a ZIP archive writer which streams its output. Archive members are compressed as their content arrives and the archive bytes are yielded in fixed-size blocks, so that neither a member nor the archive ever has to be held in memory (or on disk) in its entirety.
+"""
+
+import struct
+import time
+import zlib
+from collections import deque
+from zipfile import ZIP_STORED, ZIP_DEFLATED
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+DEFAULT_PIECE_SIZE = 1024**2
+DICTIONARY_SIZE = 32 * 1024
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+
+# Header layouts, per section 4.3 of the PKWARE APPNOTE
+LOCAL_HEADER = struct.Struct("<4sHHHHHLLLHH")
+ZIP64_LOCAL_EXTRA = struct.Struct("<HHQQ")
+DATA_DESCRIPTOR64 = struct.Struct("<4sLQQ")
+CENTRAL_HEADER = struct.Struct("<4sHHHHHHLLLHHHHHLL")
+END_OF_CENTRAL_DIR = struct.Struct("<4sHHHHLLH")
+END_OF_CENTRAL_DIR64 = struct.Struct("<4sQHHLLQQQQ")
+END_OF_CENTRAL_DIR64_LOCATOR = struct.Struct("<4sLQL")
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+ZIP64_EXTRA_ID = 1
+
+VERSION_ZIP64 = 45
+CREATE_SYSTEM_UNIX = 3
+
+
+def dos_date_time(date_time):
+    """Pack a (year, month, day, hour, minute, second) tuple into MS-DOS (date, time) fields"""
+    year, month, day, hour, minute, second = date_time[:6]
+    year = max(year, 1980)
+    return (
+        (year - 1980) << 9 | month << 5 | day,
+        hour << 11 | minute << 5 | second // 2,
+    )
+
+
+def get_compressor(compression, compresslevel=None):
+    """Return an object with ``compress()`` and ``flush()`` methods which produces a raw member data stream for the given compression method, or None for stored members"""
+    if compression == ZIP_STORED:
+        return None
+    elif compression == ZIP_DEFLATED:
+        level = zlib.Z_DEFAULT_COMPRESSION if compresslevel is None else compresslevel
+        return zlib.compressobj(level, zlib.DEFLATED, -15)
+    else:
+        raise ValueError(f"Unsupported compression method: {compression}")
+
+
+def compress_piece(data, compresslevel=None, zdict=b""):
+    """Deflate one piece of a member as a byte-aligned, non-final segment of a raw deflate stream
+
+    Segments produced this way can simply be concatenated (and terminated with :func:`final_block`) to form the member's complete deflate stream, which is what allows pieces to be compressed in parallel. Priming the compressor with the preceding 32 KiB of the member (``zdict``) keeps the compression ratio close to that of a single stream. This is a module-level function so that it can be sent to a process pool.
+    """
+    level = zlib.Z_DEFAULT_COMPRESSION if compresslevel is None else compresslevel
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def final_block():
+    """An empty, final deflate block which terminates a stream of :func:`compress_piece` segments"""
+    return zlib.compressobj(0, zlib.DEFLATED, -15).flush()
+
+
+class ZipMember(object):
+    """Bookkeeping for a single archive member: enough to write its local header, its data descriptor and its central directory record, plus the time spent compressing it"""
+
+    def __init__(self, name, compression, offset, date_time):
+        self.name = name.encode("utf-8")
+        self.flags = FLAG_DATA_DESCRIPTOR
+        if not name.isascii():
+            self.flags |= FLAG_UTF8
+        self.compression = compression
+        self.offset = offset
+        self.date, self.time = dos_date_time(date_time)
+        self.crc = 0
+        self.compress_size = 0
+        self.file_size = 0
+        self.compress_time = 0.0
+
+    def local_header(self):
+        # CRC and sizes are unknown until the data has been streamed; they follow
+        # the data in the data descriptor. Whether they will need 8 bytes is
+        # unknown too, so the header always has a ZIP64 extra field (with zero
+        # sizes, as zipfile writes with force_zip64), which tells readers that
+        # go by the local headers alone to expect the 8-byte descriptor.
+        extra = ZIP64_LOCAL_EXTRA.pack(ZIP64_EXTRA_ID, ZIP64_LOCAL_EXTRA.size - 4, 0, 0)
+        return (
+            LOCAL_HEADER.pack(
+                b"PK\x03\x04",
+                VERSION_ZIP64,
+                self.flags,
+                self.compression,
+                self.time,
+                self.date,
+                0,
+                ZIP64_LIMIT,
+                ZIP64_LIMIT,
+                len(self.name),
+                len(extra),
+            )
+            + self.name
+            + extra
+        )
+
+    def data_descriptor(self):
+        return DATA_DESCRIPTOR64.pack(
+            b"PK\x07\x08", self.crc, self.compress_size, self.file_size
+        )
+
+    def central_header(self):
+        extra = []
+        file_size, compress_size, offset = (
+            self.file_size,
+            self.compress_size,
+            self.offset,
+        )
+        if file_size > ZIP64_LIMIT:
+            extra.append(file_size)
+            file_size = ZIP64_LIMIT
+        if compress_size > ZIP64_LIMIT:
+            extra.append(compress_size)
+            compress_size = ZIP64_LIMIT
+        if offset > ZIP64_LIMIT:
+            extra.append(offset)
+            offset = ZIP64_LIMIT
+        if extra:
+            extra = struct.pack(
+                f"<HH{len(extra)}Q", ZIP64_EXTRA_ID, 8 * len(extra), *extra
+            )
+        else:
+            extra = b""
+        # As in the local header, which needs ZIP64 to read its data descriptor
+        version = VERSION_ZIP64
+        return (
+            CENTRAL_HEADER.pack(
+                b"PK\x01\x02",
+                CREATE_SYSTEM_UNIX << 8 | version,
+                version,
+                self.flags,
+                self.compression,
+                self.time,
+                self.date,
+                self.crc,
+                compress_size,
+                file_size,
+                len(self.name),
+                len(extra),
+                0,
+                0,
+                0,
+                0o644 << 16,
+                offset,
+            )
+            + self.name
+            + extra
+        )
+
+
+class ZipStream(object):
+    """A write-only ZIP archive whose bytes are produced incrementally
+
+    Each of the writing methods is a generator which yields blocks of exactly ``block_size`` bytes as they become available. The only exceptions are the very first block, which is flushed as soon as the first local header is written so that the response can get moving, and the last block of the archive. Members are written with data descriptors, so their sizes and checksums need not be known in advance. Those descriptors always have 8-byte (ZIP64) sizes, which every local header announces with a ZIP64 extra field, so that streaming readers can read members of any size; the central directory has ZIP64 records whenever the archive outgrows the classic format.
+
+    Example::
+
+     archive = ZipStream()
+     for name, chunks in members:
+         for block in archive.write(name, chunks):
+             send(block)
+     for block in archive.close():
+         send(block)
+
+    :param block_size: size in bytes of the blocks yielded
+    :type block_size: int
+    :param compression: :py:data:`zipfile.ZIP_DEFLATED` or :py:data:`zipfile.ZIP_STORED`
+    :param compresslevel: zlib compression level (0-9) or None for the zlib default
+    :param date_time: (year, month, day, hour, minute, second) timestamp applied to all members. Defaults to the time at which the archive was created.
+    :param executor: optional :py:class:`concurrent.futures.Executor` (thread or process pool) used to deflate members in pieces of ``piece_size`` bytes in parallel. Members are still written whole and in order, so the result is a regular archive.
+    :param piece_size: size in bytes of the pieces compressed by the executor
+    :type piece_size: int
+    :param max_pending: maximum number of pieces submitted to the executor at once, which bounds the memory used by parallel compression
+    :type max_pending: int
+    :param budget: optional memory budget of the download. Pieces awaiting parallel compression are reserved from it; when it is exhausted, outstanding pieces are written out before any more are submitted.
+    :type budget: :class:`pdp_util.budget.MemoryBudget`
+    """
+
+    def __init__(
+        self,
+        block_size=DEFAULT_BLOCK_SIZE,
+        compression=ZIP_DEFLATED,
+        compresslevel=None,
+        date_time=None,
+        executor=None,
+        piece_size=DEFAULT_PIECE_SIZE,
+        max_pending=8,
+        budget=None,
+    ):
+        get_compressor(compression, compresslevel)  # Fail early on bad settings
+        self.block_size = block_size
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self.date_time = date_time or time.localtime(time.time())[:6]
+        self.executor = executor
+        self.piece_size = piece_size
+        self.max_pending = max_pending
+        self.budget = budget
+        self.members = []
+        self.offset = 0
+        self._buffer = bytearray()
+
+    def write(self, name, chunks):
+        """Add a member to the archive, compressing its content as it is iterated
+
+        :param name: name of the member within the archive
+        :type name: str
+        :param chunks: iterable of bytes (or str, which is UTF-8 encoded) making up the member's content
+        :rtype: iterator of bytes
+        """
+        member = ZipMember(name, self.compression, self.offset, self.date_time)
+        self._write(member.local_header())
+        if not self.members:
+            yield from self.flush()
+
+        if self.executor and self.compression == ZIP_DEFLATED:
+            yield from self._write_parallel(member, chunks)
+        else:
+            yield from self._write_serial(member, chunks)
+        self._write(member.data_descriptor())
+        self.members.append(member)
+        yield from self._full_blocks()
+
+    def _write_serial(self, member, chunks):
+        compressor = get_compressor(self.compression, self.compresslevel)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            view = memoryview(chunk)
+            # Feed large chunks in pieces so that the buffered output stays bounded
+            for i in range(0, len(view), self.block_size):
+                piece = view[i : i + self.block_size]
+                t0 = time.perf_counter()
+                member.crc = zlib.crc32(piece, member.crc)
+                member.file_size += len(piece)
+                data = compressor.compress(piece) if compressor else piece
+                member.compress_time += time.perf_counter() - t0
+                member.compress_size += len(data)
+                self._write(data)
+                yield from self._full_blocks()
+
+        if compressor:
+            t0 = time.perf_counter()
+            data = compressor.flush()
+            member.compress_time += time.perf_counter() - t0
+            member.compress_size += len(data)
+            self._write(data)
+
+    def _write_parallel(self, member, chunks):
+        pending = deque()
+        piece = bytearray()
+        zdict = b""
+
+        def reserve(size):
+            if self.budget is None:
+                return
+            if not self.budget.try_reserve(size):
+                # Compress less concurrently rather than exceed the budget
+                if pending:
+                    self.budget.record_throttle()
+                    yield from write_completed(0)
+                self.budget.reserve(size)
+
+        def submit(data):
+            nonlocal zdict
+            t0 = time.perf_counter()
+            member.crc = zlib.crc32(data, member.crc)
+            member.file_size += len(data)
+            future = self.executor.submit(
+                compress_piece, data, self.compresslevel, zdict
+            )
+            pending.append((future, len(data)))
+            zdict = data[-DICTIONARY_SIZE:]
+            member.compress_time += time.perf_counter() - t0
+
+        def write_completed(limit):
+            while len(pending) > limit:
+                future, size = pending.popleft()
+                # Waiting for the executor is the part of the compression that
+                # the request actually pays for
+                t0 = time.perf_counter()
+                data = future.result()
+                member.compress_time += time.perf_counter() - t0
+                if self.budget is not None:
+                    self.budget.release(size)
+                member.compress_size += len(data)
+                self._write(data)
+                yield from self._full_blocks()
+
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                piece += chunk
+                while len(piece) >= self.piece_size:
+                    yield from reserve(self.piece_size)
+                    submit(bytes(piece[: self.piece_size]))
+                    del piece[: self.piece_size]
+                    yield from write_completed(self.max_pending)
+            if piece:
+                yield from reserve(len(piece))
+                submit(bytes(piece))
+            yield from write_completed(0)
+        finally:
+            if self.budget is not None:
+                self.budget.release(sum(size for future, size in pending))
+
+        data = final_block()
+        member.compress_size += len(data)
+        self._write(data)
+
+    def close(self):
+        """Write the central directory and the end of archive records, and yield whatever remains buffered
+
+        :rtype: iterator of bytes
+        """
+        cd_offset = self.offset
+        for member in self.members:
+            self._write(member.central_header())
+            yield from self._full_blocks()
+        cd_size = self.offset - cd_offset
+        count = len(self.members)
+
+        if count > ZIP_FILECOUNT_LIMIT or max(cd_offset, cd_size) > ZIP64_LIMIT:
+            eocd64_offset = self.offset
+            self._write(
+                END_OF_CENTRAL_DIR64.pack(
+                    b"PK\x06\x06",
+                    END_OF_CENTRAL_DIR64.size - 12,
+                    CREATE_SYSTEM_UNIX << 8 | VERSION_ZIP64,
+                    VERSION_ZIP64,
+                    0,
+                    0,
+                    count,
+                    count,
+                    cd_size,
+                    cd_offset,
+                )
+            )
+            self._write(
+                END_OF_CENTRAL_DIR64_LOCATOR.pack(b"PK\x06\x07", 0, eocd64_offset, 1)
+            )
+        self._write(
+            END_OF_CENTRAL_DIR.pack(
+                b"PK\x05\x06",
+                0,
+                0,
+                min(count, ZIP_FILECOUNT_LIMIT),
+                min(count, ZIP_FILECOUNT_LIMIT),
+                min(cd_size, ZIP64_LIMIT),
+                min(cd_offset, ZIP64_LIMIT),
+                0,
+            )
+        )
+        yield from self._full_blocks()
+        yield from self.flush()
+
+    def flush(self):
+        """Yield everything that is buffered, regardless of the block size"""
+        if self._buffer:
+            block = bytes(self._buffer)
+            self._buffer.clear()
+            yield block
+
+    def _write(self, data):
+        self._buffer += data
+        self.offset += len(data)
+
+    def _full_blocks(self):
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[: self.block_size])
+            del self._buffer[: self.block_size]
+            yield block
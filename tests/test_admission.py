@@ -0,0 +1,243 @@
+import time
+from threading import Thread
+from wsgiref.util import FileWrapper
+from io import BytesIO
+
+import pytest
+from webob.request import Request
+
+from pdp_util.admission import (
+    AdmissionController,
+    AdmissionRejected,
+    AdmissionApp,
+    client_id,
+)
+
+
+def test_global_and_per_client_limits():
+    controller = AdmissionController(max_active=3, max_per_client=2, queue_timeout=0)
+    a1 = controller.acquire("a", 1)
+    controller.acquire("a", 1)
+    with pytest.raises(AdmissionRejected):
+        controller.acquire("a", 1)
+    controller.acquire("b", 1)
+    with pytest.raises(AdmissionRejected):
+        controller.acquire("c", 1)
+    controller.release(a1)
+    controller.acquire("c", 1)
+    assert len(controller.active) == 3
+    assert controller.waiting == []
+
+
+def test_load_limit():
+    controller = AdmissionController(max_load=100, queue_timeout=0)
+    big = controller.acquire("a", 1000)  # Admitted alone despite its size
+    with pytest.raises(AdmissionRejected):
+        controller.acquire("b", 1)
+    controller.release(big)
+    controller.acquire("b", 60)
+    with pytest.raises(AdmissionRejected) as e:
+        controller.acquire("c", 50)
+    assert e.value.retry_after == controller.retry_after
+    controller.acquire("c", 40)
+
+
+def test_waiting_requests_are_admitted_in_order():
+    controller = AdmissionController(max_active=1, queue_timeout=5)
+    first = controller.acquire("a", 1)
+    admitted = []
+
+    def wait(client):
+        ticket = controller.acquire(client, 1)
+        admitted.append(client)
+        controller.release(ticket)
+
+    threads = []
+    for client in ("b", "c"):
+        threads.append(Thread(target=wait, args=(client,)))
+        threads[-1].start()
+        time.sleep(0.05)
+    assert len(controller.waiting) == 2
+    controller.release(first)
+    for thread in threads:
+        thread.join()
+    assert admitted == ["b", "c"]
+
+
+def test_queue_length_limit():
+    controller = AdmissionController(max_active=1, max_queued=0, queue_timeout=5)
+    controller.acquire("a", 1)
+    t0 = time.time()
+    with pytest.raises(AdmissionRejected):
+        controller.acquire("b", 1)
+    assert time.time() - t0 < 1
+
+
+def test_client_id():
+    environ = {"REMOTE_ADDR": "10.0.0.1", "HTTP_X_FORWARDED_FOR": "1.2.3.4, 10.0.0.1"}
+    assert client_id(environ) == "10.0.0.1"
+    assert client_id(environ, "X-Forwarded-For") == "1.2.3.4"
+    assert client_id({"REMOTE_ADDR": "10.0.0.1"}, "X-Forwarded-For") == "10.0.0.1"
+
+
+def test_admission_app(test_session):
+    def app(environ, start_response):
+        start_response("200 OK", [("Content-type", "application/zip")])
+        return iter([b"PK", b"data"])
+
+    controller = AdmissionController(max_active=1, queue_timeout=0)
+    admission = AdmissionApp(app, None, controller)
+
+    req = Request.blank("", {"sesh": test_session})
+    body = req.get_response(admission).app_iter
+    assert len(controller.active) == 1
+
+    # The slot is held until the first response is finished
+    resp = Request.blank("", {"sesh": test_session}).get_response(admission)
+    assert resp.status_int == 503
+    assert resp.headers["Retry-After"] == str(controller.retry_after)
+
+    assert b"".join(body) == b"PKdata"
+    assert controller.active == []
+    resp = Request.blank("", {"sesh": test_session}).get_response(admission)
+    assert resp.status_int == 200
+
+
+def test_unstarted_response_releases_its_slot():
+    controller = AdmissionController(max_active=1, queue_timeout=0)
+    admission = AdmissionApp(None, None, controller)
+    body = (block for block in [b"PK"])
+    response = admission.released(body, controller.acquire("a", 1))
+    iter(response)
+    # The server gives up before asking for the first block
+    response.close()
+    assert controller.active == []
+    response.close()
+    assert controller.acquire("b", 1)
+
+
+def test_requests_which_do_not_build_skip_admission():
+    class App(object):
+        def builds(self, environ):
+            return "build" in environ["QUERY_STRING"]
+
+        def __call__(self, environ, start_response):
+            start_response("200 OK", [("Content-type", "application/zip")])
+            return [b"PK"]
+
+    def no_session():
+        raise AssertionError("Cached downloads need no estimate")
+
+    controller = AdmissionController(max_active=1, queue_timeout=0)
+    controller.acquire("a", 1)
+    admission = AdmissionApp(App(), no_session, controller)
+    assert Request.blank("?cached").get_response(admission).status_int == 200
+    with pytest.raises(AssertionError):
+        Request.blank("?build").get_response(admission)
+
+
+def test_file_wrapper_response_is_passed_through():
+    controller = AdmissionController(max_active=1, queue_timeout=0)
+    admission = AdmissionApp(None, None, controller)
+    body = FileWrapper(BytesIO(b"PK"))
+    response = admission.released(
+        body, controller.acquire("a", 1), {"wsgi.file_wrapper": FileWrapper}
+    )
+    # The server must still see its own wrapper, to use sendfile
+    assert response is body
+    assert controller.active == []
+
+
+def admit_in_background(controller, requests):
+    admitted = []
+
+    def wait(client, cost):
+        ticket = controller.acquire(client, cost)
+        admitted.append(cost)
+        controller.release(ticket)
+
+    threads = []
+    for client, cost in requests:
+        threads.append(Thread(target=wait, args=(client, cost)))
+        threads[-1].start()
+        time.sleep(0.05)
+    return admitted, threads
+
+
+def test_shortest_job_first():
+    controller = AdmissionController(
+        max_active=1, max_per_client=10, queue_timeout=5, scheduling="sjf"
+    )
+    first = controller.acquire("a", 1)
+    admitted, threads = admit_in_background(
+        controller, [("b", 100), ("c", 10), ("d", 50)]
+    )
+    controller.release(first)
+    for thread in threads:
+        thread.join()
+    assert admitted == [10, 50, 100]
+
+
+def test_aging():
+    controller = AdmissionController(scheduling="sjf", aging=10)
+    big = controller.acquire("a", 1000)
+    small = controller.acquire("b", 10)
+    now = big.queued
+    assert controller.rank(small, now) < controller.rank(big, now)
+    # After 100s, the big download has the rank of a 1000 / 2**10 record one
+    assert controller.rank(big, now + 100) < controller.rank(small, now)
+
+
+def test_large_download_is_not_starved():
+    controller = AdmissionController(
+        max_active=1, max_per_client=100, queue_timeout=2, scheduling="sjf"
+    )
+    admitted = []
+
+    def download(client, cost, hold):
+        try:
+            ticket = controller.acquire(client, cost)
+        except AdmissionRejected:
+            return
+        admitted.append(cost)
+        time.sleep(hold)
+        controller.release(ticket)
+
+    first = controller.acquire("first", 1)
+    big = Thread(target=download, args=("big", 1000000, 0))
+    big.start()
+    # A steady stream of small downloads, faster than they are served, so
+    # that some are always waiting whenever the slot comes free
+    small = []
+    deadline = time.monotonic() + 2.5
+    while time.monotonic() < deadline:
+        small.append(Thread(target=download, args=(f"s{len(small)}", 10, 0.05)))
+        small[-1].start()
+        if first:
+            time.sleep(0.05)
+            controller.release(first)
+            first = None
+        time.sleep(0.02)
+    big.join()
+    for thread in small:
+        thread.join()
+    assert 1000000 in admitted
+
+
+def test_no_overtaking_a_download_held_back_by_load():
+    controller = AdmissionController(max_load=100, queue_timeout=5)
+    first = controller.acquire("a", 50)
+    admitted, threads = admit_in_background(controller, [("b", 80)])
+    # The small download would fit, but must not overtake the waiting one
+    controller.queue_timeout = 0.1
+    with pytest.raises(AdmissionRejected):
+        controller.acquire("c", 10)
+    controller.release(first)
+    for thread in threads:
+        thread.join()
+    assert admitted == [80]
+
+
+def test_bad_scheduling_policy():
+    with pytest.raises(ValueError):
+        AdmissionController(scheduling="lifo")
@@ -2,18 +2,32 @@ import os
 from datetime import datetime
 from random import random
 from tempfile import NamedTemporaryFile
-from zipfile import ZipFile
+from io import BytesIO
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from concurrent.futures import ThreadPoolExecutor
 from collections import Counter
+from itertools import chain
 
 from webob.request import Request
 
 import pdp_util
+from pdp_util.budget import MemoryBudget
+from pdp_util.cache import ArchiveCache, MemoryCache
+from pdp_util.instrument import Instrumentation
+from pdp_util.failures import MemberFailure
+from pdp_util.spool import spool_file
 from pdp_util.agg import (
     PcdsZipApp,
+    DETERMINISTIC_DATE_TIME,
     ziperator,
+    streaming_ziperator,
+    cancel_when_abandoned,
+    close_when_done,
+    get_pruned_responders,
     get_pcds_responders,
     metadata_index_responder,
     get_all_metadata_index_responders,
+    get_network_variables,
 )
 
 # import pydap.handlers.pcic
@@ -49,6 +63,35 @@ def test_metadata_index_responder(test_session):
         assert line in str(response_text)
 
 
+def test_metadata_index_responder_layout(test_session):
+    # The layout of the pydap ASCII response which used to produce these files
+    response_text = b"".join(metadata_index_responder(test_session, "FLNRO-WMB"))
+    assert response_text.startswith(
+        b"Dataset {\n    Sequence {\n        String variable;\n"
+    )
+    assert b"} Variable%20metadata;\n" + 45 * b"-" + b"\n" in response_text
+    assert response_text.endswith(b"\n\n")
+
+
+def test_get_network_variables(test_session):
+    cache = MemoryCache()
+    networks = ["ARDA", "EC_raw", "FLNRO-WMB", "nonexistent"]
+    variables = get_network_variables(test_session, networks, False, cache)
+    assert set(variables) == set(networks)
+    assert variables["nonexistent"] == []
+    for network in networks[:3]:
+        assert variables[network]
+        assert (
+            variables[network]
+            == get_network_variables(test_session, [network])[network]
+        )
+    # Everything is cached now, so no session is needed
+    assert get_network_variables(None, networks, False, cache) == variables
+    # ... but climatologies are cached separately
+    with pytest.raises(AttributeError):
+        get_network_variables(None, networks, True, cache)
+
+
 @pytest.mark.parametrize(
     "stations, expected_filenames",
     [
@@ -75,11 +118,11 @@ def test_get_all_metadata_index_responders(
     expected_filenames,
 ):
     # Content is tested elsewhere. Fake it out.
-    def fake_metadata_index_responder(sesh, net, climo):
-        return []
+    def fake_get_network_variables(sesh, networks, climo, cache):
+        return {network: [] for network in networks}
 
     monkeypatch.setattr(
-        pdp_util.agg, "metadata_index_responder", fake_metadata_index_responder
+        pdp_util.agg, "get_network_variables", fake_get_network_variables
     )
 
     resp = get_all_metadata_index_responders(test_session, stations, False)
@@ -117,7 +160,45 @@ def test_get_pcds_responders(conn_params, monkeypatch):
         assert str(now) in env["QUERY_STRING"]
 
 
-def test_ziperator():
+def test_get_pcds_responders_windows(conn_params, monkeypatch):
+    monkeypatch.setattr(
+        pydap_extras.handlers.pcic.PcicSqlHandler, "__call__", lambda x, y, z: y
+    )
+
+    windows = {
+        ("ARDA", "115084"): [
+            (datetime(2000, 1, 1), datetime(2001, 1, 1)),
+            (datetime(2001, 1, 1), datetime(2002, 1, 1)),
+        ]
+    }
+    clip_dates = (datetime(2000, 6, 1), None)
+    response = list(
+        get_pcds_responders(conn_params, stns[:2], "csv", clip_dates, {}, None, windows)
+    )
+
+    assert [name for name, env in response] == [
+        # The first window starts at the requested date, the last is open
+        "ARDA/115084/115084_20000601-20001231.csv",
+        "ARDA/115084/115084_20010101-end.csv",
+        "ARDA/112073.csv",
+    ]
+    assert [env["PATH_INFO"] for name, env in response] == [
+        "/ARDA/115084.rsql.csv",
+        "/ARDA/115084.rsql.csv",
+        "/ARDA/112073.rsql.csv",
+    ]
+    assert response[0][1]["QUERY_STRING"] == (
+        "station_observations.time>='2000-06-01 00:00:00'"
+        "&station_observations.time<'2001-01-01 00:00:00'"
+    )
+    # The last window takes in anything after the counted months
+    assert response[1][1]["QUERY_STRING"] == (
+        "station_observations.time>='2001-01-01 00:00:00'"
+    )
+
+
+@pytest.mark.parametrize("ziperator", [ziperator, streaming_ziperator])
+def test_ziperator(ziperator):
     random_content = lambda: [str(random()) + "\n" for x in range(10)]
     files = {
         "file0.txt": random_content(),
@@ -149,3 +230,318 @@ def test_ziperator():
                     assert x.read() == b"".join([line.encode() for line in content])
 
         os.remove(f.name)
+
+
+@pytest.mark.parametrize("ziperator", [ziperator, streaming_ziperator])
+def test_ziperator_memory_budget(ziperator):
+    budget = MemoryBudget(1024**2)
+    content = [str(random()) for x in range(100000)]
+    result = b"".join(ziperator([("file.txt", iter(content))], budget=budget))
+    with ZipFile(BytesIO(result)) as z:
+        assert z.read("file.txt") == "".join(content).encode()
+    assert budget.used == 0
+    assert budget.overrun == 0
+
+
+def test_ziperator_exhausted_budget(monkeypatch):
+    spools = []
+
+    def recording_spool_file(max_size):
+        spools.append(spool_file(max_size))
+        return spools[-1]
+
+    monkeypatch.setattr(pdp_util.agg, "spool_file", recording_spool_file)
+    budget = MemoryBudget(1024)
+    budget.reserve(1024)
+    content = [str(random()) for x in range(1000)]
+    result = b"".join(ziperator([("file.txt", iter(content))], budget=budget))
+    assert spools[0]._rolled
+    with ZipFile(BytesIO(result)) as z:
+        assert z.read("file.txt") == "".join(content).encode()
+    assert budget.used == 1024
+
+
+@pytest.mark.parametrize("ziperator", [ziperator, streaming_ziperator])
+def test_ziperator_instrumentation(ziperator):
+    events = []
+    instrument = Instrumentation(lambda event, stats: events.append((event, stats)))
+    responders = instrument.timed_responders(
+        [("a.csv", iter(["x,y\n"] * 1000)), ("b.csv", iter([]))], count_rows=True
+    )
+    list(ziperator(responders, instrument=instrument))
+
+    members = {stats["name"]: stats for event, stats in events}
+    assert members["a.csv"]["rows"] == 1000
+    assert members["a.csv"]["raw_bytes"] == 4000
+    assert 0 < members["a.csv"]["compressed_bytes"] < 4000
+    assert members["b.csv"]["raw_bytes"] == 0
+
+
+@pytest.mark.parametrize("ziperator", [ziperator, streaming_ziperator])
+def test_abandoned_download_is_cancelled(ziperator):
+    state = {}
+
+    def content(i):
+        state[i] = "started"
+        try:
+            for x in range(1000):
+                yield str(random()) * 1000
+        finally:
+            state[i] = "closed"
+
+    def responders():
+        for i in range(10):
+            yield f"file{i}.txt", content(i)
+
+    source = responders()
+    archive = cancel_when_abandoned(ziperator(source), source)
+    for i, block in enumerate(archive):
+        if i == 3:
+            break
+    archive.close()
+    assert source.gi_frame is None
+    assert 0 < len(state) < 10
+    assert set(state.values()) == {"closed"}
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_abandoned_download_closes_sessions(monkeypatch):
+    cancelled = []
+    monkeypatch.setattr(pdp_util.agg, "cancel_query", cancelled.append)
+    lookup, data = FakeSession(), FakeSession()
+    # The data session's responders are never reached
+    data_responders = close_when_done(data, iter([("data.csv", [b"x"])]))
+    source = chain([("first.txt", [str(random()) * 100000])], data_responders)
+    archive = cancel_when_abandoned(ziperator(source), source, [lookup, data])
+    next(archive)
+    archive.close()
+    assert cancelled == [lookup, data]
+    assert lookup.closed and data.closed
+
+    # A finished download closes its sessions without cancelling anything
+    cancelled.clear()
+    data = FakeSession()
+    archive = cancel_when_abandoned(ziperator(iter([])), iter([]), [data])
+    list(archive)
+    assert cancelled == [] and data.closed
+
+
+@pytest.mark.parametrize("ziperator", [ziperator, streaming_ziperator])
+def test_ziperator_deterministic(ziperator):
+    def build():
+        responders = [("a.csv", iter([b"1,2\n"])), ("b.csv", iter([b"3,4\n"]))]
+        return b"".join(ziperator(responders, date_time=DETERMINISTIC_DATE_TIME))
+
+    first = build()
+    assert build() == first
+    with ZipFile(BytesIO(first)) as z:
+        assert z.testzip() is None
+        assert z.getinfo("b.csv").date_time == DETERMINISTIC_DATE_TIME
+
+
+def test_get_pruned_responders():
+    assert list(get_pruned_responders([])) == []
+    [(name, content)] = get_pruned_responders([("ARDA", "115084"), ("EC", "1")])
+    assert name == "stations_without_data.csv"
+    assert b"".join(content) == b"network_name,native_id\nARDA,115084\nEC,1\n"
+
+
+def test_streaming_ziperator_block_size():
+    responders = [("file.txt", (str(random()) for x in range(10000)))]
+    blocks = list(streaming_ziperator(responders, block_size=1024))
+    assert all(len(block) == 1024 for block in blocks[1:-1])
+
+
+@pytest.mark.parametrize("compression", [ZIP_STORED, ZIP_DEFLATED])
+def test_streaming_ziperator_compression(compression):
+    content = [str(random()) for x in range(1000)]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        result = b"".join(
+            streaming_ziperator(
+                [("file.txt", iter(content))],
+                compression=compression,
+                compresslevel=1,
+                executor=executor,
+            )
+        )
+    with ZipFile(BytesIO(result)) as z:
+        assert z.getinfo("file.txt").compress_type == compression
+        assert z.read("file.txt") == "".join(content).encode()
+
+
+def test_cached_download(conn_params, test_session, monkeypatch, tmp_path):
+    def fake_pcds_responders(dsn, stns, extension, *args):
+        for net, stn in stns:
+            yield f"{net}/{stn}.{extension}", [f"{net},{stn}\n"]
+
+    monkeypatch.setattr(pdp_util.agg, "get_pcds_responders", fake_pcds_responders)
+    cache = ArchiveCache(str(tmp_path))
+    app = PcdsZipApp(conn_params, test_session, cache=cache)
+    url = "?data-format=csv&network-name=EC_raw"
+
+    first = Request.blank(url).get_response(app)
+    assert first.status == "200 OK"
+
+    # A hit must not touch the database at all
+    def fail(*args):
+        raise AssertionError("get_stn_list should not be called on a cache hit")
+
+    monkeypatch.setattr(pdp_util.agg, "get_stn_list", fail)
+    assert not app.builds(Request.blank(url).environ)
+    assert app.builds(Request.blank(url + "&input-freq=daily").environ)
+    second = Request.blank(url).get_response(app)
+    assert second.status == "200 OK"
+    assert second.content_length == len(first.body)
+    assert second.body == first.body
+    assert second.etag
+
+    # A resumed download only fetches the rest
+    rest = Request.blank(
+        url, headers={"Range": "bytes=100-", "If-Range": f'"{second.etag}"'}
+    ).get_response(app)
+    assert rest.status_int == 206
+    assert rest.body == first.body[100:]
+
+    # A different selection is a miss
+    with pytest.raises(AssertionError):
+        Request.blank(url + "&input-freq=daily").get_response(app)
+
+
+def test_resume_across_rebuild(conn_params, test_session, monkeypatch, tmp_path):
+    build = ["first"]
+
+    def fake_pcds_responders(dsn, stns, extension, *args):
+        for net, stn in stns:
+            yield f"{net}/{stn}.{extension}", [f"{net},{stn},{build[0]}\n"]
+
+    monkeypatch.setattr(pdp_util.agg, "get_pcds_responders", fake_pcds_responders)
+    cache = ArchiveCache(str(tmp_path))
+    app = PcdsZipApp(conn_params, test_session, cache=cache)
+    url = "?data-format=csv&network-name=EC_raw"
+    Request.blank(url).get_response(app)
+    first = Request.blank(url).get_response(app)
+    assert first.etag
+
+    # The archive is rebuilt with other contents
+    build[0] = "second"
+    cache.invalidate()
+    Request.blank(url).get_response(app)
+
+    # Resuming with the first build's tag gets the whole of the second
+    resumed = Request.blank(
+        url, headers={"Range": "bytes=100-", "If-Range": f'"{first.etag}"'}
+    ).get_response(app)
+    assert resumed.status_int == 200
+    assert resumed.etag != first.etag
+    assert resumed.body != first.body
+    with ZipFile(BytesIO(resumed.body)) as z:
+        assert all(
+            z.read(name).endswith(b",second\n")
+            for name in z.namelist()
+            if not name.endswith("variables.csv")
+        )
+
+
+def test_pruned_network_keeps_its_variables(conn_params, test_session, monkeypatch):
+    def fake_pcds_responders(dsn, stns, extension, *args):
+        for net, stn in stns:
+            yield f"{net}/{stn}.{extension}", [f"{net},{stn}\n"]
+
+    monkeypatch.setattr(pdp_util.agg, "get_pcds_responders", fake_pcds_responders)
+    monkeypatch.setattr(
+        pdp_util.agg, "prune_stations", lambda sesh, stns, clip_dates: ([], stns)
+    )
+    app = PcdsZipApp(conn_params, test_session, prune=True)
+    response = Request.blank("?data-format=csv&network-name=EC_raw").get_response(app)
+    assert response.status == "200 OK"
+    with ZipFile(BytesIO(response.body)) as z:
+        names = z.namelist()
+        assert "EC_raw/variables.csv" in names
+        assert "stations_without_data.csv" in names
+        assert not [name for name in names if name.startswith("EC_raw/")][1:]
+
+
+def test_archive_with_failures_is_not_cached(
+    conn_params, test_session, monkeypatch, tmp_path
+):
+    def failing_pcds_responders(dsn, stns, extension, clip_dates, environ, *args):
+        failures = args[2]
+        for net, stn in stns:
+            failures.append(MemberFailure(f"{net}/{stn}.{extension}", IOError(), 3))
+        return iter([])
+
+    monkeypatch.setattr(pdp_util.agg, "get_pcds_responders", failing_pcds_responders)
+    cache = ArchiveCache(str(tmp_path))
+    app = PcdsZipApp(conn_params, test_session, cache=cache, retries=2)
+    response = Request.blank("?data-format=csv&network-name=EC_raw").get_response(app)
+    assert response.status == "200 OK"
+    with ZipFile(BytesIO(response.body)) as z:
+        assert "errors.txt" in z.namelist()
+    assert cache.size() == 0
+
+
+def test_table_format(conn_params, test_session, monkeypatch):
+    used = []
+
+    def fake_pcds_responders(dsn, stns, extension, *args):
+        used.append("pydap")
+        return iter([])
+
+    def fake_copy_responders(sesh, stns, clip_dates, climo, batch_size, since=None):
+        used.append("copy")
+        return iter([])
+
+    monkeypatch.setattr(pdp_util.agg, "get_pcds_responders", fake_pcds_responders)
+    monkeypatch.setattr(pdp_util.agg, "get_copy_responders", fake_copy_responders)
+    url = "?network-name=EC_raw&data-format="
+
+    # The table format is only offered with direct extraction
+    app = PcdsZipApp(conn_params, test_session)
+    assert Request.blank(url + "table").get_response(app).status_int == 400
+
+    # ... which leaves the layout of CSV downloads alone
+    app = PcdsZipApp(conn_params, test_session, copy=True)
+    assert Request.blank(url + "csv").get_response(app).status_int == 200
+    assert used == ["pydap"]
+    assert Request.blank(url + "table").get_response(app).status_int == 200
+    assert used == ["pydap", "copy"]
+    since = "&since=2020/01/01"
+    assert Request.blank(url + "csv" + since).get_response(app).status_int == 400
+
+
+def test_archive_closes_its_sessions(monkeypatch):
+    sessions = []
+
+    def new_session(self):
+        sessions.append(FakeSession())
+        return sessions[-1]
+
+    monkeypatch.setattr(PcdsZipApp, "session", property(new_session))
+    monkeypatch.setattr(pdp_util.agg, "get_stn_list", lambda sesh, filters: [])
+    cancelled = []
+    monkeypatch.setattr(pdp_util.agg, "cancel_query", cancelled.append)
+    app = PcdsZipApp("postgresql://nowhere")
+    args = ({}, [], (None, None), "csv", False, ZIP_DEFLATED, None, None, None)
+
+    # Closed without ever being iterated
+    app.archive(*args).close()
+    assert sessions and all(sesh.closed for sesh in sessions)
+    assert cancelled == []
+
+    # Failing to build the archive
+    def fail(sesh, filters):
+        raise IOError("lost connection")
+
+    monkeypatch.setattr(pdp_util.agg, "get_stn_list", fail)
+    sessions.clear()
+    with pytest.raises(IOError):
+        app.archive(*args)
+    assert sessions and all(sesh.closed for sesh in sessions)
+    assert cancelled == sessions
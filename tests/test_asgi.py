@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from pdp_util.asgi import AsyncPcdsZipApp, asgi_environ, MAX_BODY_SIZE
+
+
+def make_scope(method="POST", path="/agg/", query_string=b""):
+    return {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query_string,
+        "headers": [
+            (b"content-type", b"application/x-www-form-urlencoded"),
+            (b"x-forwarded-for", b"10.0.0.1"),
+        ],
+        "client": ("127.0.0.1", 5000),
+        "server": ("testserver", 80),
+    }
+
+
+class BlockApp(object):
+    """A WSGI app which streams numbered blocks and records its progress"""
+
+    def __init__(self, n):
+        self.n = n
+        self.produced = 0
+        self.closed = False
+        self.environ = None
+
+    def __call__(self, environ, start_response):
+        self.environ = environ
+        start_response("200 OK", [("Content-type", "application/zip")])
+        return self.blocks()
+
+    def blocks(self):
+        try:
+            for i in range(self.n):
+                self.produced += 1
+                yield bytes([i]) * 10
+        finally:
+            self.closed = True
+
+
+def run(app, scope, body=b"", disconnect_after=None, on_send=None):
+    messages = []
+    incoming = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        while not incoming:
+            if disconnect_after is not None and len(messages) >= disconnect_after:
+                return {"type": "http.disconnect"}
+            await asyncio.sleep(0.01)
+        return incoming.pop(0)
+
+    async def send(message):
+        messages.append(message)
+        if on_send:
+            on_send(message)
+        await asyncio.sleep(0.001)
+
+    asyncio.run(app(scope, receive, send))
+    return messages
+
+
+def test_asgi_environ():
+    environ = asgi_environ(make_scope(query_string=b"a=1"), b"data-format=csv")
+    assert environ["REQUEST_METHOD"] == "POST"
+    assert environ["QUERY_STRING"] == "a=1"
+    assert environ["CONTENT_TYPE"] == "application/x-www-form-urlencoded"
+    assert environ["CONTENT_LENGTH"] == "15"
+    assert environ["HTTP_X_FORWARDED_FOR"] == "10.0.0.1"
+    assert environ["wsgi.input"].read() == b"data-format=csv"
+    # PEP 3333 requires a text stream
+    environ["wsgi.errors"].write("")
+
+
+def test_streams_response():
+    wsgi_app = BlockApp(5)
+    messages = run(AsyncPcdsZipApp(wsgi_app, workers=2), make_scope(), b"x=1")
+    assert messages[0]["type"] == "http.response.start"
+    assert messages[0]["status"] == 200
+    assert (b"content-type", b"application/zip") in messages[0]["headers"]
+    body = [message["body"] for message in messages[1:]]
+    assert b"".join(body) == b"".join(bytes([i]) * 10 for i in range(5))
+    assert messages[-1].get("more_body", False) is False
+    assert wsgi_app.environ["wsgi.input"].read() == b"x=1"
+    assert wsgi_app.closed
+
+
+def test_backpressure():
+    wsgi_app = BlockApp(20)
+    progress = []
+    run(
+        AsyncPcdsZipApp(wsgi_app, workers=2),
+        make_scope(),
+        on_send=lambda message: progress.append(wsgi_app.produced),
+    )
+    # Never more than one block is produced ahead of the one being sent
+    assert all(produced <= sent + 1 for sent, produced in enumerate(progress))
+
+
+def test_client_disconnect_abandons_download():
+    wsgi_app = BlockApp(10000)
+    messages = run(AsyncPcdsZipApp(wsgi_app), make_scope(), disconnect_after=3)
+    assert wsgi_app.produced < 10000
+    assert wsgi_app.closed
+    assert messages[-1].get("more_body")
+
+
+def test_request_too_large():
+    wsgi_app = BlockApp(1)
+    messages = run(AsyncPcdsZipApp(wsgi_app), make_scope(), b"x" * (MAX_BODY_SIZE + 1))
+    assert messages[0]["status"] == 413
+    assert wsgi_app.environ is None
+
+
+def test_unsupported_scope():
+    with pytest.raises(ValueError):
+        asyncio.run(AsyncPcdsZipApp(BlockApp(1))({"type": "websocket"}, None, None))
@@ -0,0 +1,31 @@
+from pdp_util.budget import MemoryBudget
+
+
+def test_try_reserve_within_limit():
+    budget = MemoryBudget(100)
+    assert budget.try_reserve(60)
+    assert not budget.try_reserve(60)
+    assert budget.available == 40
+    budget.release(60)
+    assert budget.try_reserve(100)
+    assert budget.available == 0
+
+
+def test_reserve_records_overrun():
+    budget = MemoryBudget(100)
+    budget.reserve(80)
+    budget.reserve(50)
+    budget.release(130)
+    summary = budget.summary()
+    assert summary["used"] == 0
+    assert summary["peak"] == 130
+    assert summary["overrun"] == 30
+
+
+def test_spills_and_throttles_are_counted():
+    budget = MemoryBudget(100)
+    budget.record_spill(10)
+    budget.record_spill(5)
+    budget.record_throttle()
+    assert budget.spilled == 15
+    assert budget.throttled == 1
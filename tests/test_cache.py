@@ -0,0 +1,140 @@
+import os
+import time
+import hashlib
+
+import pytest
+
+from pdp_util.cache import ArchiveCache, MemoryCache, cache_key
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ArchiveCache(str(tmp_path), max_bytes=1000, ttl=60)
+
+
+def test_cache_key():
+    assert cache_key(("a", "b"), "nc", False) == cache_key(("a", "b"), "nc", False)
+    assert cache_key(("a", "b"), "nc", False) != cache_key(("a", "b"), "nc", True)
+
+
+def test_store_and_open(cache):
+    assert cache.open("abc") is None
+    chunks = [b"PK", b"123", b"456"]
+    assert list(cache.store("abc", iter(chunks))) == chunks
+    with cache.open("abc") as f:
+        assert f.read() == b"PK123456"
+        assert cache.etag(f) == hashlib.sha256(b"PK123456").hexdigest()
+
+
+def test_rebuild_while_open(cache):
+    list(cache.store("abc", [b"PK", b"old"]))
+    old = cache.open("abc")
+    list(cache.store("abc", [b"PK", b"new"]))
+    # The open entry keeps its contents and its tag...
+    with old:
+        assert old.read() == b"PKold"
+        assert cache.etag(old) == hashlib.sha256(b"PKold").hexdigest()
+    # ... while the rebuilt one replaces it
+    with cache.open("abc") as new:
+        assert new.read() == b"PKnew"
+        assert cache.etag(new) == hashlib.sha256(b"PKnew").hexdigest()
+    assert len([path for path, st in cache._entries()]) == 1
+
+
+def test_aborted_store_is_discarded(cache):
+    stored = cache.store("abc", iter([b"PK", b"123"]))
+    next(stored)
+    stored.close()
+    assert cache.open("abc") is None
+    assert cache.size() == 0
+    assert not [
+        name for root, dirs, files in os.walk(cache.directory) for name in files
+    ]
+
+
+def test_failed_store_is_discarded(cache):
+    def broken():
+        yield b"PK"
+        raise RuntimeError()
+
+    with pytest.raises(RuntimeError):
+        list(cache.store("abc", broken()))
+    assert cache.open("abc") is None
+
+
+def test_store_not_committed(cache):
+    assert list(cache.store("abc", iter([b"PK", b"1"]), lambda: False)) == [
+        b"PK",
+        b"1",
+    ]
+    assert cache.open("abc") is None
+    assert not [
+        name for root, dirs, files in os.walk(cache.directory) for name in files
+    ]
+    list(cache.store("abc", iter([b"PK", b"1"]), lambda: True))
+    assert cache.open("abc") is not None
+
+
+def test_ttl(cache):
+    list(cache.store("abc", [b"x"]))
+    path = cache.path("abc")
+    old = time.time() - 120
+    os.utime(path, (old, old))
+    assert cache.open("abc") is None
+    assert not os.path.exists(path)
+
+
+def test_contains(cache):
+    assert "abc" not in cache
+    list(cache.store("abc", [b"x"]))
+    assert "abc" in cache
+    old = time.time() - 120
+    os.utime(cache.path("abc"), (old, old))
+    assert "abc" not in cache
+
+
+def test_lru_eviction(cache):
+    now = time.time()
+    for i, key in enumerate(["aa", "bb"]):
+        list(cache.store(key, [b"x" * 400]))
+        # Make the access order explicit: aa is the oldest
+        os.utime(cache.path(key), (now - 100 + i, now))
+    cache.open("aa").close()  # aa is now the most recently used
+    list(cache.store("cc", [b"x" * 400]))
+    assert cache.size() <= 1000
+    assert os.path.exists(cache.path("aa"))
+    assert os.path.exists(cache.path("cc"))
+    assert cache.path("bb") is None
+
+
+def test_invalidate(cache):
+    for key in ["aa", "bb"]:
+        list(cache.store(key, [b"x"]))
+    cache.invalidate("aa")
+    assert cache.open("aa") is None
+    assert cache.open("bb") is not None
+    cache.invalidate()
+    assert cache.open("bb") is None
+
+
+def test_memory_cache():
+    cache = MemoryCache(max_entries=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # a is now the most recently used
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    cache.invalidate("a")
+    assert cache.get("a", "missing") == "missing"
+    cache.invalidate()
+    assert len(cache) == 0
+
+
+def test_memory_cache_ttl(monkeypatch):
+    cache = MemoryCache(ttl=10)
+    cache.set("a", None)
+    assert "a" in cache
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert "a" not in cache
@@ -0,0 +1,118 @@
+import time
+from threading import Event
+
+import pytest
+
+from pdp_util.coalesce import Coalescer
+
+
+class Build(object):
+    """An archive factory which counts its builds and can be held back"""
+
+    def __init__(self, n=100, size=1000, fail=False, pause_at=None):
+        self.n = n
+        self.size = size
+        self.fail = fail
+        self.pause_at = pause_at
+        self.builds = 0
+        self.closed = False
+        self.release = Event()
+        self.resume = Event()
+
+    def __call__(self):
+        self.builds += 1
+        return self.blocks()
+
+    def blocks(self):
+        try:
+            self.release.wait(5)
+            for i in range(self.n):
+                if i == self.pause_at:
+                    self.resume.wait(5)
+                yield bytes([i % 256]) * self.size
+            if self.fail:
+                raise IOError("statement timeout")
+        finally:
+            self.closed = True
+
+    def content(self):
+        return b"".join(bytes([i % 256]) * self.size for i in range(self.n))
+
+
+@pytest.mark.parametrize("max_memory", [1024**2, 2500])
+def test_identical_downloads_share_a_build(tmp_path, max_memory):
+    coalescer = Coalescer(max_memory, str(tmp_path))
+    build = Build()
+    subscriptions = [coalescer.subscribe("key", build) for i in range(5)]
+    build.release.set()
+    # Some readers are slow to start; they catch up from the spill
+    fast = b"".join(subscriptions[0])
+    assert fast == build.content()
+    for subscription in subscriptions[1:]:
+        assert b"".join(subscription) == build.content()
+    assert build.builds == 1
+
+
+def test_contains():
+    coalescer = Coalescer()
+    build = Build()
+    assert "key" not in coalescer
+    subscription = coalescer.subscribe("key", build)
+    assert "key" in coalescer
+    assert "other" not in coalescer
+    build.release.set()
+    b"".join(subscription)
+    subscription.close()
+    assert "key" not in coalescer
+
+
+def test_late_subscriber_reads_from_the_start(tmp_path):
+    coalescer = Coalescer(2500, str(tmp_path))
+    build = Build(pause_at=50)
+    first = coalescer.subscribe("key", build)
+    build.release.set()
+    head = next(first)
+    time.sleep(0.1)
+    # Half of the archive has been built, and most of that spilled
+    late = coalescer.subscribe("key", build)
+    build.resume.set()
+    assert b"".join(late) == build.content()
+    assert head + b"".join(first) == build.content()
+    assert build.builds == 1
+
+
+def test_different_keys_build_separately():
+    coalescer = Coalescer()
+    a, b = Build(), Build()
+    a.release.set()
+    b.release.set()
+    assert b"".join(coalescer.subscribe("a", a)) == a.content()
+    assert b"".join(coalescer.subscribe("b", b)) == b.content()
+    assert (a.builds, b.builds) == (1, 1)
+    assert not coalescer.builds
+
+
+def test_errors_reach_every_subscriber():
+    coalescer = Coalescer()
+    build = Build(n=3, fail=True)
+    subscriptions = [coalescer.subscribe("key", build) for i in range(2)]
+    build.release.set()
+    for subscription in subscriptions:
+        with pytest.raises(IOError):
+            b"".join(subscription)
+
+
+def test_build_is_abandoned_with_its_last_subscriber():
+    coalescer = Coalescer(2500)
+    build = Build(n=100000)
+    subscriptions = [coalescer.subscribe("key", build) for i in range(2)]
+    build.release.set()
+    for subscription in subscriptions:
+        next(subscription)
+        subscription.close()
+    deadline = time.time() + 5
+    while not build.closed and time.time() < deadline:
+        time.sleep(0.01)
+    assert build.closed
+    # The next request starts afresh
+    assert not coalescer.builds
@@ -0,0 +1,80 @@
+from datetime import datetime
+
+from netCDF4 import Dataset
+
+from pdp_util.columnar import column_names, write_dsg, get_dsg_responders
+
+
+stns = [
+    ("ARDA", "115084"),
+    ("ARDA", "112073"),
+    ("EC_raw", "1046332"),
+    ("FLNRO-WMB", "369"),
+]
+
+
+def test_column_names():
+    found = [
+        (("A", "1"), (1, [(10, "tmp"), (11, "pr")])),
+        (("A", "2"), (2, [(10, "tmp")])),
+        (("B", "3"), (3, [(20, "tmp"), (21, "time")])),
+    ]
+    assert column_names(found) == {
+        10: "A_tmp",
+        11: "pr",
+        20: "B_tmp",
+        21: "obs_time",
+    }
+
+
+def test_write_dsg(test_session, tmp_path):
+    path = str(tmp_path / "stations.nc")
+    write_dsg(test_session, stns, (None, None), path, batch_rows=7, chunk_size=16)
+
+    with Dataset(path) as ds:
+        assert ds.featureType == "timeSeries"
+        assert ds["row_size"].sample_dimension == "obs"
+        assert ds["station_id"].cf_role == "timeseries_id"
+        stations = set(zip(ds["network"][:], ds["station_id"][:]))
+        assert stations <= set(stns)
+        assert sum(ds["row_size"][:]) == len(ds.dimensions["obs"])
+        for name, var in ds.variables.items():
+            if "obs" in var.dimensions and name != "time":
+                # Observations carry their variable's metadata
+                assert var.coordinates == "time lat lon alt station_id"
+                assert {"units", "standard_name", "long_name"} & set(var.ncattrs())
+        times = ds["time"][:]
+        # Observations are ordered by time within each station
+        start = 0
+        for size in ds["row_size"][:]:
+            assert list(times[start : start + size]) == sorted(
+                times[start : start + size]
+            )
+            start += size
+
+
+def test_write_dsg_clip_dates(test_session, tmp_path):
+    path = str(tmp_path / "stations.nc")
+    clip_dates = (datetime(2000, 1, 1), datetime(2000, 1, 31))
+    write_dsg(test_session, stns, clip_dates, path)
+
+    with Dataset(path) as ds:
+        for t in ds["time"][:]:
+            assert datetime(2000, 1, 1) <= datetime.utcfromtimestamp(t)
+            assert datetime.utcfromtimestamp(t) <= datetime(2000, 1, 31)
+
+
+def test_get_dsg_responders(test_session, tmp_path):
+    responders = list(get_dsg_responders(test_session, stns, (None, None)))
+    assert [name for name, content in responders] == ["pcds_data.nc"]
+    data = b"".join(responders[0][1])
+    assert data.startswith(b"\x89HDF")
+
+
+def test_get_dsg_responders_no_stations(test_session, tmp_path):
+    # A 0 length station dimension would be unlimited, so there is no file
+    responders = get_dsg_responders(
+        test_session, [("ARDA", "no such station")], (None, None), spool_dir=tmp_path
+    )
+    assert list(responders) == []
+    assert list(tmp_path.iterdir()) == []
@@ -3,11 +3,22 @@ from datetime import datetime
 
 import pytest
 from sqlalchemy.dialects import postgresql
-from pycds import CrmpNetworkGeoserver
+from pycds import CrmpNetworkGeoserver, ClimoObsCount, Network, Station
 from webob.request import Request
 import json
 
-from pdp_util.counts import CountStationsApp, CountRecordLengthApp
+from sqlalchemy import event
+
+import pdp_util.counts
+from pdp_util.filters import validate_vars
+from pdp_util.counts import (
+    CountStationsApp,
+    CountRecordLengthApp,
+    CountsCache,
+    counts_key,
+    get_counts,
+    views_version,
+)
 
 
 def cng_query(
@@ -132,6 +143,22 @@ def test_count_stations_app(test_session, filters, expected):
     assert data["stations_selected"] == expected
 
 
+def test_count_stations_breakdowns(test_session):
+    app = CountStationsApp()
+    req = Request.blank(
+        "?input-freq=1-hourly&breakdown=network&breakdown=frequency",
+        {"sesh": test_session},
+    )
+    data = json.loads(req.get_response(app).app_iter)
+    assert data["stations_selected"] == 6
+    assert sum(data["by_network"].values()) == 6
+    assert set(data["by_network"]) == {"FLNRO-WMB", "MoTIe", "EC_raw", "BCH", "ENV-AQN"}
+    assert data["by_frequency"] == {"1-hourly": 6}
+
+    req = Request.blank("?breakdown=colour", {"sesh": test_session})
+    assert req.get_response(app).status_int == 400
+
+
 def test_count_record_length_app(test_session):
     app = CountRecordLengthApp(None, 3000)
     req = Request.blank("", {"sesh": test_session})
@@ -195,5 +222,88 @@ def test_filter_dates_on_record_length_app(test_session, params):
     # Climatologies aren't filtered by date, only station
 
 
+def test_get_counts_is_one_query(test_session):
+    engine = test_session.get_bind()
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        counts = get_counts(test_session, [], None, None)
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert counts == {"record_length": 1969, "climo_length": 412}
+    assert len(statements) == 1
+
+
 def test_length_of_return_dataset(test_session):
     pass
+
+
+def test_counts_key():
+    def key(query):
+        return counts_key("stations", validate_vars(Request.blank(query).environ))
+
+    assert key("?network-name=EC_raw&input-freq=daily") == key(
+        "?input-freq=daily&network-name=EC_raw"
+    )
+    assert key("?network-name=EC_raw") != key("?network-name=EC")
+
+
+def test_counts_cache(test_session, monkeypatch):
+    cache = CountsCache()
+    stations = CountStationsApp(cache=cache)
+    lengths = CountRecordLengthApp(None, 3000, cache=cache)
+
+    def count(app, query="?network-name=EC_raw"):
+        req = Request.blank(query, {"sesh": test_session})
+        return json.loads(req.get_response(app).app_iter)
+
+    expected = (count(stations), count(lengths))
+    assert expected == (
+        count(CountStationsApp()),
+        count(CountRecordLengthApp(None, 3000)),
+    )
+
+    # Repeated requests don't touch the data
+    def fail(*args, **kwargs):
+        raise AssertionError("The counts should have come from the cache")
+
+    for name in ("get_stn_count", "stn_list_query"):
+        monkeypatch.setattr(pdp_util.counts, name, fail)
+    assert (count(stations), count(lengths)) == expected
+    with pytest.raises(AssertionError):
+        count(stations, "?network-name=EC")
+
+    # Refreshing a view clears the cache
+    version = views_version(test_session)
+    test_session.execute(ClimoObsCount.refresh())
+    assert views_version(test_session) != version
+    with pytest.raises(AssertionError):
+        count(stations)
+
+
+def test_counts_cache_sees_station_changes(test_session):
+    stations = CountStationsApp(cache=CountsCache())
+
+    def count(app):
+        req = Request.blank("?network-name=EC_raw", {"sesh": test_session})
+        return json.loads(req.get_response(app).app_iter)
+
+    before = count(stations)
+    # Move a station to another network, underneath crmp_network_geoserver
+    station = (
+        test_session.query(Station)
+        .join(Network, Network.id == Station.network_id)
+        .filter(Network.name == "EC_raw")
+        .first()
+    )
+    other = test_session.query(Network).filter(Network.name != "EC_raw").first()
+    station.network_id = other.id
+    test_session.flush()
+
+    after = count(stations)
+    assert after != before
+    assert after == count(CountStationsApp())
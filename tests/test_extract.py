@@ -0,0 +1,187 @@
+from datetime import datetime
+
+import pytest
+
+from pdp_util.util import get_stn_list
+from pdp_util.extract import (
+    cancel_query,
+    station_columns,
+    csv_rows,
+    format_value,
+    merge_datum,
+    get_bulk_responders,
+    get_copy_responders,
+)
+
+stns = [
+    ("ARDA", "115084"),
+    ("ARDA", "112073"),
+    ("EC_raw", "1046332"),
+    ("FLNRO-WMB", "369"),
+]
+
+
+def test_station_columns(test_session):
+    columns = station_columns(test_session, stns)
+    assert set(columns) <= set(stns)
+    for station_id, variables in columns.values():
+        assert isinstance(station_id, int)
+        names = [name for vars_id, name in variables]
+        assert names == sorted(names)
+
+
+def test_csv_rows_skips_unknown_variables():
+    rows = [("2000-01-01", 1, 1.5), ("2000-01-01", 9, 3.0), ("2000-01-02", 9, 4.0)]
+    content = b"".join(csv_rows([(1, "T")], rows)).decode()
+    assert content == "time,T\n2000-01-01,1.5\n"
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [
+        (None, ""),
+        (1.0, "1"),
+        (-2.5, "-2.5"),
+        (0.1, "0.1"),
+        (1e16, "1e+16"),
+        (float("nan"), "NaN"),
+        (datetime(2000, 1, 1), "2000-01-01 00:00:00"),
+        (datetime(2000, 1, 1, 0, 0, 0, 500000), "2000-01-01 00:00:00.5"),
+    ],
+)
+def test_format_value(value, expected):
+    # As PostgreSQL formats them in CSV
+    assert format_value(value) == expected
+
+
+def test_csv_rows_duplicates():
+    rows = [(datetime(2000, 1, 1), 1, 2.0), (datetime(2000, 1, 1), 1, 1.0)]
+    content = b"".join(csv_rows([(1, "T")], rows)).decode()
+    assert content == "time,T\n2000-01-01 00:00:00,2\n"
+
+
+@pytest.mark.parametrize(
+    ("kept", "datum", "expected"),
+    [
+        (None, None, None),
+        (None, 1.0, 1.0),
+        (1.0, None, 1.0),
+        (1.0, 2.0, 2.0),
+        (2.0, 1.0, 2.0),
+    ],
+)
+def test_merge_datum(kept, datum, expected):
+    assert merge_datum(kept, datum) == expected
+
+
+def bulk_files(sesh, stations, clip_dates=(None, None), batch_size=100):
+    return {
+        name: b"".join(content).decode()
+        for name, content in get_bulk_responders(
+            sesh, stations, clip_dates, batch_size=batch_size
+        )
+    }
+
+
+def test_get_bulk_responders(test_session):
+    files = bulk_files(test_session, stns)
+    assert set(files) == {f"{net}/{stn}.csv" for net, stn in stns}
+    for content in files.values():
+        lines = content.splitlines()
+        assert lines[0].startswith("time")
+        # Rows are ordered by time and have a value slot for every column
+        times = [line.split(",")[0] for line in lines[1:]]
+        assert times == sorted(times)
+        assert {line.count(",") for line in lines} <= {lines[0].count(",")}
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_bulk_batching_is_transparent(test_session, batch_size):
+    stations = get_stn_list(test_session, [])
+    assert bulk_files(test_session, stations, batch_size=batch_size) == bulk_files(
+        test_session, stations
+    )
+
+
+def test_bulk_clip_dates(test_session):
+    stations = get_stn_list(test_session, [])
+    sdate, edate = datetime(2000, 1, 1), datetime(2000, 1, 31)
+    files = bulk_files(test_session, stations, (sdate, edate))
+    for content in files.values():
+        for line in content.splitlines()[1:]:
+            time = datetime.strptime(line.split(",")[0], "%Y-%m-%d %H:%M:%S")
+            assert sdate <= time <= edate
+    full = bulk_files(test_session, stations)
+    assert sum(len(c) for c in files.values()) < sum(len(c) for c in full.values())
+
+
+def copy_files(sesh, stations, clip_dates=(None, None), batch_size=100):
+    return {
+        name: b"".join(content).decode()
+        for name, content in get_copy_responders(
+            sesh, stations, clip_dates, batch_size=batch_size
+        )
+    }
+
+
+@pytest.mark.parametrize(
+    "clip_dates", [(None, None), (datetime(2000, 1, 1), datetime(2000, 1, 31))]
+)
+def test_copy_matches_bulk(test_session, clip_dates):
+    stations = get_stn_list(test_session, [])
+    assert copy_files(test_session, stations, clip_dates, 3) == bulk_files(
+        test_session, stations, clip_dates
+    )
+
+
+def test_incremental_extraction(test_session):
+    stations = get_stn_list(test_session, [])
+    since = datetime(1900, 1, 1)
+    full = bulk_files(test_session, stations)
+    changed = {
+        name: b"".join(content).decode()
+        for name, content in get_bulk_responders(
+            test_session, stations, (None, None), since=since
+        )
+    }
+    # Everything has changed since long ago
+    assert changed == full
+    copied = {
+        name: b"".join(content).decode()
+        for name, content in get_copy_responders(
+            test_session, stations, (None, None), since=since
+        )
+    }
+    assert copied == full
+
+    # Nothing has changed since the future
+    for name, content in get_bulk_responders(
+        test_session, stations, (None, None), since=datetime(3000, 1, 1)
+    ):
+        assert len(b"".join(content).decode().splitlines()) <= 1
+
+
+@pytest.mark.parametrize("stn", stns)
+def test_copy_matches_bulk_per_station(test_session, stn):
+    assert copy_files(test_session, [stn]) == bulk_files(test_session, [stn])
+
+
+def test_abandoned_copy(test_session):
+    responders = get_copy_responders(test_session, stns, (None, None))
+    name, content = next(responders)
+    next(content)
+    content.close()
+    # The session is still usable
+    assert station_columns(test_session, stns[:1]) == station_columns(
+        test_session, stns[:1]
+    )
+
+
+def test_cancel_query(test_session):
+    responders = get_bulk_responders(test_session, stns, (None, None))
+    name, content = next(responders)
+    next(content)
+    cancel_query(test_session)
+    responders.close()
+    # The session is still usable, on a new connection
+    assert test_session.execute("SELECT 1").scalar() == 1
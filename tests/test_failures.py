@@ -0,0 +1,76 @@
+from io import BytesIO
+from itertools import chain
+from zipfile import ZipFile
+
+from pdp_util.agg import ziperator
+from pdp_util.failures import retrying, get_error_responders
+
+
+class Flaky(object):
+    """A responder factory whose first ``failures`` responses fail, after ``sent`` chunks"""
+
+    def __init__(self, failures, sent=0):
+        self.failures = failures
+        self.sent = sent
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.content(self.calls <= self.failures)
+
+    def content(self, fail):
+        for i in range(self.sent):
+            yield b"row\n"
+        if fail:
+            raise IOError("canceling statement due to statement timeout")
+        yield b"rest\n"
+
+
+def test_retry_succeeds():
+    failures = []
+    factory = Flaky(2)
+    assert b"".join(retrying("a.csv", factory, failures, retries=2, backoff=0)) == (
+        b"rest\n"
+    )
+    assert factory.calls == 3
+    assert failures == []
+
+
+def test_retries_exhausted():
+    failures = []
+    factory = Flaky(5)
+    assert list(retrying("a.csv", factory, failures, retries=2, backoff=0)) == []
+    assert factory.calls == 3
+    [failure] = failures
+    assert failure.name == "a.csv"
+    assert failure.attempts == 3
+    assert not failure.partial
+
+
+def test_partial_member_is_not_retried():
+    failures = []
+    factory = Flaky(1, sent=2)
+    assert b"".join(retrying("a.csv", factory, failures, retries=2, backoff=0)) == (
+        b"row\nrow\n"
+    )
+    assert factory.calls == 1
+    assert failures[0].partial
+    assert "truncated" in str(failures[0])
+
+
+def test_archive_is_finished_with_errors():
+    failures = []
+    responders = [
+        ("good.csv", retrying("good.csv", Flaky(0), failures, backoff=0)),
+        ("bad.csv", retrying("bad.csv", Flaky(1), failures, backoff=0)),
+    ]
+    archive = b"".join(ziperator(chain(responders, get_error_responders(failures))))
+    with ZipFile(BytesIO(archive)) as z:
+        assert z.read("good.csv") == b"rest\n"
+        assert z.read("bad.csv") == b""
+        assert "bad.csv: missing after 1 attempt(s)" in z.read("errors.txt").decode()
+
+
+def test_no_errors_no_member():
+    assert list(get_error_responders([])) == []
+    assert list(get_error_responders(None)) == []
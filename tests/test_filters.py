@@ -3,7 +3,7 @@ from urllib.parse import urlencode
 
 from sqlalchemy.exc import CompileError
 
-from pdp_util.filters import form_filters, validate_vars
+from pdp_util.filters import form_filters, validate_vars, canonical_filters
 from pycds import CrmpNetworkGeoserver as cng
 
 import pytest
@@ -134,3 +134,27 @@ def test_validate_vars(input, expected):
                         pass
         assert expected == []
         assert result == []
+
+
+@pytest.mark.parametrize(
+    ("a", "b", "equal"),
+    [
+        (
+            "?network-name=EC_raw&input-freq=daily",
+            "?input-freq=daily&network-name=EC_raw",
+            True,
+        ),
+        ("?network-name=EC_raw", "?network-name=EC_raw&bogus=1", True),
+        ("?network-name=EC_raw", "?network-name=ARDA", False),
+        ("?from-date=2000/01/01", "?from-date=2000/01/02", False),
+        (
+            "?input-vars=air_temperature_point",
+            "?input-vars=air_temperature_mean",
+            False,
+        ),
+    ],
+)
+def test_canonical_filters(a, b, equal):
+    canonical_a = canonical_filters(validate_vars(Request.blank(a).environ))
+    canonical_b = canonical_filters(validate_vars(Request.blank(b).environ))
+    assert (canonical_a == canonical_b) == equal
@@ -0,0 +1,90 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import func
+from webob.request import Request
+
+from pdp_util.util import get_stn_list
+from pdp_util.incremental import (
+    make_token,
+    parse_since,
+    get_since,
+    snapshot_time,
+    changed_stations,
+    get_manifest_responders,
+    MANIFEST_FILENAME,
+    SNAPSHOT_OVERLAP,
+)
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [
+        ("2020/01/02", datetime(2020, 1, 2)),
+        ("2020/01/02 03:04:05", datetime(2020, 1, 2, 3, 4, 5)),
+        ("2020-01-02T03:04:05", datetime(2020, 1, 2, 3, 4, 5)),
+    ],
+)
+def test_parse_since(value, expected):
+    assert parse_since(value) == expected
+
+
+def test_token_round_trip():
+    snapshot = datetime(2020, 1, 2, 3, 4, 5, 678901, tzinfo=timezone.utc)
+    token = make_token(snapshot)
+    assert parse_since(token) == snapshot
+    # Tokens travel in query strings as they are
+    assert Request.blank(f"/?since={token}").params["since"] == token
+
+
+@pytest.mark.parametrize("value", ["yesterday", "2020/13/01", "!!!"])
+def test_parse_since_bad(value):
+    with pytest.raises(ValueError):
+        parse_since(value)
+
+
+def test_get_since():
+    assert get_since(Request.blank("/?data-format=csv").environ) is None
+    assert get_since(Request.blank("/?since=2020/01/02").environ) == datetime(
+        2020, 1, 2
+    )
+
+
+def test_manifest():
+    snapshot = datetime(2020, 1, 2, tzinfo=timezone.utc)
+    counts = {("EC_raw", "1046332"): 12}
+    [(name, content)] = get_manifest_responders(
+        datetime(2020, 1, 1), snapshot, counts, 3
+    )
+    assert name == MANIFEST_FILENAME
+    manifest = json.loads(b"".join(content))
+    assert parse_since(manifest["next_token"]) == snapshot
+    assert manifest["stations"] == [
+        {
+            "network_name": "EC_raw",
+            "native_id": "1046332",
+            "file": "EC_raw/1046332.csv",
+            "changed_observations": 12,
+        }
+    ]
+    assert manifest["unchanged_stations"] == 3
+
+
+def test_changed_stations(test_session):
+    stns = get_stn_list(test_session, [])
+    changed, counts = changed_stations(test_session, stns, datetime(1900, 1, 1))
+    assert changed
+    assert set(changed) == set(counts)
+    assert all(count > 0 for count in counts.values())
+
+    # Nothing can have changed after the present
+    future = snapshot_time(test_session)
+    assert changed_stations(test_session, stns, future) == ([], {})
+
+
+def test_snapshot_time(test_session):
+    # No later than the start of this transaction, less the overlap
+    now = test_session.query(func.now()).scalar()
+    assert snapshot_time(test_session) <= now - SNAPSHOT_OVERLAP
+    assert snapshot_time(test_session, timedelta(0)) <= now
@@ -0,0 +1,64 @@
+import time
+
+from pdp_util.instrument import Instrumentation
+
+
+def slow_chunks(first_delay, delay, n):
+    time.sleep(first_delay)
+    for i in range(n):
+        if i:
+            time.sleep(delay)
+        yield b"a,b\n" * 10
+
+
+def test_timed_splits_query_and_encode_time():
+    instrument = Instrumentation()
+    content = b"".join(instrument.timed("a.csv", slow_chunks(0.05, 0.01, 3), True))
+    stats = instrument.member("a.csv")
+    assert len(content) == 120
+    assert stats.query_time >= 0.05
+    assert 0.02 <= stats.encode_time < 0.05
+    assert stats.rows == 30
+
+
+def test_rows_are_not_counted_for_binary_formats():
+    instrument = Instrumentation()
+    list(instrument.timed("a.nc", iter([b"\n\n"])))
+    assert instrument.member("a.nc").rows is None
+
+
+def test_callback_receives_members_and_summary():
+    events = []
+    instrument = Instrumentation(lambda event, stats: events.append((event, stats)))
+    for name in ("a.csv", "b.csv"):
+        list(instrument.timed(name, iter(["x\n", "y\n"]), True))
+        instrument.member(name).raw_bytes = 4
+        instrument.member_done(name)
+    response = list(instrument.measure(iter([b"PK", b"rest"])))
+
+    assert response == [b"PK", b"rest"]
+    assert [event for event, stats in events] == ["member", "member", "request"]
+    assert events[0][1]["name"] == "a.csv"
+    summary = events[-1][1]
+    assert summary["members"] == 2
+    assert summary["rows"] == 4
+    assert summary["raw_bytes"] == 8
+    assert summary["response_bytes"] == 6
+
+
+def test_send_time_is_measured():
+    instrument = Instrumentation()
+    for block in instrument.measure(iter([b"a", b"b", b"c"])):
+        time.sleep(0.02)
+    summary = instrument.summary()
+    assert summary["send_time"] >= 0.04
+    assert summary["total_time"] >= summary["send_time"]
+
+
+def test_callback_errors_are_ignored():
+    def callback(event, stats):
+        raise RuntimeError("metrics are down")
+
+    instrument = Instrumentation(callback)
+    instrument.member_done("a.csv")
+    instrument.request_done()
@@ -0,0 +1,200 @@
+import json
+import time
+import socket
+import subprocess
+import sys
+from threading import Event
+
+import pytest
+from webob.request import Request
+
+from pdp_util.jobs import (
+    JobApp,
+    JobStore,
+    job_environ,
+    DONE,
+    FAILED,
+    QUEUED,
+    RUNNING,
+)
+
+
+class ArchiveApp(object):
+    """A WSGI app which streams a fixed response, or fails part way through"""
+
+    def __init__(self, blocks, fail=False):
+        self.blocks = blocks
+        self.fail = fail
+        self.environ = None
+
+    def __call__(self, environ, start_response):
+        self.environ = environ
+        start_response("200 OK", [("Content-type", "application/zip")])
+        return self.content()
+
+    def content(self):
+        yield from self.blocks
+        if self.fail:
+            raise IOError("lost connection")
+
+
+def wait_for(app, job_id, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = app.store.get(job_id)
+        if job["status"] in (DONE, FAILED):
+            return job
+        time.sleep(0.01)
+    raise AssertionError("Job did not finish")
+
+
+def submit(app, **params):
+    req = Request.blank("/jobs/", POST=dict({"data-format": "csv"}, **params))
+    req.script_name = "/jobs"
+    req.path_info = "/"
+    return req.get_response(app)
+
+
+def test_job_lifecycle(tmp_path):
+    download = ArchiveApp([b"PK", b"rest of the archive"])
+    app = JobApp(download, JobStore(str(tmp_path)))
+
+    response = submit(app, **{"network-name": "EC"})
+    assert response.status_int == 202
+    body = json.loads(response.body)
+    assert response.headers["Location"] == body["status_url"]
+    job = wait_for(app, body["id"])
+    assert job["status"] == DONE
+    assert job["bytes"] == 21
+
+    # The download ran with the parameters of the POST
+    assert Request(download.environ).GET["network-name"] == "EC"
+
+    status = Request.blank(f"/{body['id']}").get_response(app)
+    assert json.loads(status.body)["result_url"].endswith(f"/{body['id']}/result")
+
+    result = Request.blank(f"/{body['id']}/result").get_response(app)
+    assert result.status_int == 200
+    assert result.body == b"PKrest of the archive"
+    assert result.headers["Content-Length"] == "21"
+
+    # An interrupted transfer can be resumed
+    rest = Request.blank(
+        f"/{body['id']}/result", headers={"Range": "bytes=2-"}
+    ).get_response(app)
+    assert rest.status_int == 206
+    assert rest.body == b"rest of the archive"
+    assert rest.headers["Content-Range"] == "bytes 2-20/21"
+
+
+def test_failed_job(tmp_path):
+    app = JobApp(ArchiveApp([b"PK"], fail=True), JobStore(str(tmp_path)))
+    job_id = json.loads(submit(app).body)["id"]
+    job = wait_for(app, job_id)
+    assert job["status"] == FAILED
+    assert "lost connection" in job["error"]
+    assert Request.blank(f"/{job_id}/result").get_response(app).status_int == 409
+    assert not list(tmp_path.glob("*.zip*"))
+
+
+def test_bad_requests(tmp_path):
+    app = JobApp(ArchiveApp([]), JobStore(str(tmp_path)))
+    assert submit(app, **{"data-format": "exe"}).status_int == 400
+    assert Request.blank("/nonesuch").get_response(app).status_int == 404
+    assert Request.blank("/nonesuch/result").get_response(app).status_int == 404
+
+
+def test_expire_and_recover(tmp_path):
+    store = JobStore(str(tmp_path), ttl=0)
+    done = store.create([])
+    store.update(done, status=DONE)
+    open(store.path(done), "wb").close()
+    running = store.create([])
+    store.update(running, status=RUNNING)
+
+    assert store.expire() == 1
+    assert store.get(done) is None
+    assert not list(tmp_path.glob("*.zip"))
+
+    # A job whose process has gone away
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    orphan = store.create([])
+    store.update(orphan, owner=f"{socket.gethostname()}:{dead.pid}")
+    # A job of a process on another host
+    remote = store.create([])
+    store.update(remote, status=RUNNING, owner="elsewhere:1")
+
+    # A new application only marks the job which lost its process as failed
+    JobApp(ArchiveApp([]), JobStore(str(tmp_path)))
+    assert store.get(orphan)["status"] == FAILED
+    assert store.get(running)["status"] == RUNNING
+    assert store.get(remote)["status"] == RUNNING
+
+
+class BlockingApp(ArchiveApp):
+    """An ArchiveApp which does not finish until it is released"""
+
+    def __init__(self):
+        super().__init__([b"PK"])
+        self.release = Event()
+
+    def content(self):
+        self.release.wait(5)
+        yield from self.blocks
+
+
+def test_queue_limit(tmp_path):
+    download = BlockingApp()
+    app = JobApp(download, JobStore(str(tmp_path)), workers=1, max_queued=1)
+    running = json.loads(submit(app).body)["id"]
+    queued = json.loads(submit(app).body)["id"]
+
+    response = submit(app)
+    assert response.status_int == 503
+    assert "Retry-After" in response.headers
+    assert app.store.get(queued)["status"] == QUEUED
+
+    download.release.set()
+    assert wait_for(app, running)["status"] == DONE
+    assert wait_for(app, queued)["status"] == DONE
+    assert submit(app).status_int == 202
+
+
+def test_job_environ():
+    environ = Request.blank("/", POST={"input-var": "T"}).environ
+    # Parsing the body leaves webob's own cache in the environ
+    Request(environ).params
+    env = job_environ(environ, [("input-var", "T"), ("input-var", "P")])
+    assert Request(env).params.getall("input-var") == ["T", "P"]
+    assert env["REQUEST_METHOD"] == "GET"
+
+
+def test_job_environ_builds_the_whole_archive():
+    headers = {
+        "Range": "bytes=100-",
+        "If-Range": '"abc"',
+        "If-None-Match": '"abc"',
+        "If-Modified-Since": "Sat, 01 Jan 2000 00:00:00 GMT",
+        "Accept": "application/zip",
+    }
+    environ = Request.blank("/", headers=headers).environ
+    env = job_environ(environ, [("input-var", "T")])
+    assert {key for key in env if key.startswith("HTTP_")} == {
+        "HTTP_HOST",
+        "HTTP_ACCEPT",
+    }
+
+
+def test_failed_submission_gives_back_its_place(tmp_path, monkeypatch):
+    app = JobApp(ArchiveApp([b"PK"]), JobStore(str(tmp_path)), max_queued=0)
+
+    def fail(*args):
+        raise RuntimeError("cannot schedule new futures after shutdown")
+
+    monkeypatch.setattr(app.executor, "submit", fail)
+    with pytest.raises(RuntimeError):
+        submit(app)
+    assert app.pending == 0
+    [job] = app.store._execute("SELECT status FROM jobs", ())
+    assert job[0] == FAILED
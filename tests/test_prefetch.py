@@ -0,0 +1,169 @@
+import time
+from threading import Lock, Event
+
+import pytest
+
+from pdp_util.budget import MemoryBudget
+from pdp_util.prefetch import PrefetchedResponders
+
+
+def slow_content(n, delay=0.0, size=100):
+    for i in range(n):
+        time.sleep(delay)
+        yield bytes([i % 256]) * size
+
+
+def test_order_and_content():
+    responders = [(f"{i}.txt", slow_content(i + 1)) for i in range(20)]
+    expected = [(f"{i}.txt", b"".join(slow_content(i + 1))) for i in range(20)]
+    result = [
+        (name, b"".join(content))
+        for name, content in PrefetchedResponders(responders, workers=4)
+    ]
+    assert result == expected
+
+
+def test_chunks_pass_through():
+    result = [
+        list(content)
+        for name, content in PrefetchedResponders([("a", iter(["é", b"x"]))])
+    ]
+    assert result == [["é", b"x"]]
+
+
+def test_runs_ahead_in_parallel():
+    responders = [(f"{i}.txt", slow_content(5, delay=0.02)) for i in range(8)]
+    t0 = time.time()
+    for name, content in PrefetchedResponders(responders, workers=8):
+        b"".join(content)
+    # Serially this would take 8 * 5 * 0.02 = 0.8s
+    assert time.time() - t0 < 0.5
+
+
+def test_buffer_is_capped():
+    max_bytes = 1000
+    prefetched = PrefetchedResponders(
+        [(f"{i}.txt", slow_content(50, size=100)) for i in range(10)],
+        workers=4,
+        max_bytes=max_bytes,
+    )
+    for name, content in prefetched:
+        for chunk in content:
+            time.sleep(0.001)
+            # The member being consumed may exceed the cap by one chunk
+            assert prefetched.buffered <= max_bytes + 100
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_responder_error_is_raised_in_order(workers):
+    def broken():
+        yield b"partial"
+        raise RuntimeError("database went away")
+
+    responders = [("ok.txt", slow_content(3)), ("bad.txt", broken())]
+    prefetched = iter(PrefetchedResponders(responders, workers=workers))
+    name, content = next(prefetched)
+    assert name == "ok.txt" and len(b"".join(content)) == 300
+    name, content = next(prefetched)
+    assert name == "bad.txt"
+    with pytest.raises(RuntimeError):
+        b"".join(content)
+
+
+def test_source_error_is_raised():
+    def responders():
+        yield "ok.txt", slow_content(1)
+        raise RuntimeError("bad station list")
+
+    prefetched = iter(PrefetchedResponders(responders(), workers=2))
+    name, content = next(prefetched)
+    b"".join(content)
+    with pytest.raises(RuntimeError):
+        next(prefetched)
+
+
+def test_bad_worker_count():
+    with pytest.raises(ValueError):
+        PrefetchedResponders([], workers=0)
+
+
+def test_budget_is_respected_and_released():
+    budget = MemoryBudget(1000)
+    prefetched = PrefetchedResponders(
+        [(f"{i}.txt", slow_content(50, size=100)) for i in range(10)],
+        workers=4,
+        budget=budget,
+    )
+    for name, content in prefetched:
+        for chunk in content:
+            time.sleep(0.001)
+            assert budget.used <= 1000 + 100
+    assert budget.used == 0
+    assert budget.throttled > 0
+
+
+def test_spill_to_disk(tmp_path):
+    budget = MemoryBudget(500)
+    responders = [(f"{i}.txt", slow_content(20, size=100)) for i in range(6)]
+    expected = [(f"{i}.txt", b"".join(slow_content(20, size=100))) for i in range(6)]
+    prefetched = PrefetchedResponders(
+        responders, workers=3, budget=budget, spill_dir=str(tmp_path)
+    )
+    result = []
+    for name, content in prefetched:
+        time.sleep(0.02)  # Let the workers run ahead and spill
+        result.append((name, b"".join(content)))
+    assert result == expected
+    assert budget.spilled > 0
+    assert budget.used == 0
+
+
+def test_abandoned_responders_are_closed():
+    closed = []
+
+    def endless(i):
+        try:
+            while True:
+                yield bytes([i]) * 100
+        finally:
+            closed.append(i)
+
+    prefetched = PrefetchedResponders(
+        ((f"{i}.txt", endless(i)) for i in range(100)), workers=2, max_bytes=1000
+    )
+    iterator = iter(prefetched)
+    name, content = next(iterator)
+    next(content)
+    iterator.close()
+    deadline = time.time() + 2
+    while len(closed) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    # Only the responders which had been started, and all of them
+    assert sorted(closed) == [0, 1]
+
+
+def test_close_cancels_running_responders():
+    started, cancelled = Event(), Event()
+
+    def blocked():
+        # Like a database query, which only returns once it is cancelled
+        started.set()
+        cancelled.wait(5)
+        yield b"x"
+
+    cancelled_threads = []
+
+    def cancel(thread):
+        cancelled_threads.append(thread)
+        cancelled.set()
+
+    prefetched = PrefetchedResponders(
+        iter([("a.txt", iter([b"a"])), ("b.txt", blocked())]), workers=2, cancel=cancel
+    )
+    iterator = iter(prefetched)
+    name, content = next(iterator)
+    assert b"".join(content) == b"a"
+    assert started.wait(5)
+    iterator.close()
+    assert len(cancelled_threads) == 1
+    assert cancelled_threads[0].name.startswith("prefetch-")
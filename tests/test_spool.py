@@ -0,0 +1,83 @@
+import pytest
+
+from pdp_util.budget import MemoryBudget
+from pdp_util.spool import spooled_responders, spool_file
+
+
+class Responder(object):
+    """Chunk generator which records whether it was drained and closed"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.drained = False
+        self.closed = False
+
+    def __iter__(self):
+        yield from self.chunks
+        self.drained = True
+
+    def close(self):
+        self.closed = True
+
+
+def test_members_are_drained_before_they_are_read():
+    responders = [
+        ("a.csv", Responder([b"a" * 10, "b" * 10])),
+        ("b.csv", Responder([b"c" * 5])),
+    ]
+    released = []
+    spooled = spooled_responders(
+        iter(responders), max_memory=4, release=lambda: released.append(True)
+    )
+
+    name, content = next(spooled)
+    assert name == "a.csv"
+    assert responders[0][1].drained and responders[0][1].closed
+    assert not responders[1][1].drained
+    assert released == [True]
+    assert b"".join(content) == b"a" * 10 + b"b" * 10
+
+    name, content = next(spooled)
+    assert name == "b.csv"
+    assert b"".join(content) == b"c" * 5
+    assert released == [True, True]
+
+
+def test_spool_memory_is_reserved_from_the_budget():
+    budget = MemoryBudget(100)
+    spooled = spooled_responders(
+        iter([("a.csv", Responder([b"x" * 50]))]), max_memory=1000, budget=budget
+    )
+    name, content = next(spooled)
+    assert budget.used == 100
+    content.close()
+    assert budget.used == 0
+
+
+def test_failing_responder_is_discarded():
+    def broken():
+        yield b"x"
+        raise IOError("lost connection")
+
+    budget = MemoryBudget(100)
+    spooled = spooled_responders(iter([("a.csv", broken())]), budget=budget)
+    with pytest.raises(IOError):
+        next(spooled)
+    assert budget.used == 0
+
+
+def test_exhausted_budget_spools_to_disk():
+    budget = MemoryBudget(100)
+    budget.reserve(100)
+    spooled = spooled_responders(
+        iter([("a.csv", Responder([b"x" * 50]))]), max_memory=1000, budget=budget
+    )
+    name, content = next(spooled)
+    assert content.spool._rolled
+    assert b"".join(content) == b"x" * 50
+    assert budget.used == 100
+
+
+def test_spool_file():
+    assert not spool_file(10)._rolled
+    assert spool_file(0)._rolled
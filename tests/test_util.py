@@ -2,9 +2,19 @@ from urllib.parse import urlencode
 from datetime import datetime
 
 from pycds import Network, CrmpNetworkGeoserver as cng
-from pdp_util.util import get_stn_list, get_clip_dates, get_extension
+from pdp_util.util import (
+    get_stn_list,
+    get_stn_count,
+    get_stn_counts_by,
+    get_clip_dates,
+    get_extension,
+    get_compression,
+    file_response,
+    asbool,
+)
 
 import pytest
+from zipfile import ZIP_STORED, ZIP_DEFLATED
 from sqlalchemy import text
 from webob.request import Request
 
@@ -59,6 +69,19 @@ def test_get_stn_list_with_filter(test_session, constraints, to_select, expected
     assert set(expected) == set([x[0] for x in stns])
 
 
+@pytest.mark.parametrize(
+    "constraints",
+    [[], [cng.network_name == "EC_raw"], [cng.min_obs_time < datetime(1965, 1, 1)]],
+)
+def test_get_stn_count(test_session, constraints):
+    stns = get_stn_list(test_session, constraints)
+    assert get_stn_count(test_session, constraints) == len(stns)
+    by_network = get_stn_counts_by(test_session, constraints, cng.network_name)
+    assert sum(by_network.values()) == len(stns)
+    for network, count in by_network.items():
+        assert count == len([stn for stn in stns if stn[0] == network])
+
+
 def test_single_column_select(test_session):
     stns = get_stn_list(test_session, [], cng.station_id)
     assert isinstance(stns[0][0], int)
@@ -103,7 +126,87 @@ def test_get_extension_bad():
     assert get_extension(req.environ) == None
 
 
+def test_get_extension_extra_formats():
+    req = Request.blank("?" + urlencode({"data-format": "dsg"}))
+    assert get_extension(req.environ) == None
+    assert get_extension(req.environ, ["dsg"]) == "dsg"
+
+
 def test_unpublished(test_session_with_unpublished):
     sesh = test_session_with_unpublished
     stns = get_stn_list(sesh, [Network.name == "MoSecret"])
     assert len(stns) == 0
+    assert get_stn_count(sesh, [Network.name == "MoSecret"]) == 0
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [
+        ("true", True),
+        ("Yes", True),
+        ("1", True),
+        ("false", False),
+        ("", False),
+        (True, True),
+        (0, False),
+    ],
+)
+def test_asbool(value, expected):
+    assert asbool(value) == expected
+
+
+@pytest.mark.parametrize(
+    ("params", "expected"),
+    [
+        ({}, (None, None)),
+        ({"compression": "stored"}, (ZIP_STORED, None)),
+        ({"compression": "deflated", "compression-level": "9"}, (ZIP_DEFLATED, 9)),
+        ({"compression-level": "0"}, (None, 0)),
+    ],
+)
+def test_get_compression(params, expected):
+    req = Request.blank("?" + urlencode(params))
+    assert get_compression(req.environ) == expected
+
+
+@pytest.mark.parametrize(
+    "params",
+    [{"compression": "bzip2"}, {"compression-level": "10"}, {"compression-level": "x"}],
+)
+def test_get_compression_bad(params):
+    req = Request.blank("?" + urlencode(params))
+    with pytest.raises(ValueError):
+        get_compression(req.environ)
+
+
+@pytest.mark.parametrize(
+    ("headers", "status", "body"),
+    [
+        ({}, 200, b"0123456789"),
+        ({"Range": "bytes=4-"}, 206, b"456789"),
+        ({"Range": "bytes=2-4"}, 206, b"234"),
+        ({"Range": "bytes=20-"}, 416, None),
+        ({"Range": "bytes=4-", "If-Range": '"abc"'}, 206, b"456789"),
+        # The file has changed since the first part was fetched
+        ({"Range": "bytes=4-", "If-Range": '"old"'}, 200, b"0123456789"),
+        ({"If-None-Match": '"abc"'}, 304, b""),
+    ],
+)
+def test_file_response(tmp_path, headers, status, body):
+    path = tmp_path / "archive.zip"
+    path.write_bytes(b"0123456789")
+
+    def app(environ, start_response):
+        f = open(path, "rb")
+        return file_response(
+            environ, start_response, f, [("Content-type", "application/zip")], "abc"
+        )
+
+    response = Request.blank("/", headers=headers).get_response(app)
+    assert response.status_int == status
+    if body is not None:
+        assert response.body == body
+    if status in (200, 206):
+        assert response.headers["ETag"] == '"abc"'
+        assert response.headers["Accept-Ranges"] == "bytes"
+        assert response.content_length == len(body)
@@ -0,0 +1,191 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func
+
+from pycds import ObsCountPerMonthHistory
+
+from pdp_util.windows import (
+    parse_window,
+    month_windows,
+    get_station_windows,
+    window_constraints,
+    window_name,
+    prune_stations,
+)
+
+months = [
+    (datetime(1999, 11, 1), 10),
+    (datetime(1999, 12, 1), 10),
+    (datetime(2000, 1, 1), 25),
+    (datetime(2003, 6, 1), 5),
+]
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"), [(None, None), ("", None), ("year", "year"), ("100", 100)]
+)
+def test_parse_window(value, expected):
+    assert parse_window(value) == expected
+
+
+@pytest.mark.parametrize("value", ["0", "month"])
+def test_parse_bad_window(value):
+    with pytest.raises(ValueError):
+        parse_window(value)
+
+
+def test_year_windows():
+    assert month_windows(months, "year") == [
+        (datetime(1999, 1, 1), datetime(2000, 1, 1)),
+        # The years without observations are part of the window before them
+        (datetime(2000, 1, 1), datetime(2003, 1, 1)),
+        (datetime(2003, 1, 1), datetime(2004, 1, 1)),
+    ]
+
+
+def test_row_windows():
+    assert month_windows(months, 20) == [
+        (datetime(1999, 11, 1), datetime(2000, 1, 1)),
+        (datetime(2000, 1, 1), datetime(2003, 6, 1)),
+        (datetime(2003, 6, 1), datetime(2003, 7, 1)),
+    ]
+    assert month_windows(months, 1000) == [
+        (datetime(1999, 11, 1), datetime(2003, 7, 1))
+    ]
+    assert month_windows([], 1000) == []
+
+
+def test_window_constraints():
+    window = (datetime(2000, 1, 1), datetime(2001, 1, 1))
+    assert window_constraints(window, (None, None)) == [
+        "station_observations.time>='2000-01-01 00:00:00'",
+        "station_observations.time<'2001-01-01 00:00:00'",
+    ]
+    assert window_constraints(window, (datetime(2000, 6, 1), datetime(2000, 7, 1))) == [
+        "station_observations.time>='2000-06-01 00:00:00'",
+        "station_observations.time<='2000-07-01 00:00:00'",
+    ]
+    assert window_constraints(window, (datetime(2001, 1, 1), None)) is None
+    assert window_constraints(window, (None, datetime(1999, 12, 31))) is None
+
+
+def test_open_window_constraints():
+    window = (datetime(2000, 1, 1), datetime(2001, 1, 1))
+    assert window_constraints(window, (None, None), first=True) == [
+        "station_observations.time<'2001-01-01 00:00:00'",
+    ]
+    assert window_constraints(window, (None, None), last=True) == [
+        "station_observations.time>='2000-01-01 00:00:00'",
+    ]
+    assert window_constraints(window, (None, None), True, True) == []
+    # Open ends still honour the requested dates
+    clip_dates = (datetime(1990, 1, 1), datetime(2010, 1, 1))
+    assert window_constraints(window, clip_dates, True, True) == [
+        "station_observations.time>='1990-01-01 00:00:00'",
+        "station_observations.time<='2010-01-01 00:00:00'",
+    ]
+    assert window_constraints(window, (datetime(2005, 1, 1), None), last=True) == [
+        "station_observations.time>='2005-01-01 00:00:00'",
+    ]
+    assert window_constraints(window, (datetime(2005, 1, 1), None), first=True) is None
+
+
+def test_windows_cover_uncounted_observations():
+    # Observations before, between and after the counted months (e.g. made
+    # since the counts were last refreshed) each fall in exactly one window
+    windows = month_windows(months, "year")
+    constraints = [
+        window_constraints(window, (None, None), i == 0, i == len(windows) - 1)
+        for i, window in enumerate(windows)
+    ]
+
+    def matches(time, qs):
+        for q in qs:
+            op, value = q[len("station_observations.time") :].split("'")[:2]
+            value = datetime.fromisoformat(value)
+            if not {">=": time >= value, "<": time < value, "<=": time <= value}[op]:
+                return False
+        return True
+
+    for time in [
+        datetime(1950, 1, 1),
+        datetime(1999, 11, 15),
+        datetime(2001, 7, 1),
+        datetime(2003, 6, 1),
+        datetime(2025, 1, 1),
+    ]:
+        assert sum(matches(time, qs) for qs in constraints) == 1
+
+
+def test_window_name():
+    window = (datetime(2000, 1, 1), datetime(2001, 1, 1))
+    assert window_name("EC_raw", "1046332", window, "csv") == (
+        "EC_raw/1046332/1046332_20000101-20001231.csv"
+    )
+
+
+@pytest.mark.parametrize(
+    ("clip_dates", "first", "last", "expected"),
+    [
+        ((None, None), True, False, "start-20001231"),
+        ((None, None), False, True, "20000101-end"),
+        ((None, None), True, True, "start-end"),
+        # Named from the requested dates which bound them
+        (
+            (datetime(1990, 1, 1), datetime(2010, 6, 30)),
+            True,
+            True,
+            "19900101-20100630",
+        ),
+        (
+            (datetime(2000, 3, 1), datetime(2000, 6, 30)),
+            False,
+            False,
+            "20000301-20000630",
+        ),
+        ((datetime(2000, 3, 1), None), False, True, "20000301-end"),
+    ],
+)
+def test_open_window_name(clip_dates, first, last, expected):
+    window = (datetime(2000, 1, 1), datetime(2001, 1, 1))
+    name = window_name("EC_raw", "1046332", window, "csv", clip_dates, first, last)
+    assert name == f"EC_raw/1046332/1046332_{expected}.csv"
+
+
+def test_get_station_windows(test_session):
+    stns = [("EC_raw", "1046332"), ("ARDA", "115084")]
+    windows = get_station_windows(test_session, stns, (None, None), "year")
+    assert set(windows) <= set(stns)
+    for stn, stn_windows in windows.items():
+        assert stn_windows
+        for start, end in stn_windows:
+            assert (start.month, start.day) == (1, 1)
+            assert (end.month, end.day) == (1, 1)
+        # Contiguous
+        for (start, end), (next_start, next_end) in zip(stn_windows, stn_windows[1:]):
+            assert end == next_start
+
+
+def test_prune_stations(test_session):
+    stns = [("EC_raw", "1046332"), ("ARDA", "115084")]
+    assert prune_stations(test_session, stns, (None, None)) == (stns, [])
+    # Observations made since the counts were refreshed are not in them, so
+    # nothing is pruned for times they do not cover
+    assert prune_stations(test_session, stns, (datetime(2100, 1, 1), None)) == (
+        stns,
+        [],
+    )
+    assert prune_stations(
+        test_session, stns, (datetime(1800, 1, 1), datetime(2100, 1, 1))
+    ) == (stns, [])
+    assert prune_stations(
+        test_session, stns, (datetime(1800, 1, 1), datetime(1800, 12, 31))
+    ) == ([], stns)
+
+    latest = test_session.query(func.max(ObsCountPerMonthHistory.date_trunc)).scalar()
+    edate = latest - timedelta(days=1)
+    kept, pruned = prune_stations(test_session, stns, (None, edate))
+    with_data = get_station_windows(test_session, stns, (None, edate), "year")
+    assert kept == [stn for stn in stns if stn in with_data]
+    assert kept + pruned == stns
@@ -0,0 +1,202 @@
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+import os
+import struct
+import zlib
+
+import pytest
+
+from pdp_util.budget import MemoryBudget
+from pdp_util.zipstream import (
+    ZipStream,
+    dos_date_time,
+    LOCAL_HEADER,
+    ZIP64_LIMIT,
+)
+
+
+def build(members, **kwargs):
+    archive = ZipStream(**kwargs)
+    blocks = []
+    for name, chunks in members:
+        blocks.extend(archive.write(name, chunks))
+    blocks.extend(archive.close())
+    return blocks
+
+
+@pytest.mark.parametrize("compression", [ZIP_STORED, ZIP_DEFLATED])
+def test_zipstream_is_valid_archive(compression):
+    members = [
+        ("a.txt", [b"hello ", "world\n"]),
+        ("net/stn.csv", [b"x" * 100000, b"y" * 10]),
+        ("empty.txt", []),
+        ("café.txt", ["été"]),
+    ]
+    blocks = build(members, compression=compression, block_size=1024)
+    with ZipFile(BytesIO(b"".join(blocks))) as z:
+        assert z.testzip() is None
+        assert z.namelist() == [name for name, _ in members]
+        for name, chunks in members:
+            assert z.getinfo(name).compress_type == compression
+            expected = b"".join(c.encode() if isinstance(c, str) else c for c in chunks)
+            assert z.read(name) == expected
+
+
+def stream_members(blocks):
+    """Read the deflated members of an archive front to back, as streaming readers do: from the local headers and data descriptors alone, never seeking to the central directory
+
+    :rtype: iterator of (``name``, ``size``, ``crc``) triples
+    """
+    blocks = iter(blocks)
+    buffer = bytearray()
+
+    def take(n):
+        while len(buffer) < n:
+            buffer.extend(next(blocks))
+        data = bytes(buffer[:n])
+        del buffer[:n]
+        return data
+
+    while True:
+        signature = take(4)
+        if signature != b"PK\x03\x04":
+            assert signature == b"PK\x01\x02"
+            return
+        header = LOCAL_HEADER.unpack(signature + take(LOCAL_HEADER.size - 4))
+        name = take(header[9]).decode("utf-8")
+        extra = take(header[10])
+        fields = {}
+        while extra:
+            field_id, size = struct.unpack("<HH", extra[:4])
+            fields[field_id] = extra[4 : 4 + size]
+            extra = extra[4 + size :]
+        # Without the local ZIP64 extra, the descriptor is read with 4-byte sizes
+        zip64 = 1 in fields
+
+        decompressor = zlib.decompressobj(-15)
+        size, crc = 0, 0
+        while not decompressor.eof:
+            data = decompressor.decompress(take(len(buffer) or 1))
+            size += len(data)
+            crc = zlib.crc32(data, crc)
+        buffer[:0] = decompressor.unused_data
+
+        assert take(4) == b"PK\x07\x08"
+        sizes = "<LQQ" if zip64 else "<LLL"
+        stored_crc, compress_size, file_size = struct.unpack(
+            sizes, take(struct.calcsize(sizes))
+        )
+        assert (stored_crc, file_size) == (crc, size)
+        yield name, size, crc
+
+
+def test_zipstream_streaming_reader():
+    members = [("a.txt", [b"hello"]), ("empty.txt", []), ("b.bin", [b"x" * 100000])]
+    blocks = build(members, block_size=1024)
+    assert [(name, size) for name, size, crc in stream_members(blocks)] == [
+        ("a.txt", 5),
+        ("empty.txt", 0),
+        ("b.bin", 100000),
+    ]
+
+
+@pytest.mark.slow
+def test_zipstream_zip64_member():
+    chunk = b"\0" * 2**24
+    count = ZIP64_LIMIT // len(chunk) + 2
+    size = count * len(chunk)
+    chunks = (chunk for i in range(count))
+    archive = ZipStream(compresslevel=1)
+    blocks = (
+        block
+        for part in (archive.write("big.bin", chunks), archive.close())
+        for block in part
+    )
+    assert [(name, size) for name, size, crc in stream_members(blocks)] == [
+        ("big.bin", size)
+    ]
+
+
+def test_zipstream_block_sizes():
+    block_size = 4096
+    blocks = build([("random.bin", [os.urandom(50000)])], block_size=block_size)
+    # The first block is flushed early, the last is whatever remains
+    assert all(len(block) == block_size for block in blocks[1:-1])
+    assert len(blocks) > 3
+
+
+def test_zipstream_bounded_buffer():
+    archive = ZipStream(block_size=1024, compression=ZIP_STORED)
+    for block in archive.write("big.bin", [b"\0" * 10**6]):
+        assert len(archive._buffer) < 2 * 1024
+    list(archive.close())
+
+
+def test_zipstream_fixed_date_time():
+    date_time = (2001, 2, 3, 4, 5, 6)
+    blocks = build([("a.txt", [b"a"])], date_time=date_time)
+    with ZipFile(BytesIO(b"".join(blocks))) as z:
+        assert z.getinfo("a.txt").date_time == date_time
+    assert dos_date_time((1970, 1, 1, 0, 0, 0))[0] >> 9 == 0
+
+
+@pytest.mark.slow
+def test_zipstream_zip64_member_count():
+    count = 0x10000 + 10
+    blocks = build((f"{i}.txt", [b""]) for i in range(count))
+    with ZipFile(BytesIO(b"".join(blocks))) as z:
+        assert len(z.namelist()) == count
+
+
+def test_zipstream_bad_compression():
+    with pytest.raises(ValueError):
+        ZipStream(compression=99)
+
+
+@pytest.mark.parametrize("Executor", [ThreadPoolExecutor, ProcessPoolExecutor])
+@pytest.mark.parametrize("compresslevel", [None, 1, 9])
+def test_zipstream_parallel_compression(Executor, compresslevel):
+    content = [os.urandom(1000) + b"abc" * 10000 for i in range(30)]
+    members = [("a.bin", content), ("b.txt", [b"small"]), ("c.txt", [])]
+    with Executor(max_workers=4) as executor:
+        blocks = build(
+            members,
+            compresslevel=compresslevel,
+            executor=executor,
+            piece_size=64 * 1024,
+            max_pending=4,
+        )
+    with ZipFile(BytesIO(b"".join(blocks))) as z:
+        assert z.testzip() is None
+        for name, chunks in members:
+            assert z.read(name) == b"".join(chunks)
+
+
+def test_zipstream_parallel_compression_ratio():
+    content = [b"the quick brown fox jumps over the lazy dog\n" * 100000]
+    serial = b"".join(build([("a.txt", content)]))
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        parallel = b"".join(
+            build([("a.txt", content)], executor=executor, piece_size=256 * 1024)
+        )
+    # Priming each piece with the preceding dictionary keeps the loss small
+    assert len(parallel) < 1.1 * len(serial)
+
+
+def test_zipstream_parallel_compression_budget():
+    budget = MemoryBudget(3 * 64 * 1024)
+    content = [os.urandom(64 * 1024) for i in range(20)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        blocks = build(
+            [("a.bin", content)],
+            executor=executor,
+            piece_size=64 * 1024,
+            max_pending=8,
+            budget=budget,
+        )
+    with ZipFile(BytesIO(b"".join(blocks))) as z:
+        assert z.read("a.bin") == b"".join(content)
+    assert budget.peak <= 3 * 64 * 1024
+    assert budget.throttled > 0
+    assert budget.used == 0